@@ -149,8 +149,11 @@ void DaemonPerfCounters::update(MMgrReport *report)
       ::decode(avgcount, p);
       ::decode(avgcount2, p);
     }
-    // TODO: interface for insertion of avgs
-    instances[t_path].push(now, val);
+    auto &instance = instances[t_path];
+    instance.push(now, val);
+    if (t.type & PERFCOUNTER_LONGRUNAVG) {
+      instance.push_avg(now, val, avgcount);
+    }
   }
   DECODE_FINISH(p);
 }
@@ -165,3 +168,9 @@ void PerfCounterInstance::push(utime_t t, uint64_t const &v)
   buffer.push_back({t, v});
 }
 
+void PerfCounterInstance::push_avg(utime_t t, uint64_t const &s,
+                                   uint64_t const &c)
+{
+  avg_buffer.push_back({t, s, c});
+}
+
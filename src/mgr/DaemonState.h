@@ -45,7 +45,19 @@ class PerfCounterInstance
     {}
   };
 
+  class AvgDataPoint
+  {
+    public:
+    utime_t t;
+    uint64_t s;
+    uint64_t c;
+    AvgDataPoint(utime_t t_, uint64_t s_, uint64_t c_)
+      : t(t_), s(s_), c(c_)
+    {}
+  };
+
   boost::circular_buffer<DataPoint> buffer;
+  boost::circular_buffer<AvgDataPoint> avg_buffer;
   uint64_t get_current() const;
 
   public:
@@ -53,9 +65,15 @@ class PerfCounterInstance
   {
     return buffer;
   }
+  // Sum and count samples, for PERFCOUNTER_LONGRUNAVG counters only
+  const boost::circular_buffer<AvgDataPoint> & get_data_avg() const
+  {
+    return avg_buffer;
+  }
   void push(utime_t t, uint64_t const &v);
+  void push_avg(utime_t t, uint64_t const &s, uint64_t const &c);
   PerfCounterInstance()
-    : buffer(20) {}
+    : buffer(20), avg_buffer(20) {}
 };
 
 
@@ -247,9 +247,10 @@ void MgrPyModule::notify(const std::string &notify_type, const std::string &noti
 
   Gil gil(pMyThreadState);
 
-  // Execute
+  // Execute (via MgrModule._notify, which drops stale cached state
+  // before handing over to the module's own notify())
   auto pValue = PyObject_CallMethod(pClassInstance,
-       const_cast<char*>("notify"), const_cast<char*>("(ss)"),
+       const_cast<char*>("_notify"), const_cast<char*>("(ss)"),
        notify_type.c_str(), notify_id.c_str());
 
   if (pValue != NULL) {
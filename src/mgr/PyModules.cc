@@ -17,6 +17,7 @@
 
 #include "common/errno.h"
 #include "include/stringify.h"
+#include "include/str_list.h"
 
 #include "PyFormatter.h"
 
@@ -306,6 +307,29 @@ PyObject *PyModules::get_python(const std::string &what)
       mgr_map.dump(&f);
     });
     return f.get();
+  } else if (what == "versions") {
+    // Cheap summary of the map epochs/versions, used by the python
+    // side to tell whether a cached copy of the above is still current
+    PyFormatter f;
+    cluster_state.with_osdmap([&f](const OSDMap &osd_map) {
+      f.dump_unsigned("osd_map", osd_map.get_epoch());
+    });
+    cluster_state.with_pgmap([&f](const PGMap &pg_map) {
+      f.dump_unsigned("pg_map", pg_map.version);
+    });
+    cluster_state.with_fsmap([&f](const FSMap &fsmap) {
+      f.dump_unsigned("fs_map", fsmap.get_epoch());
+    });
+    cluster_state.with_monmap([&f](const MonMap &monmap) {
+      f.dump_unsigned("mon_map", monmap.get_epoch());
+    });
+    cluster_state.with_servicemap([&f](const ServiceMap &service_map) {
+      f.dump_unsigned("service_map", service_map.epoch);
+    });
+    cluster_state.with_mgrmap([&f](const MgrMap &mgr_map) {
+      f.dump_unsigned("mgr_map", mgr_map.get_epoch());
+    });
+    return f.get();
   } else {
     derr << "Python module requested unknown data '" << what << "'" << dendl;
     Py_RETURN_NONE;
@@ -780,6 +804,237 @@ PyObject* PyModules::get_perf_schema_python(
   return f.get();
 }
 
+// Column accessors for get_pg_stats_python/get_osd_stats_python.  Each
+// one emits a single value for one PG (or OSD) into the current array
+// section, so that a projection only pays for the fields it asks for.
+typedef std::function<void(Formatter*, const pg_t&, const pg_stat_t&)>
+  PgStatColumn;
+typedef std::function<void(Formatter*, int32_t, const osd_stat_t&)>
+  OsdStatColumn;
+
+#define PG_STAT_COLUMN(name, expr)					\
+  {#name, [](Formatter *f, const pg_t &pgid, const pg_stat_t &s) {	\
+      expr;								\
+    }}
+#define PG_STAT_SUM_COLUMN(name)					\
+  PG_STAT_COLUMN(name, f->dump_int(#name, s.stats.sum.name))
+#define OSD_STAT_COLUMN(name, expr)					\
+  {#name, [](Formatter *f, int32_t osd, const osd_stat_t &s) {		\
+      expr;								\
+    }}
+
+static const std::map<std::string, PgStatColumn> pg_stat_columns = {
+  PG_STAT_COLUMN(pgid, f->dump_string("pgid", stringify(pgid))),
+  PG_STAT_COLUMN(pool, f->dump_int("pool", pgid.pool())),
+  PG_STAT_COLUMN(state, f->dump_string("state", pg_state_string(s.state))),
+  PG_STAT_COLUMN(up,
+    f->open_array_section("up");
+    for (auto osd : s.up) {
+      f->dump_int("osd", osd);
+    }
+    f->close_section()),
+  PG_STAT_COLUMN(acting,
+    f->open_array_section("acting");
+    for (auto osd : s.acting) {
+      f->dump_int("osd", osd);
+    }
+    f->close_section()),
+  PG_STAT_COLUMN(up_primary, f->dump_int("up_primary", s.up_primary)),
+  PG_STAT_COLUMN(acting_primary,
+    f->dump_int("acting_primary", s.acting_primary)),
+  PG_STAT_COLUMN(reported_epoch,
+    f->dump_unsigned("reported_epoch", s.reported_epoch)),
+  PG_STAT_COLUMN(reported_seq, f->dump_unsigned("reported_seq", s.reported_seq)),
+  PG_STAT_COLUMN(log_size, f->dump_int("log_size", s.log_size)),
+  PG_STAT_COLUMN(ondisk_log_size,
+    f->dump_int("ondisk_log_size", s.ondisk_log_size)),
+  PG_STAT_SUM_COLUMN(num_bytes),
+  PG_STAT_SUM_COLUMN(num_objects),
+  PG_STAT_SUM_COLUMN(num_object_copies),
+  PG_STAT_SUM_COLUMN(num_objects_degraded),
+  PG_STAT_SUM_COLUMN(num_objects_misplaced),
+  PG_STAT_SUM_COLUMN(num_objects_unfound),
+  PG_STAT_SUM_COLUMN(num_rd),
+  PG_STAT_SUM_COLUMN(num_rd_kb),
+  PG_STAT_SUM_COLUMN(num_wr),
+  PG_STAT_SUM_COLUMN(num_wr_kb),
+};
+
+static const std::map<std::string, OsdStatColumn> osd_stat_columns = {
+  OSD_STAT_COLUMN(osd, f->dump_int("osd", osd)),
+  OSD_STAT_COLUMN(kb, f->dump_int("kb", s.kb)),
+  OSD_STAT_COLUMN(kb_used, f->dump_int("kb_used", s.kb_used)),
+  OSD_STAT_COLUMN(kb_avail, f->dump_int("kb_avail", s.kb_avail)),
+  OSD_STAT_COLUMN(num_pgs, f->dump_unsigned("num_pgs", s.num_pgs)),
+  OSD_STAT_COLUMN(snap_trim_queue_len,
+    f->dump_int("snap_trim_queue_len", s.snap_trim_queue_len)),
+  OSD_STAT_COLUMN(num_snap_trimming,
+    f->dump_int("num_snap_trimming", s.num_snap_trimming)),
+  OSD_STAT_COLUMN(up_from, f->dump_unsigned("up_from", s.up_from)),
+  OSD_STAT_COLUMN(seq, f->dump_unsigned("seq", s.seq)),
+  OSD_STAT_COLUMN(hb_peers,
+    f->open_array_section("hb_peers");
+    for (auto osd : s.hb_peers) {
+      f->dump_int("osd", osd);
+    }
+    f->close_section()),
+  OSD_STAT_COLUMN(commit_latency_ms,
+    f->dump_unsigned("commit_latency_ms", s.os_perf_stat.os_commit_latency)),
+  OSD_STAT_COLUMN(apply_latency_ms,
+    f->dump_unsigned("apply_latency_ms", s.os_perf_stat.os_apply_latency)),
+};
+
+#undef PG_STAT_COLUMN
+#undef PG_STAT_SUM_COLUMN
+#undef OSD_STAT_COLUMN
+
+/**
+ * Resolve a comma separated list of field names against a column
+ * table.  An empty list selects every column.  Sets a python
+ * ValueError and returns false on an unknown name.
+ */
+template<typename Columns>
+static bool select_columns(
+    const std::string &fields,
+    const Columns &columns,
+    std::vector<typename Columns::const_iterator> *selected)
+{
+  std::vector<std::string> names;
+  get_str_vec(fields, ", ", names);
+  if (names.empty()) {
+    for (auto i = columns.begin(); i != columns.end(); ++i) {
+      selected->push_back(i);
+    }
+    return true;
+  }
+  for (const auto &name : names) {
+    auto i = columns.find(name);
+    if (i == columns.end()) {
+      PyErr_Format(PyExc_ValueError, "unknown field '%s'", name.c_str());
+      return false;
+    }
+    selected->push_back(i);
+  }
+  return true;
+}
+
+PyObject *PyModules::get_pg_stats_python(const std::string &fields)
+{
+  std::vector<decltype(pg_stat_columns)::const_iterator> selected;
+  if (!select_columns(fields, pg_stat_columns, &selected)) {
+    return nullptr;
+  }
+
+  PyThreadState *tstate = PyEval_SaveThread();
+  Mutex::Locker l(lock);
+  PyEval_RestoreThread(tstate);
+
+  // One list per field, all in the same (pg_stat iteration) order, so
+  // that row i of every column describes the same PG.
+  PyFormatter f;
+  cluster_state.with_pgmap([&f, &selected](const PGMap &pg_map) {
+    for (const auto &column : selected) {
+      f.open_array_section(column->first.c_str());
+      for (const auto &i : pg_map.pg_stat) {
+        column->second(&f, i.first, i.second);
+      }
+      f.close_section();
+    }
+  });
+  return f.get();
+}
+
+PyObject *PyModules::get_osd_stats_python(const std::string &fields)
+{
+  std::vector<decltype(osd_stat_columns)::const_iterator> selected;
+  if (!select_columns(fields, osd_stat_columns, &selected)) {
+    return nullptr;
+  }
+
+  PyThreadState *tstate = PyEval_SaveThread();
+  Mutex::Locker l(lock);
+  PyEval_RestoreThread(tstate);
+
+  PyFormatter f;
+  cluster_state.with_pgmap([&f, &selected](const PGMap &pg_map) {
+    for (const auto &column : selected) {
+      f.open_array_section(column->first.c_str());
+      for (const auto &i : pg_map.osd_stat) {
+        column->second(&f, i.first, i.second);
+      }
+      f.close_section();
+    }
+  });
+  return f.get();
+}
+
+PyObject* PyModules::get_all_perf_counters_python(
+    const std::string &svc_type,
+    const std::string &paths,
+    bool latest_only)
+{
+  std::vector<std::string> path_list;
+  get_str_vec(paths, ", ", path_list);
+  const std::set<std::string> wanted(path_list.begin(), path_list.end());
+
+  PyThreadState *tstate = PyEval_SaveThread();
+  Mutex::Locker l(lock);
+  PyEval_RestoreThread(tstate);
+
+  DaemonStateCollection states;
+  if (svc_type.empty()) {
+    states = daemon_state.get_all();
+  } else {
+    states = daemon_state.get_by_service(svc_type);
+  }
+
+  PyFormatter f;
+  for (const auto &statepair : states) {
+    const auto &key = statepair.first;
+    const auto &state = statepair.second;
+    Mutex::Locker l2(state->lock);
+    f.open_object_section((key.first + "." + key.second).c_str());
+    for (const auto &i : state->perf_counters.instances) {
+      if (!wanted.empty() && wanted.count(i.first) == 0) {
+        continue;
+      }
+      auto type = state->perf_counters.types.find(i.first);
+      f.open_array_section(i.first.c_str());
+      if (type != state->perf_counters.types.end() &&
+          (type->second.type & PERFCOUNTER_LONGRUNAVG)) {
+        // [t, sum, count], so that callers can derive averages
+        const auto &data = i.second.get_data_avg();
+        auto begin = data.begin();
+        if (latest_only && !data.empty()) {
+          begin = data.end() - 1;
+        }
+        for (auto datapoint = begin; datapoint != data.end(); ++datapoint) {
+          f.open_array_section("datapoint");
+          f.dump_float("t", (double)datapoint->t);
+          f.dump_unsigned("s", datapoint->s);
+          f.dump_unsigned("c", datapoint->c);
+          f.close_section();
+        }
+      } else {
+        const auto &data = i.second.get_data();
+        auto begin = data.begin();
+        if (latest_only && !data.empty()) {
+          begin = data.end() - 1;
+        }
+        for (auto datapoint = begin; datapoint != data.end(); ++datapoint) {
+          f.open_array_section("datapoint");
+          f.dump_float("t", (double)datapoint->t);
+          f.dump_unsigned("v", datapoint->v);
+          f.close_section();
+        }
+      }
+      f.close_section();
+    }
+    f.close_section();
+  }
+  return f.get();
+}
+
 PyObject *PyModules::get_context()
 {
   PyThreadState *tstate = PyEval_SaveThread();
@@ -82,6 +82,12 @@ public:
      const std::string &handle,
      const std::string svc_type,
      const std::string &svc_id);
+  PyObject *get_all_perf_counters_python(
+     const std::string &svc_type,
+     const std::string &paths,
+     bool latest_only);
+  PyObject *get_pg_stats_python(const std::string &fields);
+  PyObject *get_osd_stats_python(const std::string &fields);
   PyObject *get_context();
   PyObject *get_osdmap();
 
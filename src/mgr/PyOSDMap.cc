@@ -139,13 +139,40 @@ static PyObject *osdmap_calc_pg_upmaps(PyObject *self, PyObject *args)
 	   << " max_deviation " << max_deviation
 	   << " max_iterations " << max_iterations
 	   << dendl;
+  if (!PyList_Check(pool_list)) {
+    PyErr_SetString(PyExc_TypeError, "pool list must be a list");
+    return nullptr;
+  }
   set<int64_t> pools;
-  // FIXME: unpack pool_list and translate to pools set
-  int r = osdmap->calc_pg_upmaps(g_ceph_context,
-				 max_deviation,
-				 max_iterations,
-				 pools,
-				 inc);
+  for (Py_ssize_t i = 0; i < PyList_Size(pool_list); ++i) {
+    PyObject *pool = PyList_GetItem(pool_list, i);
+    if (PyString_Check(pool)) {
+      const char *name = PyString_AsString(pool);
+      int64_t poolid = osdmap->lookup_pg_pool_name(name);
+      if (poolid < 0) {
+	PyErr_Format(PyExc_ValueError, "pool '%s' does not exist", name);
+	return nullptr;
+      }
+      pools.insert(poolid);
+    } else if (PyInt_Check(pool)) {
+      pools.insert(PyInt_AsLong(pool));
+    } else {
+      PyErr_SetString(PyExc_TypeError,
+		      "pools must be given by name or id");
+      return nullptr;
+    }
+  }
+  dout(10) << __func__ << " pools " << pools << dendl;
+  // this only reads the map, and each caller has an incremental of its
+  // own: let other threads (e.g. other balancer candidates) run meanwhile
+  int r;
+  Py_BEGIN_ALLOW_THREADS
+  r = osdmap->calc_pg_upmaps(g_ceph_context,
+			     max_deviation,
+			     max_iterations,
+			     pools,
+			     inc);
+  Py_END_ALLOW_THREADS
   dout(10) << __func__ << " r = " << r << dendl;
   return PyInt_FromLong(r);
 }
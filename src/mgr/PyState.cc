@@ -454,6 +454,46 @@ get_perf_schema(PyObject *self, PyObject *args)
   return global_handle->get_perf_schema_python(handle, type_str, svc_id);
 }
 
+static PyObject*
+get_all_perf_counters(PyObject *self, PyObject *args)
+{
+  char *handle = nullptr;
+  char *svc_type = nullptr;
+  char *paths = nullptr;
+  int latest_only = 1;
+  if (!PyArg_ParseTuple(args, "sssi:get_all_perf_counters", &handle,
+                        &svc_type, &paths, &latest_only)) {
+    return nullptr;
+  }
+
+  return global_handle->get_all_perf_counters_python(
+      svc_type, paths, latest_only);
+}
+
+static PyObject*
+get_pg_stats(PyObject *self, PyObject *args)
+{
+  char *handle = nullptr;
+  char *fields = nullptr;
+  if (!PyArg_ParseTuple(args, "ss:get_pg_stats", &handle, &fields)) {
+    return nullptr;
+  }
+
+  return global_handle->get_pg_stats_python(fields);
+}
+
+static PyObject*
+get_osd_stats(PyObject *self, PyObject *args)
+{
+  char *handle = nullptr;
+  char *fields = nullptr;
+  if (!PyArg_ParseTuple(args, "ss:get_osd_stats", &handle, &fields)) {
+    return nullptr;
+  }
+
+  return global_handle->get_osd_stats_python(fields);
+}
+
 static PyObject *
 ceph_get_osdmap(PyObject *self, PyObject *args)
 {
@@ -486,6 +526,12 @@ PyMethodDef CephStateMethods[] = {
       "Get a performance counter"},
     {"get_perf_schema", get_perf_schema, METH_VARARGS,
       "Get the performance counter schema"},
+    {"get_all_perf_counters", get_all_perf_counters, METH_VARARGS,
+      "Get performance counters for many daemons at once"},
+    {"get_pg_stats", get_pg_stats, METH_VARARGS,
+      "Get selected per-PG stats as columns"},
+    {"get_osd_stats", get_osd_stats, METH_VARARGS,
+      "Get selected per-OSD stats as columns"},
     {"log", ceph_log, METH_VARARGS,
      "Emit a (local) log message"},
     {"get_version", ceph_get_version, METH_VARARGS,
@@ -8,28 +8,70 @@ import json
 import math
 import random
 import time
+from itertools import izip
 from mgr_module import MgrModule, CommandResult
-from threading import Event
+from threading import Event, Lock, Thread
 
 # available modes: 'none', 'crush', 'crush-compat', 'upmap', 'osd_weight'
 default_mode = 'none'
 default_sleep_interval = 60   # seconds
 default_max_misplaced = .03   # max ratio of pgs replaced at a time
+default_incremental = True    # carry eval state over between runs
+default_upmap_search_candidates = 1  # upmap plans to compare per optimize
+default_upmap_search_workers = 4     # threads building candidate plans
+default_crush_compat_metric = 'pgs'  # pgs, objects, bytes or mixed
+default_crush_compat_mixed_weights = 'pgs=1,bytes=1'
+default_max_bytes_in_flight = 0  # cap on bytes being moved, 0 = no cap
+default_max_moves_per_osd = 0    # cap on moves per osd per plan, 0 = no cap
+
+POOL_TYPE_ERASURE = 3
 
 TIME_FORMAT = '%Y-%m-%d_%H:%M:%S'
 
 
+# per-PG fields the balancer needs from the PGMap
+PG_STAT_FIELDS = ['pgid', 'state', 'num_bytes', 'num_objects',
+                  'reported_epoch', 'reported_seq']
+
+
 class MappingState:
-    def __init__(self, osdmap, pg_dump, desc=''):
+    def __init__(self, osdmap, pg_stats, desc='', prev=None):
         self.desc = desc
         self.osdmap = osdmap
-        self.osdmap_dump = self.osdmap.dump()
         self.crush = osdmap.get_crush()
-        self.crush_dump = self.crush.dump()
-        self.pg_dump = pg_dump
-        self.pg_stat = {
-            i['pgid']: i['stat_sum'] for i in pg_dump.get('pg_stats', [])
-        }
+        self.pg_up = {}  # pool id -> {pgid: up}
+        if prev is not None and \
+           prev.osdmap.get_epoch() == osdmap.get_epoch():
+            # same map; the dumps and pg mappings are still valid
+            self.osdmap_dump = prev.osdmap_dump
+            self.crush_dump = prev.crush_dump
+            self.pg_up.update(prev.pg_up)
+        else:
+            self.osdmap_dump = self.osdmap.dump()
+            self.crush_dump = self.crush.dump()
+        self.pg_stats = pg_stats
+        self._pg_stat = None
+        if prev is not None and prev.pg_stats is pg_stats:
+            self._pg_stat = prev._pg_stat
+
+    @property
+    def pg_stat(self):
+        """
+        pgid -> {'num_bytes', 'num_objects'}, only built when first used
+        """
+        if self._pg_stat is None:
+            self._pg_stat = {
+                pgid: {'num_bytes': b, 'num_objects': o}
+                for pgid, b, o in izip(self.pg_stats.column('pgid'),
+                                       self.pg_stats.column('num_bytes'),
+                                       self.pg_stats.column('num_objects'))
+            }
+        return self._pg_stat
+
+    def get_pool_pgs_up(self, poolid):
+        if poolid not in self.pg_up:
+            self.pg_up[poolid] = self.osdmap.map_pool_pgs_up(poolid)
+        return self.pg_up[poolid]
 
 
 class Plan:
@@ -42,16 +84,34 @@ class Plan:
         self.compat_ws = {}
         self.inc = ms.osdmap.new_incremental()
 
+        # pgids whose upmap changes are held back for a later cycle
+        self.deferred = set()
+
     def final_state(self):
         self.inc.set_osd_reweights(self.osd_weights)
         self.inc.set_crush_compat_weight_set_weights(self.compat_ws)
         return MappingState(self.initial.osdmap.apply_incremental(self.inc),
-                            self.initial.pg_dump,
+                            self.initial.pg_stats,
                             'plan %s final' % self.name)
 
     def dump(self):
         return json.dumps(self.inc.dump(), indent=4)
 
+    def upmap_changes(self):
+        """
+        :return: (pgids to remove upmap items for, new upmap items), not
+                 counting deferred pgs
+        """
+        incdump = self.inc.dump()
+        new_items = [item for item in incdump.get('new_pg_upmap_items', [])
+                     if item['pgid'] not in self.deferred]
+        # pg-upmap-items replaces any existing entry for the pg, so there
+        # is no need to remove it first
+        replaced = set([item['pgid'] for item in new_items])
+        rm_pgids = [pgid for pgid in incdump.get('old_pg_upmap_items', [])
+                    if pgid not in replaced and pgid not in self.deferred]
+        return rm_pgids, new_items
+
     def show(self):
         ls = []
         ls.append('# starting osdmap epoch %d' % self.initial.osdmap.get_epoch())
@@ -66,40 +126,43 @@ class Plan:
                       (osd, weight))
         for osd, weight in self.osd_weights.iteritems():
             ls.append('ceph osd reweight osd.%d %f' % (osd, weight))
-        incdump = self.inc.dump()
-        for pgid in incdump.get('old_pg_upmap_items', []):
+        rm_pgids, new_items = self.upmap_changes()
+        for pgid in rm_pgids:
             ls.append('ceph osd rm-pg-upmap-items %s' % pgid)
-        for item in incdump.get('new_pg_upmap_items', []):
+        for item in new_items:
             osdlist = []
             for m in item['mappings']:
                 osdlist += [m['from'], m['to']]
             ls.append('ceph osd pg-upmap-items %s %s' %
                       (item['pgid'], ' '.join([str(a) for a in osdlist])))
+        if self.deferred:
+            ls.append('# deferred %d pgs: %s' %
+                      (len(self.deferred), ' '.join(sorted(self.deferred))))
         return '\n'.join(ls)
 
 
 class Eval:
-    pool_name = {}       # pool id -> pool name
-    pool_id = {}         # pool name -> id
-    pool_roots = {}      # pool name -> root name
-    root_pools = {}      # root name -> pools
-    target_by_root = {}  # root name -> target weight map
-    count_by_pool = {}
-    count_by_root = {}
-    actual_by_pool = {}  # pool -> by_* -> actual weight map
-    actual_by_root = {}  # pool -> by_* -> actual weight map
-    total_by_pool = {}   # pool -> by_* -> total
-    total_by_root = {}   # root -> by_* -> total
-    stats_by_pool = {}   # pool -> by_* -> stddev or avg -> value
-    stats_by_root = {}   # root -> by_* -> stddev or avg -> value
-
-    score_by_pool = {}
-    score_by_root = {}
-
-    score = 0.0
-
     def __init__(self, ms):
         self.ms = ms
+        self.pool_name = {}       # pool id -> pool name
+        self.pool_id = {}         # pool name -> id
+        self.pool_roots = {}      # pool name -> root name
+        self.root_pools = {}      # root name -> pools
+        self.target_by_root = {}  # root name -> target weight map
+        self.count_by_pool = {}
+        self.count_by_root = {}
+        self.actual_by_pool = {}  # pool -> by_* -> actual weight map
+        self.actual_by_root = {}  # pool -> by_* -> actual weight map
+        self.total_by_pool = {}   # pool -> by_* -> total
+        self.total_by_root = {}   # root -> by_* -> total
+        self.stats_by_pool = {}   # pool -> by_* -> stddev or avg -> value
+        self.stats_by_root = {}   # root -> by_* -> stddev or avg -> value
+
+        self.score_by_pool = {}
+        self.score_by_root = {}
+        self.data_shards = {}     # pool name -> shards a pg's bytes split over
+
+        self.score = 0.0
 
     def show(self):
         r = self.ms.desc + '\n'
@@ -116,10 +179,392 @@ class Eval:
         r += 'score %f (lower is better)\n' % self.score
         return r
 
-    def calc_stats(self, count, target, total):
+
+STAT_KEYS = ('pgs', 'objects', 'bytes')
+
+
+def _new_counters(n):
+    """
+    One dense integer list per STAT_KEYS entry, each n columns wide.
+    """
+    return [[0] * n for t in STAT_KEYS]
+
+
+def _copy_by_stat(d):
+    return {k: dict(v) for k, v in d.iteritems()}
+
+
+class EvalEngine:
+    """
+    Build an Eval for a MappingState.
+
+    Rather than keeping nested dicts keyed by OSD while walking every PG
+    instance, each root and each pool gets a dense column space (one
+    column per OSD) and the pgs/objects/bytes counters of each pool live
+    in flat lists indexed by column.  Every OSD column of a pool is
+    resolved to its root column once.  The dicts that Eval exposes are
+    only materialized at the end, in the same key order the per-OSD
+    dicts always had.
+
+    The engine remembers what each PG contributed, so it can be brought
+    forward to a newer MappingState with advance(), touching only the
+    counters of PGs whose mapping or stats changed.  A PG's stats are
+    only read again when its reported epoch or seq moved.  The pool
+    counters are integers (bytes are only divided over the shards of EC
+    pools when materializing) and root counters are summed from them
+    again for every changed root, so adding and removing contributions
+    never accumulates rounding error: an advanced engine gives exactly
+    the results of a fresh one.
+    """
+    def __init__(self, ms, log):
+        self.ms = ms
+        self.log = log
+
+        self.pools = []
+        self.roots = []
+        self.pool_name = {}
+        self.pool_id = {}
+        self.pool_roots = {}
+        self.root_pools = {}
+        self.target_by_root = {}
+        self.pool_data_shards = {}
+
+        # root name -> ([osds], {osd: column})
+        self.root_columns = {}
+        # pool name -> ([osds], {osd: column}, [(root, root column)],
+        #               [counters])
+        self.pool_columns = {}
+        # pool name -> {pgid: (up, num_objects, num_bytes)}
+        self.pool_pgs = {}
+        # pgid -> (reported_epoch, reported_seq, num_objects, num_bytes)
+        self.stat_by_pg = {}
+
+        # materialized results, rebuilt only for dirty pools/roots
+        self.pool_out = {}   # pool name -> (count, actual, total)
+        self.root_out = {}   # root name -> (count, actual, total, stats)
+        self.dirty_pools = set()
+        self.dirty_roots = set()
+
+    def run(self):
+        self.setup()
+        self.refresh_stats(None)
+        for pool in self.pools:
+            self.map_pool(pool)
+        return self.finish()
+
+    def setup(self):
+        ms = self.ms
+        pool_rule = {}
+        for p in ms.osdmap_dump.get('pools',[]):
+            self.pool_name[p['pool']] = p['pool_name']
+            self.pool_id[p['pool_name']] = p['pool']
+            pool_rule[p['pool_name']] = p['crush_rule']
+            self.pool_roots[p['pool_name']] = []
+            self.pool_data_shards[p['pool_name']] = self.data_shards(p)
+        self.pools = self.pool_id.keys()
+        if len(self.pools) == 0:
+            return
+        self.log.debug('pool_name %s' % self.pool_name)
+        self.log.debug('pool_id %s' % self.pool_id)
+        self.log.debug('pools %s' % self.pools)
+        self.log.debug('pool_rule %s' % pool_rule)
+
+        # get expected distributions by root
+        rootids = ms.crush.find_takes()
+        for rootid in rootids:
+            root = ms.crush.get_item_name(rootid)
+            self.roots.append(root)
+            ls = ms.osdmap.get_pools_by_take(rootid)
+            self.root_pools[root] = []
+            for poolid in ls:
+                self.pool_roots[self.pool_name[poolid]].append(root)
+                self.root_pools[root].append(self.pool_name[poolid])
+            self.target_by_root[root] = \
+                ms.crush.get_take_weight_osd_map(rootid)
+            osds = list(self.target_by_root[root].iterkeys())
+            self.root_columns[root] = (
+                osds,
+                {osd: col for col, osd in enumerate(osds)},
+            )
+            self.dirty_roots.add(root)
+        self.log.debug('pool_roots %s' % self.pool_roots)
+        self.log.debug('root_pools %s' % self.root_pools)
+        self.log.debug('target_by_root %s' % self.target_by_root)
+
+        # pool columns, in the order of the roots the pool maps to.  each
+        # column remembers which root it is accounted against: pick the
+        # first root containing the osd.  note that this is imprecise if
+        # the roots have overlapping children.
+        for pool in self.pools:
+            osds = []
+            cols = {}
+            homes = []
+            for root in self.pool_roots[pool]:
+                root_osds, root_cols = self.root_columns[root]
+                for osd in root_osds:
+                    if osd not in cols:
+                        cols[osd] = len(osds)
+                        osds.append(osd)
+                        homes.append((root, root_cols[osd]))
+            self.pool_columns[pool] = (osds, cols, homes,
+                                       _new_counters(len(osds)))
+            self.pool_pgs[pool] = {}
+            self.dirty_pools.add(pool)
+
+    def data_shards(self, pool):
+        """
+        Each shard of an erasure coded PG only holds 1/k of the PG's
+        bytes, while a replicated PG stores all of them on every OSD.
+
+        :return: the k of the pool's erasure code profile, or 1
+        """
+        if pool.get('type') != POOL_TYPE_ERASURE:
+            return 1
+        profiles = self.ms.osdmap_dump.get('erasure_code_profiles', {})
+        profile = profiles.get(pool.get('erasure_code_profile'), {})
+        try:
+            return max(int(profile.get('k', 1)), 1)
+        except ValueError:
+            self.log.warn('bad k in erasure code profile %s' % profile)
+            return 1
+
+    def advance(self, ms, remap_pools):
+        """
+        Bring the engine forward to a newer MappingState of the same crush
+        map and pool set.  Pools in remap_pools are mapped again; the
+        others keep the mappings of the previous state, and only their
+        PGs whose stats changed are accounted again.
+
+        :return: number of PGs whose contribution changed
+        """
+        prev = self.ms
+        self.ms = ms
+        stats_changed = {}  # pool name -> [pgid]
+        for pgid in self.refresh_stats(prev):
+            pool = self.pool_name.get(int(pgid.split('.')[0]))
+            if pool is not None:
+                stats_changed.setdefault(pool, []).append(pgid)
+        changed = 0
+        for pool in self.pools:
+            poolid = self.pool_id[pool]
+            if pool in remap_pools or poolid not in prev.pg_up:
+                changed += self.map_pool(pool)
+                continue
+            ms.pg_up.setdefault(poolid, prev.pg_up[poolid])
+            pgs = self.pool_pgs[pool]
+            changed += self.update_pgs(
+                pool, [(pgid, pgs[pgid][0])
+                       for pgid in stats_changed.get(pool, [])
+                       if pgid in pgs])
+        return changed
+
+    def refresh_stats(self, prev):
+        """
+        Read the stats of the PGs that reported since the engine last
+        looked, going by their reported epoch and seq.
+
+        :param prev: MappingState the stats were last read from, or None
+        :return: list of pgids whose stats changed
+        """
+        pg_stats = self.ms.pg_stats
+        if prev is not None and prev.pg_stats is pg_stats:
+            return []
+        stat_by_pg = self.stat_by_pg
+        num_objects = pg_stats.column('num_objects')
+        num_bytes = pg_stats.column('num_bytes')
+        changed = []
+        for i, (pgid, epoch, seq) in enumerate(izip(
+                pg_stats.column('pgid'),
+                pg_stats.column('reported_epoch'),
+                pg_stats.column('reported_seq'))):
+            old = stat_by_pg.get(pgid)
+            if old is not None and old[0] == epoch and old[1] == seq:
+                continue
+            stat_by_pg[pgid] = (epoch, seq, int(num_objects[i]),
+                                int(num_bytes[i]))
+            changed.append(pgid)
+        return changed
+
+    def map_pool(self, pool):
+        pm = self.ms.get_pool_pgs_up(self.pool_id[pool])
+        pgs = self.pool_pgs[pool]
+        changed = self.update_pgs(pool, pm.iteritems())
+        if len(pgs) != len(pm):
+            removed = [pgid for pgid in pgs if pgid not in pm]
+            for pgid in removed:
+                self.account(pool, pgs.pop(pgid), -1)
+            if removed:
+                self.dirty_pools.add(pool)
+                self.dirty_roots.update(self.pool_roots[pool])
+            changed += len(removed)
+        return changed
+
+    def update_pgs(self, pool, pgs_up):
+        """
+        Account the pool's PGs in pgs_up with their current stats
+
+        :param pgs_up: iterable of (pgid, up)
+        :return: number of PGs whose contribution changed
+        """
+        stat_by_pg = self.stat_by_pg
+        pgs = self.pool_pgs[pool]
+        changed = 0
+        for pgid, up in pgs_up:
+            stat = stat_by_pg[pgid]
+            new = (up, stat[2], stat[3])
+            old = pgs.get(pgid)
+            if old == new:
+                continue
+            if old is not None:
+                self.account(pool, old, -1)
+            self.account(pool, new, 1)
+            pgs[pgid] = new
+            changed += 1
+        if changed:
+            self.dirty_pools.add(pool)
+            self.dirty_roots.update(self.pool_roots[pool])
+        return changed
+
+    def account(self, pool, contrib, sign):
+        osds, cols, homes, counters = self.pool_columns[pool]
+        pgs, objects, bytes = counters
+        up, num_objects, num_bytes = contrib
+        num_objects *= sign
+        num_bytes *= sign
+        for osd in up:
+            osd = int(osd)
+            col = cols.get(osd)
+            if col is None:
+                # mapped outside of the pool's roots; count it for the
+                # pool but not for any root
+                col = cols[osd] = len(osds)
+                osds.append(osd)
+                homes.append(None)
+                for a in counters:
+                    a.append(0)
+            pgs[col] += sign
+            objects[col] += num_objects
+            bytes[col] += num_bytes
+
+    def finish(self):
+        pe = Eval(self.ms)
+        pe.pool_name = dict(self.pool_name)
+        pe.pool_id = dict(self.pool_id)
+        pe.pool_roots = {k: list(v) for k, v in self.pool_roots.iteritems()}
+        pe.data_shards = dict(self.pool_data_shards)
+        if len(self.pools) == 0:
+            return pe
+        pe.root_pools = {k: list(v) for k, v in self.root_pools.iteritems()}
+        pe.target_by_root = dict(self.target_by_root)
+
+        # pool and root actual
+        for pool in self.dirty_pools:
+            self.pool_out[pool] = self.materialize_pool(pool)
+        for root in self.dirty_roots:
+            self.root_out[root] = self.materialize_root(root)
+        self.dirty_pools.clear()
+        self.dirty_roots.clear()
+        # hand out copies: the engine keeps its own for the next round
+        for pool in self.pools:
+            count, actual, total = self.pool_out[pool]
+            pe.count_by_pool[pool] = _copy_by_stat(count)
+            pe.actual_by_pool[pool] = _copy_by_stat(actual)
+            pe.total_by_pool[pool] = dict(total)
+        for root in self.roots:
+            count, actual, total, stats = self.root_out[root]
+            pe.count_by_root[root] = _copy_by_stat(count)
+            pe.actual_by_root[root] = _copy_by_stat(actual)
+            pe.total_by_root[root] = dict(total)
+            pe.stats_by_root[root] = _copy_by_stat(stats)
+        self.log.debug('actual_by_pool %s' % pe.actual_by_pool)
+        self.log.debug('actual_by_root %s' % pe.actual_by_root)
+
+        # the scores are already normalized
+        pe.score_by_root = {
+            r: {
+                t: pe.stats_by_root[r][t]['score'] for t in STAT_KEYS
+            } for r in pe.total_by_root.keys()
+        }
+
+        # total score is just average of normalized stddevs
+        pe.score = 0.0
+        for r, vs in pe.score_by_root.iteritems():
+            for k, v in vs.iteritems():
+                pe.score += v
+        pe.score /= 3 * len(self.roots)
+        return pe
+
+    def shard_counters(self, pool):
+        """
+        The pool's counters, with bytes divided over the shards of a PG
+        """
+        osds, cols, homes, counters = self.pool_columns[pool]
+        k = self.pool_data_shards[pool]
+        if k == 1:
+            return counters
+        return [counters[0], counters[1],
+                [v / float(k) for v in counters[2]]]
+
+    def materialize_pool(self, pool):
+        osds, cols, homes, raw = self.pool_columns[pool]
+        counters = self.shard_counters(pool)
+
+        # only instances that landed in one of the pool's roots count
+        # towards its totals
+        in_root = [col for col, home in enumerate(homes) if home is not None]
+        total = {
+            t: int(sum(counters[i][col] for col in in_root))
+            for i, t in enumerate(STAT_KEYS)
+        }
+        count = {
+            t: dict(izip(osds, [int(v) for v in counters[i]]))
+            for i, t in enumerate(STAT_KEYS)
+        }
+        return count, self.fractions(osds, counters, total), total
+
+    def root_counters(self, root):
+        """
+        Sum up the counters of the pools of a root, in root columns
+        """
+        osds, cols = self.root_columns[root]
+        counters = _new_counters(len(osds))
+        for pool in self.root_pools[root]:
+            pool_counters = self.shard_counters(pool)
+            homes = self.pool_columns[pool][2]
+            for col, home in enumerate(homes):
+                if home is None or home[0] != root:
+                    continue
+                root_col = home[1]
+                for a, b in izip(counters, pool_counters):
+                    a[root_col] += b[col]
+        return counters
+
+    def materialize_root(self, root):
+        osds, cols = self.root_columns[root]
+        counters = self.root_counters(root)
+        total = {t: int(sum(counters[i])) for i, t in enumerate(STAT_KEYS)}
+        count = {
+            t: dict(izip(osds, [float(v) for v in counters[i]]))
+            for i, t in enumerate(STAT_KEYS)
+        }
+        # average and stddev and score
+        stats = self.calc_stats(root, counters, self.target_by_root[root],
+                                total)
+        return count, self.fractions(osds, counters, total), total, stats
+
+    def fractions(self, osds, counters, total):
+        r = {}
+        for i, t in enumerate(STAT_KEYS):
+            div = float(max(total[t], 1))
+            r[t] = dict(izip(osds, [v / div for v in counters[i]]))
+        return r
+
+    def calc_stats(self, root, counters, target, total):
+        osds, cols = self.root_columns[root]
+        weights = [target[osd] for osd in osds]
         num = max(len(target), 1)
         r = {}
-        for t in ('pgs', 'objects', 'bytes'):
+        for i, t in enumerate(STAT_KEYS):
             avg = float(total[t]) / float(num)
             dev = 0.0
 
@@ -128,14 +573,14 @@ class Eval:
             score = 0.0
             sum_weight = 0.0
 
-            for k, v in count[t].iteritems():
-                # adjust/normalize by weight
-                adjusted = float(v) / target[k] / float(num)
-
+            # adjust/normalize by weight
+            adjusted = [float(v) / w / float(num)
+                        for v, w in izip(counters[i], weights)]
+            for a, w in izip(adjusted, weights):
                 # Overweighted devices and their weights are factors to calculate reweight_urgency.
                 # One 10% underfilled device with 5 2% overfilled devices, is arguably a better
                 # situation than one 10% overfilled with 5 2% underfilled devices
-                if adjusted > avg:
+                if a > avg:
                     '''
                     F(x) = 2*phi(x) - 1, where phi(x) = cdf of standard normal distribution
                     x = (adjusted - avg)/avg.
@@ -152,18 +597,195 @@ class Eval:
 
                     cdf of standard normal distribution: https://stackoverflow.com/a/29273201
                     '''
-                    score += target[k] * (math.erf(((adjusted - avg)/avg) / math.sqrt(2.0)))
-                    sum_weight += target[k]
-                dev += (avg - adjusted) * (avg - adjusted)
+                    score += w * (math.erf(((a - avg)/avg) / math.sqrt(2.0)))
+                    sum_weight += w
+            dev = sum((avg - a) * (avg - a) for a in adjusted)
             stddev = math.sqrt(dev / float(max(num - 1, 1)))
             score = score / max(sum_weight, 1)
             r[t] = {
                 'avg': avg,
                 'stddev': stddev,
-                'score': sum_weight,
+                'score': score,
             }
         return r
 
+class IncrementalEval:
+    """
+    Keep the EvalEngine of the last evaluated cluster state and bring it
+    forward to newer states instead of starting over.
+
+    The osdmap dump of each state is reduced to a small fingerprint
+    (crush version, pools, upmap entries by pool, per-osd state).
+    Comparing two fingerprints tells which pools need to be mapped
+    again: pools whose definition or upmap entries changed, and pools
+    that can map to an OSD whose up/in/weight/affinity changed.  The
+    other pools keep their previous pg mappings, and only those of their
+    PGs that reported new stats are accounted again.  A change of crush version or of the set of pools
+    (or their crush rules) falls back to a full evaluation.
+
+    pg_temp and primary_temp only affect the acting set, so they do not
+    invalidate the up mappings used here.
+    """
+    def __init__(self, log):
+        self.log = log
+        self.lock = Lock()
+        self.ms = None
+        self.engine = None
+        self.fingerprint = None
+        self.stats = {
+            'full': 0,
+            'incremental': 0,
+            'pools_remapped': 0,
+            'pgs_changed': 0,
+        }
+
+    def reset(self):
+        with self.lock:
+            self.ms = None
+            self.engine = None
+            self.fingerprint = None
+
+    def last_state(self):
+        """
+        :return: the MappingState evaluated last, or None
+        """
+        with self.lock:
+            return self.ms
+
+    def eval(self, ms):
+        with self.lock:
+            if self.ms is not None and \
+               ms.osdmap.get_epoch() < self.ms.osdmap.get_epoch():
+                # older than what we track; don't go backwards
+                return EvalEngine(ms, self.log).run()
+            fp = self.get_fingerprint(ms)
+            remap = None
+            if self.engine is not None:
+                remap = self.changed_pools(self.fingerprint, fp)
+            if remap is None:
+                self.engine = EvalEngine(ms, self.log)
+                pe = self.engine.run()
+                self.stats['full'] += 1
+            else:
+                changed = self.engine.advance(ms, remap)
+                pe = self.engine.finish()
+                self.stats['incremental'] += 1
+                self.stats['pools_remapped'] += len(remap)
+                self.stats['pgs_changed'] += changed
+                self.log.debug('incremental eval: remapped pools %s, '
+                               '%d pgs changed' % (list(remap), changed))
+            self.ms = ms
+            self.fingerprint = fp
+            return pe
+
+    def get_fingerprint(self, ms):
+        dump = ms.osdmap_dump
+        pools = {p['pool']: p for p in dump.get('pools', [])}
+        upmaps = {}
+        for key in ('pg_upmap', 'pg_upmap_items'):
+            for item in dump.get(key, []):
+                poolid = int(item['pgid'].split('.')[0])
+                upmaps.setdefault(poolid, []).append(item)
+        osds = {
+            o['osd']: (o['up'], o['in'], o['weight'], o['primary_affinity'])
+            for o in dump.get('osds', [])
+        }
+        return {
+            'crush_version': ms.osdmap.get_crush_version(),
+            'pools': pools,
+            'upmaps': upmaps,
+            'osds': osds,
+        }
+
+    def changed_pools(self, old, new):
+        """
+        :return: set of pool names to map again, or None if a full
+                 evaluation is needed
+        """
+        if old['crush_version'] != new['crush_version']:
+            return None
+        if set(old['pools']) != set(new['pools']):
+            return None
+        if set(old['osds']) != set(new['osds']):
+            return None
+        engine = self.engine
+        remap = set()
+        for poolid, pool in new['pools'].iteritems():
+            prev = old['pools'][poolid]
+            if prev['crush_rule'] != pool['crush_rule'] or \
+               prev['pool_name'] != pool['pool_name']:
+                return None
+            if prev != pool or \
+               old['upmaps'].get(poolid) != new['upmaps'].get(poolid):
+                remap.add(engine.pool_name[poolid])
+        changed_osds = [osd for osd, state in new['osds'].iteritems()
+                        if old['osds'][osd] != state]
+        if changed_osds:
+            for pool, (osds, cols, homes, counters) in \
+                    engine.pool_columns.iteritems():
+                for osd in changed_osds:
+                    if osd in cols:
+                        remap.add(pool)
+                        break
+        return remap
+
+
+class MoveScheduler:
+    """
+    Throttle the data movement a plan causes.
+
+    Each candidate change comes with an estimate of the bytes it moves
+    and the OSDs that send or receive them.  Candidates are admitted in
+    order of score gain per byte moved, as long as the bytes fit into
+    what is left of max_bytes_in_flight (after counting PGs that are
+    already remapped or backfilling) and no OSD takes part in more than
+    max_moves_per_osd moves.  A limit of 0 means no limit.
+
+    Bytes are those of one shard of a PG, as in the evaluation: all of
+    the PG's bytes for a replicated pool, 1/k of them for an EC pool.
+    """
+    def __init__(self, ms, max_bytes, max_moves_per_osd, data_shards):
+        """
+        :param data_shards: pool id -> shards a PG's bytes split over
+        """
+        self.in_flight = 0
+        for pgid, state, num_bytes in izip(ms.pg_stats.column('pgid'),
+                                           ms.pg_stats.column('state'),
+                                           ms.pg_stats.column('num_bytes')):
+            if 'remapped' in state or 'backfill' in state:
+                pool = int(pgid.split('.')[0])
+                self.in_flight += num_bytes / data_shards.get(pool, 1)
+        self.budget = None
+        if max_bytes:
+            self.budget = max(max_bytes - self.in_flight, 0)
+        self.max_moves_per_osd = max_moves_per_osd
+        self.moves = {}
+        self.admitted_bytes = 0
+
+    def admit(self, candidates):
+        """
+        :param candidates: list of (key, gain, bytes, osds)
+        :return: set of admitted keys
+        """
+        admitted = set()
+        order = sorted(candidates,
+                       key=lambda c: -float(c[1]) / max(c[2], 1))
+        for key, gain, nbytes, osds in order:
+            if self.budget is not None and nbytes > self.budget:
+                continue
+            if self.max_moves_per_osd and \
+               [o for o in osds
+                if self.moves.get(o, 0) >= self.max_moves_per_osd]:
+                continue
+            admitted.add(key)
+            self.admitted_bytes += nbytes
+            if self.budget is not None:
+                self.budget -= nbytes
+            for o in osds:
+                self.moves[o] = self.moves.get(o, 0) + 1
+        return admitted
+
+
 class Module(MgrModule):
     COMMANDS = [
         {
@@ -226,10 +848,13 @@ class Module(MgrModule):
     run = True
     plans = {}
     mode = ''
+    execute_progress = {}
+    weight_set_cache = None  # (crush version, weight-set weights)
 
     def __init__(self, *args, **kwargs):
         super(Module, self).__init__(*args, **kwargs)
         self.event = Event()
+        self.tracker = IncrementalEval(self.log)
 
     def handle_command(self, command):
         self.log.warn("Handling command: '%s'" % str(command))
@@ -238,6 +863,8 @@ class Module(MgrModule):
                 'plans': self.plans.keys(),
                 'active': self.active,
                 'mode': self.get_config('mode', default_mode),
+                'eval': self.tracker.stats,
+                'execute': self.execute_progress,
             }
             return (0, json.dumps(s, indent=4), '')
         elif command['prefix'] == 'balancer mode':
@@ -262,11 +889,11 @@ class Module(MgrModule):
                     return (-errno.ENOENT, '', 'plan %s not found' %
                             command['plan'])
                 ms = plan.final_state()
+                incremental = False
             else:
-                ms = MappingState(self.get_osdmap(),
-                                  self.get("pg_dump"),
-                                  'current cluster')
-            return (0, self.evaluate(ms), '')
+                ms = self.get_cluster_state('current cluster')
+                incremental = True
+            return (0, self.evaluate(ms, incremental), '')
         elif command['prefix'] == 'balancer optimize':
             plan = self.plan_create(command['plan'])
             self.optimize(plan)
@@ -291,9 +918,9 @@ class Module(MgrModule):
             plan = self.plans.get(command['plan'])
             if not plan:
                 return (-errno.ENOENT, '', 'plan %s not found' % command['plan'])
-            self.execute(plan)
-            self.plan_rm(plan)
-            return (0, '', '')
+            r, detail = self.execute(plan)
+            self.plan_rm(plan.name)
+            return (r, '', detail)
         else:
             return (-errno.EINVAL, '',
                     "Command not found '{0}'".format(command['prefix']))
@@ -321,10 +948,22 @@ class Module(MgrModule):
             self.event.wait(sleep_interval)
             self.event.clear()
 
+    def incremental(self):
+        v = self.get_config('incremental', default_incremental)
+        return str(v).lower() in ('1', 'true', 'yes', 'on')
+
+    def get_cluster_state(self, desc):
+        prev = None
+        if self.incremental():
+            prev = self.tracker.last_state()
+        else:
+            self.tracker.reset()
+        return MappingState(self.get_osdmap(),
+                            self.get_pg_stats_view(PG_STAT_FIELDS), desc,
+                            prev)
+
     def plan_create(self, name):
-        plan = Plan(name, MappingState(self.get_osdmap(),
-                                       self.get("pg_dump"),
-                                       'plan %s initial' % name))
+        plan = Plan(name, self.get_cluster_state('plan %s initial' % name))
         self.plans[name] = plan
         return plan
 
@@ -332,184 +971,18 @@ class Module(MgrModule):
         if name in self.plans:
             del self.plans[name]
 
-    def calc_eval(self, ms):
-        pe = Eval(ms)
-        pool_rule = {}
-        for p in ms.osdmap_dump.get('pools',[]):
-            pe.pool_name[p['pool']] = p['pool_name']
-            pe.pool_id[p['pool_name']] = p['pool']
-            pool_rule[p['pool_name']] = p['crush_rule']
-            pe.pool_roots[p['pool_name']] = []
-        pools = pe.pool_id.keys()
-        if len(pools) == 0:
-            return pe
-        self.log.debug('pool_name %s' % pe.pool_name)
-        self.log.debug('pool_id %s' % pe.pool_id)
-        self.log.debug('pools %s' % pools)
-        self.log.debug('pool_rule %s' % pool_rule)
-
-        # get expected distributions by root
-        actual_by_root = {}
-        rootids = ms.crush.find_takes()
-        roots = []
-        for rootid in rootids:
-            root = ms.crush.get_item_name(rootid)
-            roots.append(root)
-            ls = ms.osdmap.get_pools_by_take(rootid)
-            pe.root_pools[root] = []
-            for poolid in ls:
-                pe.pool_roots[pe.pool_name[poolid]].append(root)
-                pe.root_pools[root].append(pe.pool_name[poolid])
-            pe.target_by_root[root] = ms.crush.get_take_weight_osd_map(rootid)
-            actual_by_root[root] = {
-                'pgs': {},
-                'objects': {},
-                'bytes': {},
-            }
-            for osd in pe.target_by_root[root].iterkeys():
-                actual_by_root[root]['pgs'][osd] = 0
-                actual_by_root[root]['objects'][osd] = 0
-                actual_by_root[root]['bytes'][osd] = 0
-            pe.total_by_root[root] = {
-                'pgs': 0,
-                'objects': 0,
-                'bytes': 0,
-            }
-        self.log.debug('pool_roots %s' % pe.pool_roots)
-        self.log.debug('root_pools %s' % pe.root_pools)
-        self.log.debug('target_by_root %s' % pe.target_by_root)
-
-        # pool and root actual
-        for pool in pools:
-            pi = [p for p in ms.osdmap_dump.get('pools',[])
-                  if p['pool_name'] == pool][0]
-            poolid = pi['pool']
-            pm = ms.osdmap.map_pool_pgs_up(poolid)
-            pgs = 0
-            objects = 0
-            bytes = 0
-            pgs_by_osd = {}
-            objects_by_osd = {}
-            bytes_by_osd = {}
-            for root in pe.pool_roots[pool]:
-                for osd in pe.target_by_root[root].iterkeys():
-                    pgs_by_osd[osd] = 0
-                    objects_by_osd[osd] = 0
-                    bytes_by_osd[osd] = 0
-            for pgid, up in pm.iteritems():
-                for osd in [int(osd) for osd in up]:
-                    pgs_by_osd[osd] += 1
-                    objects_by_osd[osd] += ms.pg_stat[pgid]['num_objects']
-                    bytes_by_osd[osd] += ms.pg_stat[pgid]['num_bytes']
-                    # pick a root to associate this pg instance with.
-                    # note that this is imprecise if the roots have
-                    # overlapping children.
-                    # FIXME: divide bytes by k for EC pools.
-                    for root in pe.pool_roots[pool]:
-                        if osd in pe.target_by_root[root]:
-                            actual_by_root[root]['pgs'][osd] += 1
-                            actual_by_root[root]['objects'][osd] += ms.pg_stat[pgid]['num_objects']
-                            actual_by_root[root]['bytes'][osd] += ms.pg_stat[pgid]['num_bytes']
-                            pgs += 1
-                            objects += ms.pg_stat[pgid]['num_objects']
-                            bytes += ms.pg_stat[pgid]['num_bytes']
-                            pe.total_by_root[root]['pgs'] += 1
-                            pe.total_by_root[root]['objects'] += ms.pg_stat[pgid]['num_objects']
-                            pe.total_by_root[root]['bytes'] += ms.pg_stat[pgid]['num_bytes']
-                            break
-            pe.count_by_pool[pool] = {
-                'pgs': {
-                    k: v
-                    for k, v in pgs_by_osd.iteritems()
-                },
-                'objects': {
-                    k: v
-                    for k, v in objects_by_osd.iteritems()
-                },
-                'bytes': {
-                    k: v
-                    for k, v in bytes_by_osd.iteritems()
-                },
-            }
-            pe.actual_by_pool[pool] = {
-                'pgs': {
-                    k: float(v) / float(max(pgs, 1))
-                    for k, v in pgs_by_osd.iteritems()
-                },
-                'objects': {
-                    k: float(v) / float(max(objects, 1))
-                    for k, v in objects_by_osd.iteritems()
-                },
-                'bytes': {
-                    k: float(v) / float(max(bytes, 1))
-                    for k, v in bytes_by_osd.iteritems()
-                },
-            }
-            pe.total_by_pool[pool] = {
-                'pgs': pgs,
-                'objects': objects,
-                'bytes': bytes,
-            }
-        for root, m in pe.total_by_root.iteritems():
-            pe.count_by_root[root] = {
-                'pgs': {
-                    k: float(v)
-                    for k, v in actual_by_root[root]['pgs'].iteritems()
-                },
-                'objects': {
-                    k: float(v)
-                    for k, v in actual_by_root[root]['objects'].iteritems()
-                },
-                'bytes': {
-                    k: float(v)
-                    for k, v in actual_by_root[root]['bytes'].iteritems()
-                },
-            }
-            pe.actual_by_root[root] = {
-                'pgs': {
-                    k: float(v) / float(max(pe.total_by_root[root]['pgs'], 1))
-                    for k, v in actual_by_root[root]['pgs'].iteritems()
-                },
-                'objects': {
-                    k: float(v) / float(max(pe.total_by_root[root]['objects'], 1))
-                    for k, v in actual_by_root[root]['objects'].iteritems()
-                },
-                'bytes': {
-                    k: float(v) / float(max(pe.total_by_root[root]['bytes'], 1))
-                    for k, v in actual_by_root[root]['bytes'].iteritems()
-                },
-            }
-        self.log.debug('actual_by_pool %s' % pe.actual_by_pool)
-        self.log.debug('actual_by_root %s' % pe.actual_by_root)
-
-        # average and stddev and score
-        pe.stats_by_root = {
-            a: pe.calc_stats(
-                b,
-                pe.target_by_root[a],
-                pe.total_by_root[a]
-            ) for a, b in pe.count_by_root.iteritems()
-        }
-
-	# the scores are already normalized
-        pe.score_by_root = {
-            r: {
-                'pgs': pe.stats_by_root[r]['pgs']['score'],
-                'objects': pe.stats_by_root[r]['objects']['score'],
-                'bytes': pe.stats_by_root[r]['bytes']['score'],
-            } for r in pe.total_by_root.keys()
-        }
-
-        # total score is just average of normalized stddevs
-        pe.score = 0.0
-        for r, vs in pe.score_by_root.iteritems():
-            for k, v in vs.iteritems():
-                pe.score += v
-        pe.score /= 3 * len(roots)
-        return pe
-
-    def evaluate(self, ms):
-        pe = self.calc_eval(ms)
+    def calc_eval(self, ms, incremental=False):
+        """
+        Evaluate the data distribution of a MappingState.  Pass
+        incremental=True for states of the live cluster (as opposed to
+        plan outcomes) to reuse the work of the previous evaluation.
+        """
+        if incremental and self.incremental():
+            return self.tracker.eval(ms)
+        return EvalEngine(ms, self.log).run()
+
+    def evaluate(self, ms, incremental=False):
+        pe = self.calc_eval(ms, incremental)
         return pe.show()
 
     def optimize(self, plan):
@@ -538,9 +1011,10 @@ class Module(MgrModule):
                           misplaced, max_misplaced)
         else:
             if plan.mode == 'upmap':
-                return self.do_upmap(plan)
+                return self.do_upmap(plan) and self.schedule_moves(plan)
             elif plan.mode == 'crush-compat':
-                return self.do_crush_compat(plan)
+                return self.do_crush_compat(plan) and \
+                    self.schedule_moves(plan)
             elif plan.mode == 'none':
                 self.log.info('Idle')
             else:
@@ -549,21 +1023,132 @@ class Module(MgrModule):
 
         ##
 
+    def schedule_moves(self, plan):
+        """
+        Trim a prepared plan down to the data movement we allow per cycle
+        (see MoveScheduler).  Upmap entries that don't make the cut are
+        deferred: the incremental keeps them, but they are not executed.
+
+        :return: True if anything is left to execute
+        """
+        max_bytes = int(self.get_config('max_bytes_in_flight',
+                                        default_max_bytes_in_flight))
+        max_moves = int(self.get_config('max_moves_per_osd',
+                                        default_max_moves_per_osd))
+        if not max_bytes and not max_moves:
+            return True
+        ms = plan.initial
+        pe = self.calc_eval(ms, incremental=True)
+        sched = MoveScheduler(ms, max_bytes, max_moves,
+                              {pe.pool_id[pool]: k for pool, k in
+                               pe.data_shards.iteritems()})
+
+        def shard_bytes(pgid):
+            pool = pe.pool_name[int(pgid.split('.')[0])]
+            stat = ms.pg_stat.get(pgid, {})
+            return stat.get('num_bytes', 0) / pe.data_shards.get(pool, 1)
+
+        def improvement(root, osd, delta):
+            # how much closer the osd's share of the pgs of its root gets
+            # to its target when the share changes by delta
+            target = pe.target_by_root[root].get(osd, 0.0)
+            actual = pe.actual_by_root[root]['pgs'].get(osd, 0.0)
+            return abs(actual - target) - abs(actual + delta - target)
+
+        def gain(pgid, moves):
+            # one shard of the pg leaves each source for the destination
+            pool = pe.pool_name[int(pgid.split('.')[0])]
+            if not pe.pool_roots.get(pool):
+                return 0.0
+            root = pe.pool_roots[pool][0]
+            delta = 1.0 / max(pe.total_by_root[root]['pgs'], 1)
+            g = 0.0
+            for frm, to in moves:
+                g += improvement(root, frm, -delta)
+                g += improvement(root, to, delta)
+            return g
+
+        candidates = []
+
+        # compat weight-set changes: the OSD gains or sheds about the
+        # relative weight change of what it holds
+        old_ws = {}
+        if plan.compat_ws:
+            old_ws = self.get_compat_weight_set_weights(ms, create=False)
+        for osd, weight in plan.compat_ws.iteritems():
+            old = old_ws.get(osd, weight)
+            ratio = weight / max(old, 1e-9)
+            held = 0
+            g = 0.0
+            for root, counts in pe.count_by_root.iteritems():
+                held += counts['bytes'].get(osd, 0)
+                if osd in pe.target_by_root[root]:
+                    actual = pe.actual_by_root[root]['pgs'].get(osd, 0.0)
+                    g += improvement(root, osd, actual * (ratio - 1))
+            nbytes = int(held * abs(ratio - 1))
+            candidates.append((('ws', osd), g, nbytes, [osd]))
+
+        # upmap changes: one shard moves for every new mapping
+        current = {}
+        for item in ms.osdmap_dump.get('pg_upmap_items', []):
+            current[item['pgid']] = [(m['from'], m['to'])
+                                     for m in item['mappings']]
+        rm_pgids, new_items = plan.upmap_changes()
+        for pgid in rm_pgids:
+            moves = [(to, frm) for frm, to in current.get(pgid, [])]
+            candidates.append((('upmap', pgid), gain(pgid, moves),
+                               shard_bytes(pgid) * len(moves),
+                               [o for m in moves for o in m]))
+        for item in new_items:
+            pgid = item['pgid']
+            moves = [(m['from'], m['to']) for m in item['mappings']
+                     if (m['from'], m['to']) not in current.get(pgid, [])]
+            candidates.append((('upmap', pgid), gain(pgid, moves),
+                               shard_bytes(pgid) * len(moves),
+                               [o for m in moves for o in m]))
+
+        admitted = sched.admit(candidates)
+        for key, g, nbytes, osds in candidates:
+            if key in admitted:
+                continue
+            kind, what = key
+            if kind == 'ws':
+                del plan.compat_ws[what]
+            else:
+                plan.deferred.add(what)
+        self.log.info('scheduled %d/%d changes, %d bytes to move '
+                      '(%d already in flight), %d deferred' %
+                      (len(admitted), len(candidates), sched.admitted_bytes,
+                       sched.in_flight, len(candidates) - len(admitted)))
+        return len(admitted) > 0
+
     def do_upmap(self, plan):
         self.log.info('do_upmap')
-        max_iterations = self.get_config('upmap_max_iterations', 10)
-        max_deviation = self.get_config('upmap_max_deviation', .01)
+        max_iterations = int(self.get_config('upmap_max_iterations', 10))
+        max_deviation = float(self.get_config('upmap_max_deviation', .01))
 
         ms = plan.initial
         pools = [str(i['pool_name']) for i in ms.osdmap_dump.get('pools',[])]
         if len(pools) == 0:
             self.log.info('no pools, nothing to do')
             return False
+
+        candidates = int(self.get_config('upmap_search_candidates',
+                                         default_upmap_search_candidates))
+        if candidates > 1:
+            return self.do_upmap_search(plan, pools, candidates,
+                                        max_iterations, max_deviation)
+
         # shuffle pool list so they all get equal (in)attention
         random.shuffle(pools)
         self.log.info('pools %s' % pools)
 
-        inc = plan.inc
+        total_did = self.calc_upmaps(ms, plan.inc, pools, max_iterations,
+                                     max_deviation)
+        self.log.info('prepared %d/%d changes' % (total_did, max_iterations))
+        return True
+
+    def calc_upmaps(self, ms, inc, pools, max_iterations, max_deviation):
         total_did = 0
         left = max_iterations
         for pool in pools:
@@ -572,19 +1157,127 @@ class Module(MgrModule):
             left -= did
             if left <= 0:
                 break
-        self.log.info('prepared %d/%d changes' % (total_did, max_iterations))
+        return total_did
+
+    def do_upmap_search(self, plan, pools, candidates, max_iterations,
+                        max_deviation):
+        """
+        Prepare several candidate upmap plans and keep the one with the
+        best score improvement per PG it moves.  calc_pg_upmaps is
+        deterministic, so the candidates differ in what they ask of it:
+        each works through the pools in a different random order (the
+        iteration budget goes to the pools that come first) and asks
+        for a different max_deviation, from the configured one down to
+        a quarter of it.  Candidates that turn out the same plan are
+        only scored once, those that would push the misplaced ratio over
+        max_misplaced are discarded, and one that doesn't improve the
+        score is never picked.  Of equally good candidates, the first
+        one wins.
+
+        The plans are built on upmap_search_workers threads; the
+        calc_pg_upmaps binding releases the GIL while it runs.  They are
+        scored afterwards, in candidate order.
+        """
+        ms = plan.initial
+        workers = int(self.get_config('upmap_search_workers',
+                                      default_upmap_search_workers))
+        max_misplaced = float(self.get_config('max_misplaced',
+                                              default_max_misplaced))
+        misplaced = self.get('pg_status').get('misplaced_ratio', 0.0)
+        poolids = [p['pool'] for p in ms.osdmap_dump.get('pools', [])]
+        total_pgs = sum([len(ms.get_pool_pgs_up(p)) for p in poolids])
+        budget = int((max_misplaced - misplaced) * total_pgs)
+        score = self.calc_eval(ms, incremental=True).score
+        self.log.info('searching %d candidates on %d workers, '
+                      'budget %d of %d pgs, score %f' %
+                      (candidates, workers, budget, total_pgs, score))
+
+        cands = []
+        for i in range(candidates):
+            order = list(pools)
+            random.shuffle(order)
+            deviation = max_deviation * \
+                (1.0 - .75 * i / max(candidates - 1, 1))
+            cand = Plan('%s_%d' % (plan.name, i), ms)
+            cand.mode = plan.mode
+            cands.append((cand, order, deviation))
+        did_by_cand = [0] * candidates
+        todo = range(candidates)
+        lock = Lock()
+
+        def worker():
+            while True:
+                with lock:
+                    if not todo:
+                        return
+                    i = todo.pop()
+                cand, order, deviation = cands[i]
+                try:
+                    did_by_cand[i] = self.calc_upmaps(
+                        ms, cand.inc, order, max_iterations, deviation)
+                except Exception:
+                    self.log.exception('candidate %s failed' % cand.name)
+
+        threads = [Thread(target=worker)
+                   for i in range(max(min(workers, candidates), 1))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        best = None
+        best_key = None
+        seen = set()
+        for (cand, order, deviation), did in izip(cands, did_by_cand):
+            if not did:
+                continue
+            changes = json.dumps(cand.upmap_changes(), sort_keys=True)
+            if changes in seen:
+                continue
+            seen.add(changes)
+            moved, cand_score = self.score_upmap_candidate(cand, poolids)
+            self.log.debug('candidate %s: max_deviation %f, %d changes, '
+                           '%d pgs moved, score %f' %
+                           (cand.name, deviation, did, moved, cand_score))
+            gain = score - cand_score
+            if moved > budget or gain <= 0:
+                continue
+            key = (gain / max(moved, 1), did)
+            if best_key is None or key > best_key:
+                best, best_key = cand, key
+        if best is None:
+            self.log.info('no candidate improves the score within the '
+                          'misplaced budget')
+            return False
+        self.log.info('picked %s: %d changes, gain per pg moved %f' %
+                      (best.name, best_key[1], best_key[0]))
+        plan.inc = best.inc
         return True
 
+    def score_upmap_candidate(self, cand, poolids):
+        """
+        :return: (PGs whose up set the candidate changes, its score)
+        """
+        ms = cand.initial
+        final = cand.final_state()
+        moved = 0
+        for poolid in poolids:
+            before = ms.get_pool_pgs_up(poolid)
+            for pgid, up in final.get_pool_pgs_up(poolid).iteritems():
+                if before.get(pgid) != up:
+                    moved += 1
+        return moved, self.calc_eval(final).score
+
     def do_crush_compat(self, plan):
         self.log.info('do_crush_compat')
-        osdmap = self.get_osdmap()
-        crush = osdmap.get_crush()
+        ms = plan.initial
 
         # get current compat weight-set weights
-        old_ws = self.get_compat_weight_set_weights()
+        old_ws = self.get_compat_weight_set_weights(ms)
+        if old_ws is None:
+            return False
 
-        ms = plan.initial
-        pe = self.calc_eval(ms)
+        pe = self.calc_eval(ms, incremental=True)
 
         # Make sure roots don't overlap their devices.  If so, we
         # can't proceed.
@@ -603,7 +1296,15 @@ class Module(MgrModule):
                          overlap)
             return False
 
-        key = 'pgs'  # pgs objects or bytes
+        key = self.get_config('crush_compat_metric',
+                              default_crush_compat_metric)
+        if key == 'mixed':
+            mix = self.get_mixed_weights()
+            if not mix:
+                return False
+        elif key not in STAT_KEYS:
+            self.log.error('Unrecognized crush_compat_metric %s' % key)
+            return False
 
         # go
         random.shuffle(roots)
@@ -612,7 +1313,10 @@ class Module(MgrModule):
             self.log.info('Balancing root %s (pools %s) by %s' %
                           (root, pools, key))
             target = pe.target_by_root[root]
-            actual = pe.actual_by_root[root][key]
+            if key == 'mixed':
+                actual = self.mix_actual(pe.actual_by_root[root], mix)
+            else:
+                actual = pe.actual_by_root[root][key]
             queue = sorted(actual.keys(),
                            key=lambda osd: -abs(target[osd] - actual[osd]))
             self.log.debug('queue %s' % queue)
@@ -620,6 +1324,10 @@ class Module(MgrModule):
                 deviation = target[osd] - actual[osd]
                 if deviation == 0:
                     break
+                if actual[osd] == 0:
+                    # nothing there yet (e.g. no bytes); no ratio to go by
+                    self.log.debug('osd.%d is empty, skipping', osd)
+                    continue
                 self.log.debug('osd.%d deviation %f', osd, deviation)
                 weight = old_ws[osd]
                 calc_weight = target[osd] / actual[osd] * weight
@@ -629,6 +1337,39 @@ class Module(MgrModule):
                 plan.compat_ws[osd] = new_weight
         return True
 
+    def get_mixed_weights(self):
+        """
+        Parse crush_compat_mixed_weights, e.g. 'pgs=1,bytes=2'
+
+        :return: dict of stat key to weight, or None if invalid
+        """
+        raw = self.get_config('crush_compat_mixed_weights',
+                              default_crush_compat_mixed_weights)
+        mix = {}
+        try:
+            for item in raw.split(','):
+                k, v = item.split('=')
+                mix[k.strip()] = float(v)
+        except ValueError:
+            self.log.error('Bad crush_compat_mixed_weights %s' % raw)
+            return None
+        bad = [k for k in mix if k not in STAT_KEYS]
+        if bad or sum(mix.values()) <= 0:
+            self.log.error('Bad crush_compat_mixed_weights %s' % raw)
+            return None
+        return mix
+
+    def mix_actual(self, actual_by_key, mix):
+        """
+        Weighted average of the normalized per-key distributions of a root
+        """
+        total = sum(mix.values())
+        r = {}
+        for osd in actual_by_key['pgs'].iterkeys():
+            r[osd] = sum([w * actual_by_key[k][osd]
+                          for k, w in mix.iteritems()]) / total
+        return r
+
     def compat_weight_set_reweight(self, osd, new_weight):
         self.log.debug('ceph osd crush weight-set reweight-compat')
         result = CommandResult('')
@@ -644,41 +1385,65 @@ class Module(MgrModule):
             (osd, new_weight))
             return
 
-    def get_compat_weight_set_weights(self):
-        # enable compat weight-set
-        self.log.debug('ceph osd crush weight-set create-compat')
-        result = CommandResult('')
-        self.send_command(result, 'mon', '', json.dumps({
-            'prefix': 'osd crush weight-set create-compat',
-            'format': 'json',
-        }), '')
-        r, outb, outs = result.wait()
-        if r != 0:
-            self.log.error('Error creating compat weight-set')
-            return
-
-        result = CommandResult('')
-        self.send_command(result, 'mon', '', json.dumps({
-            'prefix': 'osd crush dump',
-            'format': 'json',
-        }), '')
-        r, outb, outs = result.wait()
-        if r != 0:
-            self.log.error('Error dumping crush map')
-            return
-        try:
-            crushmap = json.loads(outb)
-        except:
-            raise RuntimeError('unable to parse crush map')
+    def get_compat_weight_set_weights(self, ms, create=True):
+        """
+        Get the compat weight-set weights of all crush items of the map in
+        `ms`, creating the compat weight-set first if there is none.  The
+        result is cached by crush version, so the map only needs to be
+        walked again once crush changes.
+
+        With create=False nothing is sent to the mon: if there is no
+        compat weight-set, the crush weights it would start out with are
+        returned instead.
+        """
+        version = ms.osdmap.get_crush_version()
+        cached = self.weight_set_cache
+        if cached is not None and cached[0] == version:
+            return dict(cached[1])
+
+        crushmap = ms.crush_dump
+        if '-1' not in crushmap.get('choose_args', {}) and not create:
+            weights = {}
+            for b in crushmap['buckets']:
+                for item in b['items']:
+                    weights[item['id']] = item['weight'] / float(0x10000)
+            return weights
+        if '-1' not in crushmap.get('choose_args', {}):
+            # enable compat weight-set
+            self.log.debug('ceph osd crush weight-set create-compat')
+            result = CommandResult('')
+            self.send_command(result, 'mon', '', json.dumps({
+                'prefix': 'osd crush weight-set create-compat',
+                'format': 'json',
+            }), '')
+            r, outb, outs = result.wait()
+            if r != 0:
+                self.log.error('Error creating compat weight-set')
+                return
 
+            # our map predates the weight-set; get the new one from the mon
+            result = CommandResult('')
+            self.send_command(result, 'mon', '', json.dumps({
+                'prefix': 'osd crush dump',
+                'format': 'json',
+            }), '')
+            r, outb, outs = result.wait()
+            if r != 0:
+                self.log.error('Error dumping crush map')
+                return
+            try:
+                crushmap = json.loads(outb)
+            except:
+                raise RuntimeError('unable to parse crush map')
+            # creating the weight-set bumped the crush version, so don't
+            # cache this under the version of our map
+            version = None
+
+        buckets = {b['id']: b for b in crushmap['buckets']}
         raw = crushmap.get('choose_args',{}).get('-1', [])
         weight_set = {}
         for b in raw:
-            bucket = None
-            for t in crushmap['buckets']:
-                if t['id'] == b['bucket_id']:
-                    bucket = t
-                    break
+            bucket = buckets.get(b['bucket_id'])
             if not bucket:
                 raise RuntimeError('could not find bucket %s' % b['bucket_id'])
             self.log.debug('bucket items %s' % bucket['items'])
@@ -689,6 +1454,9 @@ class Module(MgrModule):
                 weight_set[bucket['items'][pos]['id']] = b['weight_set'][0][pos]
 
         self.log.debug('weight_set weights %s' % weight_set)
+        if version is not None:
+            self.weight_set_cache = (version, weight_set)
+            return dict(weight_set)
         return weight_set
 
     def get_util(self, cost_mode, pools, osds):
@@ -754,19 +1522,17 @@ class Module(MgrModule):
             r, outb, outs = result.wait()
             if r != 0:
                 self.log.error('Error creating compat weight-set')
-                return
+                return r, 'Error creating compat weight-set: %s' % outs
 
         for osd, weight in plan.compat_ws.iteritems():
             self.log.info('ceph osd crush weight-set reweight-compat osd.%d %f',
                           osd, weight)
-            result = CommandResult('foo')
-            self.send_command(result, 'mon', '', json.dumps({
+            commands.append({
                 'prefix': 'osd crush weight-set reweight-compat',
                 'format': 'json',
                 'item': 'osd.%d' % osd,
                 'weight': [weight],
-            }), 'foo')
-            commands.append(result)
+            })
 
         # new_weight
         reweightn = {}
@@ -774,46 +1540,82 @@ class Module(MgrModule):
             reweightn[int(osd)] = float(weight) / float(0x10000)
         if len(reweightn):
             self.log.info('ceph osd reweightn %s', reweightn)
-            result = CommandResult('foo')
-            self.send_command(result, 'mon', '', json.dumps({
+            commands.append({
                 'prefix': 'osd reweightn',
                 'format': 'json',
                 'weights': json.dumps(reweightn),
-            }), 'foo')
-            commands.append(result)
+            })
 
         # upmap
-        incdump = plan.inc.dump()
-        for pgid in incdump.get('old_pg_upmap_items', []):
+        rm_pgids, new_items = plan.upmap_changes()
+        for pgid in rm_pgids:
             self.log.info('ceph osd rm-pg-upmap-items %s', pgid)
-            result = CommandResult('foo')
-            self.send_command(result, 'mon', '', json.dumps({
+            commands.append({
                 'prefix': 'osd rm-pg-upmap-items',
                 'format': 'json',
                 'pgid': pgid,
-            }), 'foo')
-            commands.append(result)
+            })
 
-        for item in incdump.get('new_pg_upmap_items', []):
+        for item in new_items:
             self.log.info('ceph osd pg-upmap-items %s mappings %s', item['pgid'],
                           item['mappings'])
             osdlist = []
             for m in item['mappings']:
                 osdlist += [m['from'], m['to']]
-            result = CommandResult('foo')
-            self.send_command(result, 'mon', '', json.dumps({
+            commands.append({
                 'prefix': 'osd pg-upmap-items',
                 'format': 'json',
                 'pgid': item['pgid'],
                 'id': osdlist,
-            }), 'foo')
-            commands.append(result)
+            })
+
+        return self.send_commands(plan.name, commands)
+
+    def send_commands(self, name, commands):
+        """
+        Send all commands before waiting for any of them, and collect
+        every failure rather than stopping at the first.  The mon takes
+        each upmap and weight-set entry as a command of its own, so
+        there is nothing to merge.
+
+        Progress is kept in execute_progress for 'balancer status'.
+        """
+        t0 = time.time()
+        progress = {
+            'plan': name,
+            'total': len(commands),
+            'done': 0,
+            'failed': 0,
+            'started': time.strftime(TIME_FORMAT, time.gmtime(t0)),
+            'elapsed': 0.0,
+            'commands_per_sec': 0.0,
+        }
+        self.execute_progress = progress
+
+        results = []
+        for cmd in commands:
+            result = CommandResult('')
+            self.send_command(result, 'mon', '', json.dumps(cmd), '')
+            results.append((cmd, result))
 
         # wait for commands
-        self.log.debug('commands %s' % commands)
-        for result in commands:
+        errors = []
+        for cmd, result in results:
             r, outb, outs = result.wait()
+            progress['done'] += 1
             if r != 0:
-                self.log.error('Error on command')
-                return
+                self.log.error('Error on command %s: %d %s' % (cmd, r, outs))
+                errors.append((cmd, r, outs))
+                progress['failed'] += 1
+            progress['elapsed'] = time.time() - t0
+            if progress['elapsed'] > 0:
+                progress['commands_per_sec'] = \
+                    progress['done'] / progress['elapsed']
+        self.log.info('Sent %d commands in %.2fs (%d failed)' %
+                      (progress['done'], progress['elapsed'], len(errors)))
+        if errors:
+            cmd, r, outs = errors[0]
+            return r, '%d of %d commands failed, first: %s: %s' % (
+                len(errors), len(commands), cmd['prefix'], outs)
         self.log.debug('done')
+        return 0, ''
@@ -11,6 +11,10 @@ class CephFSClients(RemoteViewCache):
 
         self.fscid = fscid
 
+    @property
+    def name(self):
+        return "CephFSClients(%s)" % self.fscid
+
     def _get(self):
         mds_spec = "{0}:0".format(self.fscid)
         result = CommandResult("")
@@ -0,0 +1,173 @@
+
+from collections import deque
+from threading import Condition
+import json
+import os
+import time
+
+
+# How many versions' patches to keep: clients further behind than this
+# get the whole document again
+FEED_HISTORY = 32
+
+# Rebuild a feed's document at least this often, even if no notification
+# said it changed (e.g. for rates computed against the clock)
+FEED_MAX_AGE = 5
+
+# How long a client's request may wait for the next version
+FEED_MAX_WAIT = 30
+
+# How many requests may wait at once: each one holds a server thread,
+# so past this, requests return straight away, like a plain poll
+FEED_MAX_WAITERS = 20
+
+
+def _escape(key):
+    # RFC 6901 JSON pointer escaping
+    return unicode(key).replace(u'~', u'~0').replace(u'/', u'~1')
+
+
+def json_patch(old, new, path=u''):
+    """
+    The RFC 6902 operations turning `old` into `new`, using only add,
+    remove and replace.  Dicts are compared key by key and lists of the
+    same length item by item; anything else that differs is replaced
+    whole, as is a list whose patch would be longer than the list.
+    """
+    if type(old) != type(new):
+        return [{'op': 'replace', 'path': path, 'value': new}]
+
+    if isinstance(new, dict):
+        ops = []
+        for k in old:
+            if k not in new:
+                ops.append({'op': 'remove', 'path': path + u'/' + _escape(k)})
+        for k, v in new.items():
+            p = path + u'/' + _escape(k)
+            if k not in old:
+                ops.append({'op': 'add', 'path': p, 'value': v})
+            else:
+                ops.extend(json_patch(old[k], v, p))
+        return ops
+    elif isinstance(new, list):
+        if len(old) != len(new):
+            return [{'op': 'replace', 'path': path, 'value': new}]
+        ops = []
+        for i, (a, b) in enumerate(zip(old, new)):
+            ops.extend(json_patch(a, b, u'%s/%d' % (path, i)))
+            if len(ops) > len(new):
+                return [{'op': 'replace', 'path': path, 'value': new}]
+        return ops
+    elif old != new:
+        return [{'op': 'replace', 'path': path, 'value': new}]
+    return []
+
+
+class Feed(object):
+    """
+    A versioned JSON document, e.g. the data behind a page, for clients
+    that keep a copy of it up to date.
+
+    The document is rebuilt at most once per notification (see
+    `invalidate`) or every `max_age` seconds, however many clients there
+    are; each new version is stored as a JSON patch against the previous
+    one.  A client passes the feed id and the version it has, and waits
+    until there is a newer version, getting back only the patches it
+    missed.
+    """
+
+    def __init__(self, build, max_age=FEED_MAX_AGE, history=FEED_HISTORY):
+        self.build = build
+        self.max_age = max_age
+
+        # Changes when the mgr restarts, so that clients then start over
+        self.id = os.urandom(8).encode('hex')
+        self.version = 0
+        self.data = None
+        self.patches = deque(maxlen=history)
+
+        self.cond = Condition()
+        self.dirty = True
+        self.building = False
+        self.built_at = 0
+        self.waiters = 0
+
+    def invalidate(self):
+        with self.cond:
+            self.dirty = True
+            self.cond.notify_all()
+
+    def _update(self):
+        with self.cond:
+            if self.building or not (
+                    self.dirty or time.time() - self.built_at > self.max_age):
+                return
+            self.building = True
+            self.dirty = False
+
+        try:
+            # A round trip through JSON, so that we compare what clients
+            # see (e.g. tuples are lists and keys are strings), and so
+            # that nobody can change the data under us
+            data = json.loads(json.dumps(self.build()))
+        finally:
+            with self.cond:
+                self.building = False
+                self.built_at = time.time()
+
+        with self.cond:
+            if self.data is None:
+                self.version += 1
+                self.patches.clear()
+            else:
+                ops = json_patch(self.data, data)
+                if ops:
+                    self.version += 1
+                    self.patches.append((self.version, ops))
+            self.data = data
+            self.cond.notify_all()
+
+    def poll(self, feed_id=None, since=None, wait=FEED_MAX_WAIT):
+        """
+        :param feed_id: the feed id the client got its version from
+        :param since: the version the client has
+        :param wait: how long to wait for a newer version, in seconds
+        :return: dict with the feed 'id' and 'version', and either the
+                 whole document as 'data' or a list of JSON patch
+                 operations as 'patch'
+        """
+        deadline = time.time() + min(wait, FEED_MAX_WAIT)
+        current = feed_id == self.id and since is not None
+        waiting = False
+        try:
+            while True:
+                self._update()
+                with self.cond:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    if self.data is not None and (
+                            not current or since != self.version):
+                        break
+                    if not waiting:
+                        if self.waiters >= FEED_MAX_WAITERS:
+                            break
+                        self.waiters += 1
+                        waiting = True
+                    self.cond.wait(min(remaining, self.max_age))
+
+            with self.cond:
+                result = {'id': self.id, 'version': self.version}
+                if current and since == self.version:
+                    result['patch'] = []
+                elif current and since < self.version and self.patches \
+                        and self.patches[0][0] <= since + 1:
+                    result['patch'] = [op for v, ops in self.patches
+                                       if v > since for op in ops]
+                else:
+                    result['data'] = self.data
+                return result
+        finally:
+            if waiting:
+                with self.cond:
+                    self.waiters -= 1
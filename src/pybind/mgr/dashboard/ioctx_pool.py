@@ -0,0 +1,74 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+# How many pools to keep an ioctx open for
+DEFAULT_IOCTX_POOL_SIZE = 32
+
+
+class IoctxPool(object):
+    """
+    Open ioctxs for the pools we use, shared by the views of this module
+    rather than opened on every fetch.  Only the `max_size` most recently
+    used are kept; one dropped from the pool is closed once whoever is
+    still using it lets go of it.
+
+    Every `acquire` is paired with a `release`:
+
+        ioctx = ioctx_pool.acquire(pool_name)
+        try:
+            ...
+        finally:
+            ioctx_pool.release(ioctx)
+    """
+
+    def __init__(self, module_inst, max_size=DEFAULT_IOCTX_POOL_SIZE):
+        self._module = module_inst
+        self.log = module_inst.log
+        self.max_size = max_size
+        # Pool name to ioctx, least recently used first
+        self.ioctxs = OrderedDict()
+        # ioctx to how many are using it, for those in use
+        self.users = {}
+        self.lock = Lock()
+
+    def acquire(self, pool_name):
+        with self.lock:
+            ioctx = self.ioctxs.pop(pool_name, None)
+            if ioctx is None:
+                self.log.debug("Constructing IOCtx " + pool_name)
+                ioctx = self._module.rados.open_ioctx(pool_name)
+            self.ioctxs[pool_name] = ioctx
+            self.users[ioctx] = self.users.get(ioctx, 0) + 1
+            while len(self.ioctxs) > self.max_size:
+                self._drop(self.ioctxs.popitem(last=False)[1])
+            return ioctx
+
+    def release(self, ioctx):
+        with self.lock:
+            self.users[ioctx] -= 1
+            if self.users[ioctx]:
+                return
+            del self.users[ioctx]
+            if ioctx not in self.ioctxs.values():
+                # Dropped from the pool while in use
+                ioctx.close()
+
+    def discard(self, pool_name):
+        """
+        Forget the ioctx of a pool, e.g. because the pool was removed
+        """
+        with self.lock:
+            ioctx = self.ioctxs.pop(pool_name, None)
+            if ioctx is not None:
+                self._drop(ioctx)
+
+    def _drop(self, ioctx):
+        if ioctx not in self.users:
+            ioctx.close()
+
+    def close(self):
+        with self.lock:
+            for ioctx in self.ioctxs.values():
+                self._drop(ioctx)
+            self.ioctxs.clear()
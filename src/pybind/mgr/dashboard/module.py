@@ -34,8 +34,15 @@ from types import OsdMap, NotFound, Config, FsMap, MonMap, \
 import rados
 import rbd_iscsi
 import rbd_mirroring
-from rbd_ls import RbdLs, RbdPoolLs
+from rbd_ls import RbdLs, RbdPoolLs, image_workers
 from cephfs_clients import CephFSClients
+from ioctx_pool import IoctxPool
+from feed import Feed, FEED_MAX_WAITERS
+from osd_table import OsdTable
+from osd_histograms import OsdHistograms
+from timeseries import TimeSeriesStore, TIERS
+import remote_view_cache
+from remote_view_cache import RemoteViewLRU
 
 log = logging.getLogger("dashboard")
 
@@ -44,6 +51,21 @@ log = logging.getLogger("dashboard")
 # python module for the convenience of the GUI?
 LOG_BUFFER_SIZE = 30
 
+# The OSD map is rebuilt per epoch; OSD metadata changes without a new
+# epoch, so pick it up at least this often, in seconds
+OSD_METADATA_MAX_AGE = 30
+
+# Parts of the OsdMap data that come from data of their own
+OSD_MAP_PARTS = {
+    'tree': 'osd_map_tree',
+    'crush': 'osd_map_crush',
+    'crush_map_text': 'osdmap_crush_map_text',
+}
+
+# Paths into an OsdMap starting with one of these are walked from it;
+# the metadata of one OSD is fetched by itself
+OSD_MAP_ATTRS = frozenset(dir(OsdMap(None))) - frozenset(['osd_metadata'])
+
 # cherrypy likes to sys.exit on error.  don't let it take us down too!
 def os_exit_noop():
     pass
@@ -80,9 +102,12 @@ class Module(MgrModule):
         # Keep a librados instance for those that need it.
         self._rados = None
 
-        # Stateful instances of RbdLs, hold cached results.  Key to dict
-        # is pool name.
-        self.rbd_ls = {}
+        # Open ioctxs of the pools we look at, shared between views
+        self.ioctx_pool = IoctxPool(self)
+
+        # Stateful instances of RbdLs, hold cached results.  Key is pool
+        # name.
+        self.rbd_ls = RemoteViewLRU(lambda pool: RbdLs(self, pool))
 
         # Stateful instance of RbdPoolLs, hold cached list of RBD
         # pools
@@ -94,17 +119,37 @@ class Module(MgrModule):
         # Stateful instance of RbdMirroring, hold cached results.
         self.rbd_mirroring = rbd_mirroring.Controller(self)
 
-        # Stateful instances of CephFSClients, hold cached results.  Key to
-        # dict is FSCID
-        self.cephfs_clients = {}
+        # Stateful instances of CephFSClients, hold cached results.  Key is
+        # FSCID
+        self.cephfs_clients = RemoteViewLRU(
+            lambda fscid: CephFSClients(self, fscid))
 
-        # A short history of pool df stats
-        self.pool_stats = defaultdict(lambda: defaultdict(
-            lambda: collections.deque(maxlen=10)))
+        # History of pool df stats, downsampled for trends.  Retention
+        # of each tier in seconds is set by pool_stats_retention_<tier>
+        retention = {}
+        for name, _, _ in TIERS:
+            value = self.get_config('pool_stats_retention_' + name)
+            if value:
+                retention[name] = int(value)
+        self.pool_stats = TimeSeriesStore(retention)
 
         # A prefix for all URLs to use the dashboard with a reverse http proxy
         self.url_prefix = ''
 
+        # The OSD list, kept up to date in the background
+        self.osd_table = OsdTable(self)
+
+        # perf histogram dumps of the OSDs whose pages are open
+        self.osd_histograms = OsdHistograms(self)
+
+        # OsdMap of the current epoch, and when it was built
+        self._osd_map = (None, 0)
+        self._osd_map_lock = threading.Lock()
+
+        # Versioned feeds of page data, set up in serve()
+        self.health_feed = None
+        self.toplevel_feed = None
+
     @property
     def rados(self):
         """
@@ -122,12 +167,12 @@ class Module(MgrModule):
         return self._rados
 
     def update_pool_stats(self):
-        df = global_instance().get("df")
+        df = global_instance().get_cached("df")
         pool_stats = dict([(p['id'], p['stats']) for p in df['pools']])
         now = time.time()
         for pool_id, stats in pool_stats.items():
-            for stat_name, stat_val in stats.items():
-                self.pool_stats[pool_id][stat_name].appendleft((now, stat_val))
+            self.pool_stats.add(pool_id, now, stats)
+        self.pool_stats.retain(pool_stats.keys())
 
     def notify(self, notify_type, notify_val):
         if notify_type == "clog":
@@ -140,20 +185,83 @@ class Module(MgrModule):
                     self.log_buffer.appendleft(notify_val)
         elif notify_type == "pg_summary":
             self.update_pool_stats()
+            # Comes with each round of stats reports
+            self.osd_table.invalidate()
+        elif notify_type == "osd_map":
+            self.osd_table.invalidate()
         else:
             pass
 
-    def get_sync_object(self, object_type, path=None):
-        if object_type == OsdMap:
-            data = self.get("osd_map")
+        for feed in (self.health_feed, self.toplevel_feed):
+            if feed is not None:
+                feed.invalidate()
 
-            assert data is not None
+    def _get_osd_map(self):
+        """
+        The OsdMap for the current epoch, built from ``get_cached`` data
+        and shared (with its memoized CRUSH lookups) by every caller
+        until the epoch changes, so it must not be modified.  The OSD
+        metadata doesn't come with an epoch, so it is also rebuilt when
+        that is older than OSD_METADATA_MAX_AGE.
+        """
+        data = self.get_cached("osd_map")
+
+        assert data is not None
 
-            data['tree'] = self.get("osd_map_tree")
-            data['crush'] = self.get("osd_map_crush")
-            data['crush_map_text'] = self.get("osd_map_crush_map_text")
-            data['osd_metadata'] = self.get("osd_metadata")
-            obj = OsdMap(data)
+        now = time.time()
+        with self._osd_map_lock:
+            osd_map, built_at = self._osd_map
+            if osd_map is not None and \
+                    osd_map.data['epoch'] == data['epoch'] and \
+                    now - built_at < OSD_METADATA_MAX_AGE:
+                return osd_map
+
+        data = dict(data,
+                    tree=self.get_cached("osd_map_tree"),
+                    crush=self.get_cached("osd_map_crush"),
+                    crush_map_text=self.get_cached("osdmap_crush_map_text"),
+                    osd_metadata=self.get("osd_metadata"))
+        osd_map = OsdMap(data, self.get_crush_resolver())
+        with self._osd_map_lock:
+            self._osd_map = (osd_map, now)
+        return osd_map
+
+    def _get_osd_map_path(self, path):
+        """
+        The part of the OsdMap data at path, fetched on its own rather
+        than by building the whole OsdMap
+        """
+        part = path[0]
+        if part == 'osd_metadata':
+            if len(path) == 1:
+                return self.get("osd_metadata")
+            metadata = self.get_metadata("osd", str(path[1]))
+            if metadata is None:
+                raise KeyError(path[1])
+            return self._cache.walk(metadata, tuple(path[2:]))
+        elif part in OSD_MAP_PARTS:
+            return self.get_cached_path(OSD_MAP_PARTS[part], path[1:])
+        else:
+            return self.get_cached_path("osd_map", path)
+
+    def get_sync_object(self, object_type, path=None):
+        """
+        :param path: a part of the object to return instead of all of
+                     it.  For an OsdMap, paths into its data (e.g.
+                     ``['pools', 1]``, see ``get_cached_path``) are
+                     fetched and cached by themselves, without building
+                     the OsdMap; those starting with an attribute of
+                     OsdMap are walked from it.
+        """
+        if object_type == OsdMap and path and \
+                path[0] not in OSD_MAP_ATTRS:
+            try:
+                return self._get_osd_map_path(path)
+            except KeyError:
+                raise NotFound(object_type, path)
+
+        if object_type == OsdMap:
+            obj = self._get_osd_map()
         elif object_type == Config:
             data = self.get("config")
             obj = Config( data)
@@ -176,8 +284,6 @@ class Module(MgrModule):
         else:
             raise NotImplementedError(object_type)
 
-        # TODO: move 'path' handling up into C++ land so that we only
-        # Pythonize the part we're interested in
         if path:
             try:
                 for part in path:
@@ -195,7 +301,12 @@ class Module(MgrModule):
         cherrypy.engine.exit()
         log.info("Stopped server")
 
+        self.osd_table.stop()
+        image_workers.stop()
+        remote_view_cache.executor.stop(log)
+
         log.info("Stopping librados...")
+        self.ioctx_pool.close()
         if self._rados:
             self._rados.shutdown()
         log.info("Stopped librados.")
@@ -209,7 +320,10 @@ class Module(MgrModule):
 
     def get_rate(self, daemon_type, daemon_name, stat):
         data = self.get_counter(daemon_type, daemon_name, stat)[stat]
+        return self.rate(data)
 
+    @staticmethod
+    def rate(data):
         if data and len(data) > 1:
             return (data[-1][1] - data[-2][1]) / float(data[-1][0] - data[-2][0])
         else:
@@ -248,7 +362,7 @@ class Module(MgrModule):
     def fs_status(self, fs_id):
         mds_versions = defaultdict(list)
 
-        fsmap = self.get("fs_map")
+        fsmap = self.get_cached("fs_map")
         filesystem = None
         for fs in fsmap['filesystems']:
             if fs['id'] == fs_id:
@@ -349,9 +463,9 @@ class Module(MgrModule):
                 }
             )
 
-        df = self.get("df")
+        df = self.get_cached("df")
         pool_stats = dict([(p['id'], p['stats']) for p in df['pools']])
-        osdmap = self.get("osd_map")
+        osdmap = self.get_cached("osd_map")
         pools = dict([(p['pool'], p) for p in osdmap['pools']])
         metadata_pool_id = mdsmap['metadata_pool']
         data_pool_ids = mdsmap['data_pools']
@@ -499,11 +613,7 @@ class Module(MgrModule):
                 return global_instance().fs_status(int(fs_id))
 
             def _clients(self, fs_id):
-                cephfs_clients = global_instance().cephfs_clients.get(fs_id, None)
-                if cephfs_clients is None:
-                    cephfs_clients = CephFSClients(global_instance(), fs_id)
-                    global_instance().cephfs_clients[fs_id] = cephfs_clients
-
+                cephfs_clients = global_instance().cephfs_clients[fs_id]
                 status, clients = cephfs_clients.get()
                 #TODO do something sensible with status
 
@@ -567,25 +677,20 @@ class Module(MgrModule):
             def clients_data(self, fs_id):
                 return self._clients(int(fs_id))
 
-            def _rbd_pool(self, pool_name):
-                rbd_ls = global_instance().rbd_ls.get(pool_name, None)
-                if rbd_ls is None:
-                    rbd_ls = RbdLs(global_instance(), pool_name)
-                    global_instance().rbd_ls[pool_name] = rbd_ls
-
-                status, value = rbd_ls.get()
+            def _rbd_pool(self, pool_name, page=0, page_size=0,
+                          sort_key='name', reverse=False):
+                rbd_ls = global_instance().rbd_ls[pool_name]
+                try:
+                    result = rbd_ls.get_page(page, page_size, sort_key,
+                                             reverse)
+                except ValueError as e:
+                    raise cherrypy.HTTPError(400, str(e))
 
+                # Have fresh data ready for the page's next poll
                 interval = 5
+                rbd_ls.refresh(max(interval - rbd_ls.latency, 0))
 
-                wait = interval - rbd_ls.latency
-                def wait_and_load():
-                    time.sleep(wait)
-                    rbd_ls.get()
-
-                threading.Thread(target=wait_and_load).start()
-
-                assert status != RbdLs.VALUE_NONE  # FIXME bubble status up to UI
-                return value
+                return result
 
             @cherrypy.expose
             def rbd_pool(self, pool_name):
@@ -593,7 +698,7 @@ class Module(MgrModule):
 
                 toplevel_data = self._toplevel_data()
 
-                images = self._rbd_pool(pool_name)
+                images = self._rbd_pool(pool_name)['images']
                 content_data = {
                     "images": images,
                     "pool_name": pool_name
@@ -609,8 +714,17 @@ class Module(MgrModule):
 
             @cherrypy.expose
             @cherrypy.tools.json_out()
-            def rbd_pool_data(self, pool_name):
-                return self._rbd_pool(pool_name)
+            def rbd_pool_data(self, pool_name, page=None, page_size=100,
+                              sort='name', reverse='0'):
+                """
+                Without `page`, all the images loaded so far.  With it, a
+                page of them along with how far the listing got, see
+                RbdLs.get_page.
+                """
+                if page is None:
+                    return self._rbd_pool(pool_name)['images']
+                return self._rbd_pool(pool_name, int(page), int(page_size),
+                                      sort, reverse not in ('0', 'false'))
 
             def _rbd_mirroring(self):
                 status, data = global_instance().rbd_mirroring.content_data.get()
@@ -708,28 +822,17 @@ class Module(MgrModule):
                 if len(global_instance().pool_stats) == 0:
                     global_instance().update_pool_stats()
 
+                # The OSD map is shared, so decorate copies of its pools
                 for pool in osd_map['pools']:
-                    pool['pg_status'] = pg_summary['by_pool'][pool['pool'].__str__()]
-                    stats = global_instance().pool_stats[pool['pool']]
-                    s = {}
-
-                    def get_rate(series):
-                        if len(series) >= 2:
-                            return (float(series[0][1]) - float(series[1][1])) / (float(series[0][0]) - float(series[1][0]))
-                        else:
-                            return 0
-
-                    for stat_name, stat_series in stats.items():
-                        s[stat_name] = {
-                            'latest': stat_series[0][1],
-                            'rate': get_rate(stat_series),
-                            'series': [i for i in stat_series]
-                        }
-                    pool['stats'] = s
-                    pools.append(pool)
+                    pools.append(dict(
+                        pool,
+                        pg_status=pg_summary['by_pool'][pool['pool'].__str__()],
+                        stats=global_instance().pool_stats.latest(
+                            pool['pool'])))
 
                 # Not needed, skip the effort of transmitting this
                 # to UI
+                osd_map = dict(osd_map, pools=pools)
                 del osd_map['pg_temp']
 
                 df = global_instance().get("df")
@@ -754,6 +857,32 @@ class Module(MgrModule):
             def health_data(self):
                 return self._health()
 
+            @cherrypy.expose
+            @cherrypy.tools.json_out()
+            def pool_stats_data(self, pool_id, stat, tier='10s'):
+                """
+                The history of one stat of a pool at one resolution, with
+                rates and rate percentiles: see TimeSeriesStore.get
+                """
+                try:
+                    series = global_instance().pool_stats.get(
+                        int(pool_id), stat, tier)
+                except ValueError as e:
+                    raise cherrypy.HTTPError(400, str(e))
+                if series is None:
+                    raise cherrypy.HTTPError(404,
+                        "No {0} stats for pool {1}".format(stat, pool_id))
+                return series
+
+            @cherrypy.expose
+            @cherrypy.tools.json_out()
+            def health_feed(self, id=None, since=None, wait=0):
+                """
+                health_data as a feed: see Feed.poll
+                """
+                return global_instance().health_feed.poll(
+                    id, None if since is None else int(since), float(wait))
+
             @cherrypy.expose
             def index(self):
                 return self.health()
@@ -763,10 +892,19 @@ class Module(MgrModule):
             def toplevel_data(self):
                 return self._toplevel_data()
 
+            @cherrypy.expose
+            @cherrypy.tools.json_out()
+            def toplevel_feed(self, id=None, since=None, wait=0):
+                """
+                toplevel_data as a feed: see Feed.poll
+                """
+                return global_instance().toplevel_feed.poll(
+                    id, None if since is None else int(since), float(wait))
+
             def _get_mds_names(self, filesystem_id=None):
                 names = []
 
-                fsmap = global_instance().get("fs_map")
+                fsmap = global_instance().get_cached("fs_map")
                 for fs in fsmap['filesystems']:
                     if filesystem_id is not None and fs['id'] != filesystem_id:
                         continue
@@ -814,6 +952,11 @@ class Module(MgrModule):
 
                 return dict(result)
 
+            @cherrypy.expose
+            @cherrypy.tools.json_out()
+            def view_cache_stats(self):
+                return remote_view_cache.get_stats()
+
             @cherrypy.expose
             @cherrypy.tools.json_out()
             def get_counter(self, type, id, path):
@@ -854,6 +997,8 @@ class Module(MgrModule):
         cherrypy.config.update({
             'server.socket_host': server_addr,
             'server.socket_port': int(server_port),
+            # Leave threads for other requests while feed requests wait
+            'server.thread_pool': FEED_MAX_WAITERS + 10,
             'engine.autoreload.on': False
         })
 
@@ -888,20 +1033,15 @@ class Module(MgrModule):
                 osd_metadata = global_instance().get_metadata(
                         "osd", osd_spec)
 
-                result = CommandResult("")
-                global_instance().send_command(result, "osd", osd_spec,
-                       json.dumps({
-                           "prefix": "perf histogram dump",
-                           }),
-                       "")
-                r, outb, outs = result.wait()
-                assert r == 0
-                histogram = json.loads(outb)
+                histogram = global_instance().osd_histograms.get(
+                    [osd_id])[osd_id]
 
                 return {
                     "osd": osd,
                     "osd_metadata": osd_metadata,
-                    "osd_histogram": histogram
+                    "osd_histogram": histogram['histogram'] or {"osd": {}},
+                    "osd_histogram_age": histogram['age'],
+                    "osd_histogram_stale": histogram['stale']
                 }
 
             @cherrypy.expose
@@ -925,70 +1065,23 @@ class Module(MgrModule):
             @cherrypy.expose
             @cherrypy.tools.json_out()
             def list_data(self):
-                return self._osds_by_server()
+                return global_instance().osd_table.by_server()
 
-            def _osd_summary(self, osd_id, osd_info):
+            @cherrypy.expose
+            @cherrypy.tools.json_out()
+            def table_data(self, sort='id', reverse='0', filter=None,
+                           state=None, page=0, page_size=0, history='0'):
                 """
-                The info used for displaying an OSD in a table
+                A sorted, filtered page of the OSD table: see
+                OsdTable.query
                 """
-
-                osd_spec = "{0}".format(osd_id)
-
-                result = {}
-                result['id'] = osd_id
-                result['stats'] = {}
-                result['stats_history'] = {}
-
-                # Counter stats
-                for s in ['osd.op_w', 'osd.op_in_bytes', 'osd.op_r', 'osd.op_out_bytes']:
-                    result['stats'][s.split(".")[1]] = global_instance().get_rate('osd', osd_spec, s)
-                    result['stats_history'][s.split(".")[1]] = \
-                        global_instance().get_counter('osd', osd_spec, s)[s]
-
-                # Gauge stats
-                for s in ["osd.numpg", "osd.stat_bytes", "osd.stat_bytes_used"]:
-                    result['stats'][s.split(".")[1]] = global_instance().get_latest('osd', osd_spec, s)
-
-                result['up'] = osd_info['up']
-                result['in'] = osd_info['in']
-
-                result['url'] = get_prefixed_url("/osd/perf/{0}".format(osd_id))
-
-                return result
-
-            def _osds_by_server(self):
-                result = defaultdict(list)
-                servers = global_instance().list_servers()
-
-                osd_map = global_instance().get_sync_object(OsdMap)
-
-                for server in servers:
-                    hostname = server['hostname']
-                    services = server['services']
-                    first = True
-                    for s in services:
-                        if s["type"] == "osd":
-                            osd_id = int(s["id"])
-                            # If metadata doesn't tally with osdmap, drop it.
-                            if osd_id not in osd_map.osds_by_id:
-                                global_instance().log.warn(
-                                    "OSD service {0} missing in OSDMap, stale metadata?".format(osd_id))
-                                continue
-                            summary = self._osd_summary(osd_id,
-                                                        osd_map.osds_by_id[osd_id])
-
-                            if first:
-                                # A little helper for rendering
-                                summary['first'] = True
-                                first = False
-                            result[hostname].append(summary)
-
-                global_instance().log.warn("result.size {0} servers.size {1}".format(
-                    len(result), len(servers)
-                ))
-
-                # Return list form for convenience of rendering
-                return result.items()
+                try:
+                    return global_instance().osd_table.query(
+                        sort, reverse not in ('0', 'false'), filter, state,
+                        int(page), int(page_size),
+                        history not in ('0', 'false'))
+                except ValueError as e:
+                    raise cherrypy.HTTPError(400, str(e))
 
             @cherrypy.expose
             def index(self):
@@ -1001,7 +1094,7 @@ class Module(MgrModule):
                 toplevel_data = self._toplevel_data()
 
                 content_data = {
-                    "osds_by_server": self._osds_by_server()
+                    "osds_by_server": global_instance().osd_table.by_server()
                 }
 
                 return template.render(
@@ -1012,9 +1105,15 @@ class Module(MgrModule):
                     content_data=json.dumps(content_data, indent=2)
                 )
 
-        cherrypy.tree.mount(Root(), get_prefixed_url("/"), conf)
+        root = Root()
+        self.health_feed = Feed(root._health)
+        self.toplevel_feed = Feed(root._toplevel_data)
+
+        cherrypy.tree.mount(root, get_prefixed_url("/"), conf)
         cherrypy.tree.mount(OSDEndpoint(), get_prefixed_url("/osd"), conf)
 
+        self.osd_table.start()
+
         log.info("Starting engine...")
         cherrypy.engine.start()
         log.info("Waiting for engine...")
@@ -0,0 +1,143 @@
+
+from threading import Lock
+import json
+import time
+
+from mgr_module import CommandResult
+
+
+# Histograms this recent are served without asking the OSD again
+HISTOGRAM_MAX_AGE = 1.0
+
+# How long to wait for an OSD to answer when we have nothing to serve;
+# also how long a request is outstanding before we give up on it and
+# ask again
+HISTOGRAM_TIMEOUT = 5
+
+# How long to wait for an answer when we could serve older data instead
+HISTOGRAM_STALE_WAIT = 0.5
+
+
+class HistogramResult(CommandResult):
+    """
+    A 'perf histogram dump' in flight: hands the answer to the fetcher
+    as soon as it arrives, rather than anyone having to wait for it.
+    """
+    def __init__(self, fetcher, osd_id):
+        super(HistogramResult, self).__init__("")
+        self.fetcher = fetcher
+        self.osd_id = osd_id
+        self.sent_at = time.time()
+
+    def complete(self, r, outb, outs):
+        self.r = r
+        self.outb = outb
+        self.outs = outs
+        # Only wake the waiters once the fetcher has the answer
+        try:
+            self.fetcher._completed(self)
+        finally:
+            self.ev.set()
+
+
+class OsdHistograms(object):
+    """
+    The perf histograms of OSDs, as dumped by the OSDs themselves.
+
+    At most one request per OSD is in flight at a time, shared by
+    everyone asking for that OSD, and nobody waits for one longer than
+    HISTOGRAM_TIMEOUT: a hung OSD only leaves its histograms stale.
+    Requests for several OSDs are sent together and waited for together.
+    """
+
+    def __init__(self, module_inst):
+        self._module = module_inst
+        self.log = module_inst.log
+        self.lock = Lock()
+        # OSD id to dict of 'histogram', 'when' it arrived, 'pending'
+        # request and last 'error'
+        self.entries = {}
+
+    def _completed(self, result):
+        if result.r == 0:
+            try:
+                histogram = json.loads(result.outb)
+                error = None
+            except ValueError:
+                histogram = None
+                error = "bad histogram data"
+        else:
+            histogram = None
+            error = result.outs or "error {0}".format(result.r)
+
+        with self.lock:
+            entry = self.entries.get(result.osd_id)
+            if entry is None or entry['pending'] is not result:
+                # Given up on; a newer request is in flight
+                return
+            entry['pending'] = None
+            entry['error'] = error
+            if histogram is not None:
+                entry['histogram'] = histogram
+                entry['when'] = time.time()
+
+        if error:
+            self.log.warning("perf histogram dump on osd.{0}: {1}".format(
+                result.osd_id, error))
+
+    def _send(self, osd_ids):
+        now = time.time()
+        sends = []
+        pending = []
+        with self.lock:
+            for osd_id in osd_ids:
+                entry = self.entries.setdefault(osd_id, {
+                    'histogram': None, 'when': None, 'pending': None,
+                    'error': None})
+                if entry['when'] and now - entry['when'] < HISTOGRAM_MAX_AGE:
+                    continue
+                result = entry['pending']
+                if result is None or \
+                        now - result.sent_at > HISTOGRAM_TIMEOUT:
+                    result = HistogramResult(self, osd_id)
+                    entry['pending'] = result
+                    sends.append(result)
+                pending.append((entry, result))
+
+        for result in sends:
+            self._module.send_command(result, "osd", str(result.osd_id),
+                                      json.dumps({
+                                          "prefix": "perf histogram dump",
+                                      }),
+                                      "")
+        return pending
+
+    def get(self, osd_ids):
+        """
+        :return: dict of OSD id to dict of 'histogram' (None if we have
+                 none), its 'age' in seconds, and whether it is 'stale'
+                 (a newer one was asked for but didn't arrive in time)
+        """
+        pending = self._send(osd_ids)
+
+        deadline = time.time() + HISTOGRAM_TIMEOUT
+        stale_deadline = time.time() + HISTOGRAM_STALE_WAIT
+        for entry, result in pending:
+            if entry['histogram'] is None:
+                wait = deadline - time.time()
+            else:
+                wait = stale_deadline - time.time()
+            result.ev.wait(max(wait, 0))
+
+        now = time.time()
+        with self.lock:
+            results = {}
+            for osd_id in osd_ids:
+                entry = self.entries[osd_id]
+                results[osd_id] = {
+                    'histogram': entry['histogram'],
+                    'age': now - entry['when'] if entry['when'] else None,
+                    'stale': entry['pending'] is not None or
+                    entry['error'] is not None,
+                }
+            return results
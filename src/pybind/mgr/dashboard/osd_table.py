@@ -0,0 +1,275 @@
+
+from array import array
+from threading import Thread, Event, Lock
+import time
+
+
+# perf counters shown in the OSD table
+OSD_RATE_COUNTERS = ['osd.op_w', 'osd.op_in_bytes', 'osd.op_r',
+                     'osd.op_out_bytes']
+OSD_GAUGE_COUNTERS = ["osd.numpg", "osd.stat_bytes", "osd.stat_bytes_used"]
+
+# Datapoints kept per rate counter, as many as the mgr keeps per counter
+HISTORY = 20
+
+# Rebuild the table at least this often, in seconds, even without a
+# notification
+REFRESH_INTERVAL = 5
+
+# Look up which host each OSD is on at least this often, in seconds (and
+# otherwise only when the OSD map changes)
+HOSTS_MAX_AGE = 60
+
+SORT_KEYS = ['id', 'host', 'up', 'in'] + \
+    [s.split(".")[1] for s in OSD_RATE_COUNTERS + OSD_GAUGE_COUNTERS]
+
+
+class RingBuffer(object):
+    """
+    The last `capacity` datapoints of a counter, in two arrays of doubles
+    """
+    __slots__ = ('times', 'values', 'start', 'size')
+
+    def __init__(self, capacity=HISTORY):
+        self.times = array('d', [0.0]) * capacity
+        self.values = array('d', [0.0]) * capacity
+        self.start = 0
+        self.size = 0
+
+    def append(self, t, v):
+        capacity = len(self.times)
+        if self.size:
+            last = (self.start + self.size - 1) % capacity
+            if t <= self.times[last]:
+                # Already have it
+                return
+        if self.size < capacity:
+            i = (self.start + self.size) % capacity
+            self.size += 1
+        else:
+            i = self.start
+            self.start = (self.start + 1) % capacity
+        self.times[i] = t
+        self.values[i] = v
+
+    def items(self):
+        capacity = len(self.times)
+        return [[self.times[(self.start + n) % capacity],
+                 self.values[(self.start + n) % capacity]]
+                for n in range(self.size)]
+
+    def rate(self):
+        if self.size < 2:
+            return 0
+        capacity = len(self.times)
+        a = (self.start + self.size - 2) % capacity
+        b = (self.start + self.size - 1) % capacity
+        return (self.values[b] - self.values[a]) / \
+            (self.times[b] - self.times[a])
+
+
+class OsdTable(object):
+    """
+    The rows of the OSD list: state from the OSD map, host from the
+    daemon metadata, and the rates and gauges of OSD_RATE_COUNTERS and
+    OSD_GAUGE_COUNTERS.  Kept up to date by a thread of its own, woken
+    by the notifications that come with new stats and OSD maps, so that
+    requests only read the table.
+    """
+
+    def __init__(self, module_inst, interval=REFRESH_INTERVAL,
+                 history=HISTORY):
+        self._module = module_inst
+        self.log = module_inst.log
+        self.interval = interval
+        self.history = history
+
+        self.lock = Lock()
+        # Rows sorted by host, then id
+        self.rows = []
+        # OSD id to {counter name: RingBuffer}
+        self.buffers = {}
+        self.refreshed_at = None
+
+        self.refresh_lock = Lock()
+        self.hosts = {}
+        self.hosts_at = 0
+        self.hosts_epoch = None
+
+        self.event = Event()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        self.running = True
+        self.thread = Thread(target=self.run, name="osd-table")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.event.set()
+        if self.thread:
+            self.thread.join()
+
+    def invalidate(self):
+        self.event.set()
+
+    def run(self):
+        while self.running:
+            try:
+                self.refresh()
+            except:
+                self.log.exception("Failed to refresh OSD table")
+            self.event.wait(self.interval)
+            self.event.clear()
+
+    def _osd_hosts(self):
+        hosts = {}
+        for server in self._module.list_servers():
+            for s in server['services']:
+                if s['type'] == 'osd':
+                    hosts[int(s['id'])] = server['hostname']
+        return hosts
+
+    def refresh(self):
+        with self.refresh_lock:
+            osd_map = self._module.get_cached("osd_map")
+            now = time.time()
+            if osd_map['epoch'] != self.hosts_epoch or \
+                    now - self.hosts_at > HOSTS_MAX_AGE:
+                self.hosts = self._osd_hosts()
+                self.hosts_at = now
+                self.hosts_epoch = osd_map['epoch']
+
+            # The whole history the first time, then what is new
+            counters = self._module.get_all_perf_counters(
+                'osd', OSD_RATE_COUNTERS + OSD_GAUGE_COUNTERS,
+                latest_only=bool(self.buffers))
+
+            with self.lock:
+                previous = dict((row['id'], row) for row in self.rows)
+                buffers = {}
+                rows = []
+                for osd in osd_map['osds']:
+                    osd_id = osd['osd']
+                    host = self.hosts.get(osd_id)
+                    if host is None:
+                        # No metadata for it (yet)
+                        continue
+
+                    osd_counters = counters.get("osd.{0}".format(osd_id), {})
+                    osd_buffers = self.buffers.get(osd_id)
+                    if osd_buffers is None:
+                        osd_buffers = dict(
+                            (s.split(".")[1], RingBuffer(self.history))
+                            for s in OSD_RATE_COUNTERS)
+                    buffers[osd_id] = osd_buffers
+
+                    stats = {}
+                    for s in OSD_RATE_COUNTERS:
+                        name = s.split(".")[1]
+                        buf = osd_buffers[name]
+                        for t, v in osd_counters.get(s, []):
+                            buf.append(t, v)
+                        stats[name] = buf.rate()
+                    old = previous.get(osd_id)
+                    for s in OSD_GAUGE_COUNTERS:
+                        name = s.split(".")[1]
+                        data = osd_counters.get(s)
+                        if data:
+                            stats[name] = data[-1][1]
+                        else:
+                            stats[name] = old['stats'][name] if old else 0
+
+                    rows.append({
+                        'id': osd_id,
+                        'host': host,
+                        'up': osd['up'],
+                        'in': osd['in'],
+                        'url': "{0}/osd/perf/{1}".format(
+                            self._module.url_prefix, osd_id),
+                        'stats': stats,
+                    })
+
+                rows.sort(key=lambda r: (r['host'], r['id']))
+                self.rows = rows
+                self.buffers = buffers
+                self.refreshed_at = time.time()
+
+    def _get_rows(self):
+        if self.refreshed_at is None:
+            # Not waiting for the thread, so the first page load works
+            self.refresh()
+        return self.rows
+
+    def _history(self, osd_id):
+        return dict((name, buf.items())
+                    for name, buf in self.buffers.get(osd_id, {}).items())
+
+    def by_server(self):
+        """
+        The table grouped by host, with counter histories: a list of
+        (hostname, rows), with 'first' set on the first row of each host
+        """
+        self._get_rows()
+        result = []
+        with self.lock:
+            for row in self.rows:
+                row = dict(row, stats_history=self._history(row['id']))
+                if not result or result[-1][0] != row['host']:
+                    # A little helper for rendering
+                    row['first'] = True
+                    result.append((row['host'], []))
+                result[-1][1].append(row)
+        return result
+
+    def query(self, sort='id', reverse=False, filter=None, state=None,
+              page=0, page_size=0, history=False):
+        """
+        A slice of the table
+
+        :param sort: one of SORT_KEYS
+        :param filter: only OSDs whose id or host contains this
+        :param state: only OSDs that are 'up', 'down', 'in' or 'out'
+        :param page_size: rows per page, or 0 for all of them
+        :param history: include counter histories in the rows
+        :return: dict with the page's 'osds', the 'total' number of OSDs
+                 and how many 'matched'
+        """
+        if sort not in SORT_KEYS:
+            raise ValueError("Invalid sort key '{0}'".format(sort))
+        if state not in (None, 'up', 'down', 'in', 'out'):
+            raise ValueError("Invalid state '{0}'".format(state))
+
+        rows = self._get_rows()
+        matched = rows
+        if filter:
+            filter = filter.lower()
+            matched = [r for r in matched if filter in str(r['id']) or
+                       filter in r['host'].lower()]
+        if state:
+            field = 'up' if state in ('up', 'down') else 'in'
+            want = state in ('up', 'in')
+            matched = [r for r in matched if bool(r[field]) == want]
+
+        if sort in ('id', 'host', 'up', 'in'):
+            key = lambda r: r[sort]
+        else:
+            key = lambda r: r['stats'][sort]
+        matched = sorted(matched, key=key, reverse=reverse)
+
+        if page_size:
+            osds = matched[page * page_size:(page + 1) * page_size]
+        else:
+            osds = matched
+        if history:
+            with self.lock:
+                osds = [dict(r, stats_history=self._history(r['id']))
+                        for r in osds]
+
+        return {
+            'osds': osds,
+            'total': len(rows),
+            'matched': len(matched),
+        }
@@ -1,53 +1,318 @@
 
+import Queue
 import rbd
 import rados
-from types import OsdMap
+import time
+from threading import Thread, Lock, Condition
 from remote_view_cache import RemoteViewCache
 
+# Threads opening images for all RbdLs instances
+IMAGE_WORKERS = 8
+
+# Image header objects, see librbd/Utils.h
+RBD_HEADER_PREFIX = "rbd_header."
+RBD_SUFFIX = ".rbd"
+RBD_DIRECTORY = "rbd_directory"
+
+# How many rbd_directory entries to read per op
+OMAP_BATCH = 1024
+
+# Fields RbdLs.get_page can sort on
+SORT_KEYS = ['name', 'size', 'num_objs', 'obj_size', 'features_name',
+             'parent']
+
+
 class RbdPoolLs(RemoteViewCache):
-    def _get(self):
-        from mgr_module import ceph_state
-        ctx_capsule = ceph_state.get_context()
+    """
+    The names of the pools holding RBD images.  Which pools those are is
+    kept by pool id and only worked out again for pools that are new, or
+    whose application metadata changed, when the OSD map epoch changes.
 
-        osd_map = self._module.get_sync_object(OsdMap).data
-        osd_pools = [pool['pool_name'] for pool in osd_map['pools']]
+    A pool tagged with applications is an RBD pool if 'rbd' is one of
+    them.  Untagged pools (e.g. created before luminous) are probed for
+    an rbd_directory object instead.
+    """
 
+    def __init__(self, module_inst):
+        super(RbdPoolLs, self).__init__(module_inst)
+
+        self.epoch = None
+        # Pool id to (pool name, application names, is RBD)
+        self.pools = {}
+        self.rbd_pools = []
+
+    def _get(self):
+        osd_map = self._module.get_cached("osd_map")
+        if osd_map['epoch'] == self.epoch:
+            return self.rbd_pools
+
+        pools = {}
         rbd_pools = []
-        for pool in osd_pools:
-            self.log.debug("Constructing IOCtx " + pool)
-            try:
-                ioctx = self._module.rados.open_ioctx(pool)
-                ioctx.stat("rbd_directory")
-                rbd_pools.append(pool)
-            except (rados.PermissionError, rados.ObjectNotFound):
-                self.log.debug("No RBD directory in " + pool)
-            except:
-                self.log.exception("Failed to open pool " + pool)
+        conclusive = True
+        for pool in osd_map['pools']:
+            pool_name = pool['pool_name']
+            apps = sorted(pool.get('application_metadata', {}).keys())
+            cached = self.pools.get(pool['pool'])
+            if cached is not None and cached[1] == apps:
+                is_rbd = cached[2]
+            else:
+                is_rbd = self._is_rbd(pool_name, apps)
+                if is_rbd is None:
+                    # Don't remember a failed probe
+                    conclusive = False
+                    continue
+            pools[pool['pool']] = (pool_name, apps, is_rbd)
+            if is_rbd:
+                rbd_pools.append(pool_name)
+
+        for pool_id, (pool_name, _, _) in self.pools.items():
+            if pool_id not in pools:
+                self._module.ioctx_pool.discard(pool_name)
+                image_workers.discard(pool_name)
 
+        self.pools = pools
+        self.rbd_pools = rbd_pools
+        if conclusive:
+            self.epoch = osd_map['epoch']
         return rbd_pools
 
+    def _is_rbd(self, pool_name, apps):
+        if apps:
+            return 'rbd' in apps
+
+        try:
+            ioctx = self._module.ioctx_pool.acquire(pool_name)
+        except:
+            self.log.exception("Failed to open pool " + pool_name)
+            return None
+        try:
+            ioctx.stat(RBD_DIRECTORY)
+            return True
+        except (rados.PermissionError, rados.ObjectNotFound):
+            self.log.debug("No RBD directory in " + pool_name)
+            return False
+        except:
+            self.log.exception("Failed to probe pool " + pool_name)
+            return None
+        finally:
+            self._module.ioctx_pool.release(ioctx)
+
+
+class ImageWorkers(object):
+    """
+    A fixed pool of threads loading image details for RbdLs.  Each thread
+    has its own ioctx per pool: rados reports the version of the last
+    object read on an ioctx, which we use to tell whether an image header
+    changed, so the ioctx can't be shared.
+    """
+
+    class Worker(object):
+        def __init__(self):
+            # Pool name to this worker's ioctx
+            self.ioctxs = {}
+            # Whether it is loading an image, and so using its ioctxs
+            self.busy = False
+            # Pools whose ioctx to close once it is done
+            self.discarded = set()
+
+        def close(self, pool_names):
+            for pool_name in pool_names:
+                ioctx = self.ioctxs.pop(pool_name, None)
+                if ioctx is not None:
+                    ioctx.close()
+
+    def __init__(self, size=IMAGE_WORKERS):
+        self.size = size
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.workers = []
+        self.running = False
+        self.lock = Lock()
+        # Guards the workers' ioctxs; not self.lock, which stop() holds
+        # while the workers drain the queue
+        self.ioctx_lock = Lock()
+
+    def submit(self, rbd_ls, name, header_oid):
+        with self.lock:
+            if not self.threads:
+                self.running = True
+                for i in range(self.size):
+                    worker = self.Worker()
+                    t = Thread(target=self._worker, args=(worker,),
+                               name="rbd-image-%d" % i)
+                    t.daemon = True
+                    t.start()
+                    self.threads.append(t)
+                    self.workers.append(worker)
+        self.queue.put((rbd_ls, name, header_oid))
+
+    def stop(self):
+        with self.lock:
+            # Workers drain what is queued without loading it
+            self.running = False
+            for t in self.threads:
+                self.queue.put(None)
+            for t in self.threads:
+                t.join()
+            self.threads = []
+            self.workers = []
+
+    def discard(self, pool_name):
+        """
+        Close the workers' ioctxs of a pool, e.g. because the pool was
+        removed: right away for idle workers, otherwise once they are
+        done with the image they are loading.
+        """
+        with self.ioctx_lock:
+            for worker in self.workers:
+                if worker.busy:
+                    worker.discarded.add(pool_name)
+                else:
+                    worker.close([pool_name])
+
+    def _worker(self, worker):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            rbd_ls, name, header_oid = item
+            with self.ioctx_lock:
+                worker.busy = True
+            if self.running:
+                rbd_ls._load(worker.ioctxs, name, header_oid)
+            else:
+                rbd_ls._loaded()
+            with self.ioctx_lock:
+                worker.busy = False
+                worker.close(worker.discarded)
+                worker.discarded.clear()
+        with self.ioctx_lock:
+            worker.close(worker.ioctxs.keys())
+
+
+image_workers = ImageWorkers()
+
+
 class RbdLs(RemoteViewCache):
+    """
+    The images of a pool.  Image details are loaded in parallel by
+    `image_workers` and kept between fetches, keyed by image name along
+    with the version of the image's header object: an image is only
+    opened again when its header changed.
+    """
+
     def __init__(self, module_inst, pool):
         super(RbdLs, self).__init__(module_inst)
 
         self.pool = pool
 
-        self.ioctx = None
         self.rbd = None
 
-    def _init(self):
-        self.log.debug("Constructing IOCtx")
-        self.ioctx = self._module.rados.open_ioctx(self.pool)
+        # Guards the fields below, and is notified as images are loaded
+        self.cond = Condition()
+        # Image names of the current fetch, sorted
+        self.names = None
+        # Image name to (header version, details)
+        self.images = {}
+        self.remaining = 0
+
+    @property
+    def name(self):
+        return "RbdLs(%s)" % self.pool
 
+    def _init(self):
         self.log.debug("Constructing RBD")
         self.rbd = rbd.RBD()
 
     def _get(self):
-        self.log.debug("rbd.list")
-        names = self.rbd.list(self.ioctx)
-        result = []
+        # From the pool on every fetch rather than kept, so that it is
+        # closed once the pool is gone
+        ioctx = self._module.ioctx_pool.acquire(self.pool)
+        try:
+            self.log.debug("rbd.list")
+            names = sorted(self.rbd.list(ioctx))
+            header_oids = self._header_oids(ioctx, names)
+        finally:
+            self._module.ioctx_pool.release(ioctx)
+
+        with self.cond:
+            self.names = names
+            self.remaining = len(names)
+            present = set(names)
+            for name in self.images.keys():
+                if name not in present:
+                    del self.images[name]
+
+        # In name order, so that the first pages are ready first
         for name in names:
-            i = rbd.Image(self.ioctx, name)
+            image_workers.submit(self, name, header_oids[name])
+
+        with self.cond:
+            while self.remaining:
+                self.cond.wait()
+            return [self.images[name][1] for name in names
+                    if name in self.images]
+
+    def _header_oids(self, ioctx, names):
+        # Format 2 images are listed in the rbd_directory omap as
+        # name_<name> -> <id>, their header is rbd_header.<id>
+        ids = {}
+        start_after = ""
+        try:
+            while True:
+                with rados.ReadOpCtx() as op:
+                    it, ret = ioctx.get_omap_vals(op, start_after,
+                                                  "name_", OMAP_BATCH)
+                    ioctx.operate_read_op(op, RBD_DIRECTORY)
+                    batch = list(it)
+                for key, value in batch:
+                    # value is an encoded string: le32 length, then data
+                    ids[key[len("name_"):]] = value[4:]
+                if len(batch) < OMAP_BATCH:
+                    break
+                start_after = batch[-1][0]
+        except rados.ObjectNotFound:
+            pass
+
+        return dict((name, RBD_HEADER_PREFIX + ids[name] if name in ids
+                     else name + RBD_SUFFIX) for name in names)
+
+    def _load(self, ioctxs, name, header_oid):
+        """
+        Called on an image worker: load the details of one image, unless
+        its header is unchanged since we last did.
+        """
+        try:
+            ioctx = ioctxs.get(self.pool)
+            if ioctx is None:
+                ioctx = self._module.rados.open_ioctx(self.pool)
+                ioctxs[self.pool] = ioctx
+
+            ioctx.stat(header_oid)
+            version = ioctx.get_last_version()
+            with self.cond:
+                cached = self.images.get(name)
+            if cached is None or cached[0] != version:
+                stat = self._stat_image(ioctx, name)
+                with self.cond:
+                    self.images[name] = (version, stat)
+        except (rados.ObjectNotFound, rbd.ImageNotFound):
+            # Removed since we listed it
+            with self.cond:
+                self.images.pop(name, None)
+        except:
+            self.log.exception("Failed to load image %s/%s" % (self.pool,
+                                                               name))
+        finally:
+            self._loaded()
+
+    def _loaded(self):
+        with self.cond:
+            self.remaining -= 1
+            self.cond.notify_all()
+
+    def _stat_image(self, ioctx, name):
+        with rbd.Image(ioctx, name, read_only=True) as i:
             stat = i.stat()
             stat['name'] = name
             features = i.features()
@@ -62,8 +327,69 @@ class RbdLs(RemoteViewCache):
                 stat['parent'] = parent
             except rbd.ImageNotFound:
                 pass
-            result.append(stat)
-        return result
+        return stat
+
+    def get_page(self, page=0, page_size=0, sort_key='name', reverse=False):
+        """
+        One page of the images, without waiting for a whole fetch of a
+        large pool: sorted by name, a page is returned as soon as its
+        images are loaded; sorted by anything else, when all are loaded.
+        Either way we give up waiting after `timeout`, and return what we
+        have so far.
+
+        :param page_size: images per page, or 0 for all of them
+        :return: dict with the page's 'images', the 'total' number of
+                 images and how many are 'loaded' so far, and whether
+                 the listing is 'complete'
+        """
+        if sort_key not in SORT_KEYS:
+            raise ValueError("Invalid sort key '{0}'".format(sort_key))
+
+        self.get_nowait()
+
+        deadline = time.time() + self.timeout
+        with self.cond:
+            while True:
+                names = self.names
+                if names is not None:
+                    if reverse:
+                        names = names[::-1]
+                    if page_size:
+                        page_names = names[page * page_size:
+                                           (page + 1) * page_size]
+                    else:
+                        page_names = names
+                    if not self.remaining:
+                        break
+                    if sort_key == 'name' and all(
+                            name in self.images for name in page_names):
+                        break
+                wait = deadline - time.time()
+                if wait <= 0:
+                    break
+                self.cond.wait(wait)
+
+            if names is None:
+                return {'images': [], 'total': 0, 'loaded': 0,
+                        'complete': False}
+
+            if sort_key == 'name':
+                images = [self.images[name][1] for name in page_names
+                          if name in self.images]
+            else:
+                images = sorted((self.images[name][1] for name in names
+                                 if name in self.images),
+                                key=lambda i: i.get(sort_key),
+                                reverse=reverse)
+                if page_size:
+                    images = images[page * page_size:(page + 1) * page_size]
+
+            return {
+                'images': images,
+                'total': len(names),
+                'loaded': sum(1 for name in names if name in self.images),
+                'complete': not self.remaining,
+            }
 
     def _format_bitmask(self, features):
         names = ""
@@ -3,7 +3,7 @@ import json
 import re
 import rados
 import rbd
-from remote_view_cache import RemoteViewCache
+from remote_view_cache import RemoteViewCache, RemoteViewLRU
 
 class DaemonsAndPools(RemoteViewCache):
     def _get(self):
@@ -77,9 +77,8 @@ class DaemonsAndPools(RemoteViewCache):
         pool_stats = {}
         rbdctx = rbd.RBD()
         for pool_name in pool_names:
-            self.log.debug("Constructing IOCtx " + pool_name)
             try:
-                ioctx = self._module.rados.open_ioctx(pool_name)
+                ioctx = self._module.ioctx_pool.acquire(pool_name)
             except:
                 self.log.exception("Failed to open pool " + pool_name)
                 continue
@@ -88,6 +87,8 @@ class DaemonsAndPools(RemoteViewCache):
                 mirror_mode = rbdctx.mirror_mode_get(ioctx)
             except:
                 self.log.exception("Failed to query mirror mode " + pool_name)
+            finally:
+                self._module.ioctx_pool.release(ioctx)
 
             stats = {}
             if mirror_mode == rbd.RBD_MIRROR_MODE_DISABLED:
@@ -146,13 +147,16 @@ class PoolDatum(RemoteViewCache):
         super(PoolDatum, self).__init__(module_inst)
         self.pool_name = pool_name
 
+    @property
+    def name(self):
+        return "PoolDatum(%s)" % self.pool_name
+
     def _get(self):
         data = {}
-        self.log.debug("Constructing IOCtx " + self.pool_name)
         try:
-            ioctx = self._module.rados.open_ioctx(self.pool_name)
+            ioctx = self._module.ioctx_pool.acquire(self.pool_name)
         except:
-            self.log.exception("Failed to open pool " + pool_name)
+            self.log.exception("Failed to open pool " + self.pool_name)
             return None
 
         mirror_state = {
@@ -211,6 +215,8 @@ class PoolDatum(RemoteViewCache):
             pass
         except:
             self.log.exception("Failed to list mirror image status " + self.pool_name)
+        finally:
+            self._module.ioctx_pool.release(ioctx)
 
         return data
 
@@ -313,18 +319,14 @@ class ContentData(RemoteViewCache):
         }
 
     def get_pool_datum(self, pool_name):
-        pool_datum = self.pool_data.get(pool_name, None)
-        if pool_datum is None:
-            pool_datum = PoolDatum(self._module, pool_name)
-            self.pool_data[pool_name] = pool_datum
-
-        status, value = pool_datum.get()
+        status, value = self.pool_data[pool_name].get()
         return value
 
 class Controller:
     def __init__(self, module_inst):
         self.daemons_and_pools = DaemonsAndPools(module_inst)
-        self.pool_data = {}
+        self.pool_data = RemoteViewLRU(
+            lambda pool_name: PoolDatum(module_inst, pool_name))
         self.toplevel = Toplevel(module_inst, self.daemons_and_pools)
         self.content_data = ContentData(module_inst, self.daemons_and_pools,
                                         self.pool_data)
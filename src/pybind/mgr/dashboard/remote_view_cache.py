@@ -1,35 +1,118 @@
 
 
-from threading import Thread, Event, Lock
-import datetime
+from collections import OrderedDict
+from threading import Thread, Event, Lock, Condition, local
+import heapq
+import itertools
 import time
+import weakref
 
 
-class GetterThread(Thread):
-    def __init__(self, view):
-        super(GetterThread, self).__init__()
-        self._view = view
-        self.event = Event()
+# Number of threads shared by all views for running fetches
+DEFAULT_WORKERS = 4
 
-    def run(self):
-        try:
-            t0 = time.time()
-            val = self._view._get()
-            t1 = time.time()
-        except:
-            self._view.log.exception("Error while calling _get:")
-            # TODO: separate channel for passing back error
-            self._view.value = None
-            self._view.value_when = None
-            self._view.getter_thread = None
-        else:
-            with self._view.lock:
-                self._view.latency = t1 - t0
-                self._view.value = val
-                self._view.value_when = datetime.datetime.now()
-                self._view.getter_thread = None
+# How long stop() waits for workers to finish the fetches they are in
+STOP_TIMEOUT = 5
+
+# Once a value is this fraction of stale_period old, a get() that
+# returns it also starts a refresh in the background, so that callers
+# polling at about stale_period don't have to wait for the fetch.
+REFRESH_AHEAD = 0.75
+
+# How many per-key views a RemoteViewLRU keeps
+DEFAULT_LRU_SIZE = 64
+
+# Weight of the latest sample in the moving average of fetch latency
+LATENCY_ALPHA = 0.2
+
+
+class ViewExecutor(object):
+    """
+    A fixed pool of threads running the fetches of all RemoteViewCache
+    instances, replacing a thread per fetch.  Fetches may be scheduled
+    for later, which is how views refresh themselves ahead of time.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self.workers = workers
+        self.cond = Condition()
+        self.queue = []
+        self.seq = itertools.count()
+        self.threads = []
+        self.running = False
+        self.local = local()
+
+    def start(self):
+        with self.cond:
+            if self.running:
+                return
+            self.running = True
+            for i in range(self.workers):
+                t = Thread(target=self._worker,
+                           name="view-cache-%d" % i)
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+
+    def stop(self, log=None):
+        """
+        Stop the workers, waiting up to STOP_TIMEOUT seconds for those
+        in the middle of a fetch.  Workers are daemon threads, so one
+        stuck in a fetch doesn't keep the process from exiting.
+        """
+        with self.cond:
+            self.running = False
+            self.queue = []
+            self.cond.notify_all()
+        deadline = time.time() + STOP_TIMEOUT
+        for t in self.threads:
+            t.join(max(deadline - time.time(), 0))
+        stuck = [t.name for t in self.threads if t.is_alive()]
+        if stuck and log:
+            log.warning("View cache workers still running after %ss: %s" %
+                        (STOP_TIMEOUT, ", ".join(stuck)))
+        self.threads = []
+
+    def submit(self, view, ev, delay=0):
+        if not self.running:
+            self.start()
+        with self.cond:
+            heapq.heappush(self.queue,
+                           (time.time() + delay, next(self.seq), view, ev))
+            self.cond.notify()
+
+    def on_worker(self):
+        return getattr(self.local, 'worker', False)
 
-        self.event.set()
+    def _worker(self):
+        self.local.worker = True
+        while True:
+            with self.cond:
+                while self.running:
+                    if self.queue:
+                        wait = self.queue[0][0] - time.time()
+                        if wait <= 0:
+                            break
+                    else:
+                        wait = None
+                    self.cond.wait(wait)
+                if not self.running:
+                    return
+                _, _, view, ev = heapq.heappop(self.queue)
+            view._refresh(ev)
+
+    def stats(self):
+        with self.cond:
+            return {
+                'workers': len(self.threads),
+                'queued': len(self.queue),
+            }
+
+
+executor = ViewExecutor()
+
+# Every live view, for reporting statistics
+_views = weakref.WeakSet()
 
 
 class RemoteViewCache(object):
@@ -54,6 +137,10 @@ class RemoteViewCache(object):
     a polling caller doesn't end up firing off a large number of requests to
     the cluster because each one timed out.
 
+    Fetches run on the shared `executor`; at most one fetch per view is
+    queued or running at a time, and every caller waiting on the view
+    waits for that one.
+
     Subclasses may override _init and must override _get
     """
 
@@ -62,21 +149,33 @@ class RemoteViewCache(object):
 
         self.log = module_inst.log
 
-        self.getter_thread = None
-
         # Consider data within 1s old to be sufficiently fresh
         self.stale_period = 1.0
 
         # Return stale data if
         self.timeout = 5
 
-        self.event = Event()
         self.value_when = None
         self.value = None
         self.latency = 0
         self.lock = Lock()
 
+        # Event of the queued or running fetch, if any
+        self.pending = None
+        self.pending_when = None
+        self.fetching = False
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.none = 0
+        self.fetches = 0
+        self.errors = 0
+        self.latency_avg = 0
+        self.latency_max = 0
+
         self._module = module_inst
+        _views.add(self)
 
     def init(self):
         self._init()
@@ -86,6 +185,10 @@ class RemoteViewCache(object):
     VALUE_STALE = 1
     VALUE_NONE = 2
 
+    @property
+    def name(self):
+        return self.__class__.__name__
+
     def get(self):
         """
         If data less than `stale_period` old is available, return it
@@ -104,17 +207,22 @@ class RemoteViewCache(object):
             if not self.initialized:
                 self.init()
 
-            now = datetime.datetime.now()
-            if self.value_when and now - self.value_when < datetime.timedelta(
-                    seconds=self.stale_period):
+            now = time.time()
+            if self.value_when and now - self.value_when < self.stale_period:
+                self.hits += 1
+                if now - self.value_when >= \
+                        self.stale_period * REFRESH_AHEAD:
+                    self._schedule(0)
                 return self.VALUE_OK, self.value
 
-            if self.getter_thread is None:
-                self.getter_thread = GetterThread(self)
-                self.getter_thread.start()
-
-            ev = self.getter_thread.event
+            self.misses += 1
+            ev = self._schedule(0)
+            # A view fetched from another view's _get must not wait for
+            # a worker, they may all be busy waiting like this one.
+            inline = executor.on_worker() and not self.fetching
 
+        if inline:
+            self._refresh(ev)
         success = ev.wait(timeout=self.timeout)
 
         with self.lock:
@@ -123,13 +231,155 @@ class RemoteViewCache(object):
                 return self.VALUE_OK, self.value
             elif self.value_when is not None:
                 # We have some data, but it doesn't meet freshness requirements
+                self.stale += 1
                 return self.VALUE_STALE, self.value
             else:
                 # We have no data, not even stale data
+                self.none += 1
                 return self.VALUE_NONE, None
 
+    def get_nowait(self):
+        """
+        Like get(), but never waits for a fetch: if the data is stale, a
+        fetch is started and the data we have, if any, is returned.
+
+        :return: 2-tuple of value status code, value
+        """
+        with self.lock:
+            if not self.initialized:
+                self.init()
+
+            if self.value_when and \
+                    time.time() - self.value_when < self.stale_period:
+                self.hits += 1
+                return self.VALUE_OK, self.value
+
+            self._schedule(0)
+            if self.value_when is not None:
+                self.stale += 1
+                return self.VALUE_STALE, self.value
+            else:
+                self.none += 1
+                return self.VALUE_NONE, None
+
+    def refresh(self, delay=0):
+        """
+        Fetch the data again in the background in `delay` seconds,
+        unless a fetch is already due before then.
+        """
+        with self.lock:
+            self._schedule(delay)
+
+    def _schedule(self, delay):
+        # Called with self.lock held
+        when = time.time() + delay
+        if self.pending is None:
+            self.pending = Event()
+        elif self.fetching or self.pending_when <= when:
+            return self.pending
+        self.pending_when = when
+        executor.submit(self, self.pending, delay)
+        return self.pending
+
+    def _refresh(self, ev):
+        with self.lock:
+            # Stale queue entries of a fetch that was brought forward
+            if self.pending is not ev or self.fetching:
+                return
+            self.fetching = True
+
+        try:
+            t0 = time.time()
+            val = self._get()
+            t1 = time.time()
+        except:
+            self.log.exception("Error while calling _get:")
+            # TODO: separate channel for passing back error
+            with self.lock:
+                self.errors += 1
+                self.value = None
+                self.value_when = None
+        else:
+            with self.lock:
+                self.fetches += 1
+                self.latency = t1 - t0
+                self.latency_avg += LATENCY_ALPHA * \
+                    (self.latency - self.latency_avg)
+                self.latency_max = max(self.latency_max, self.latency)
+                self.value = val
+                self.value_when = t1
+
+        with self.lock:
+            self.pending = None
+            self.pending_when = None
+            self.fetching = False
+        ev.set()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'name': self.name,
+                'age': time.time() - self.value_when
+                if self.value_when else None,
+                'stale_period': self.stale_period,
+                'fetching': self.fetching,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'none': self.none,
+                'fetches': self.fetches,
+                'errors': self.errors,
+                'latency': self.latency,
+                'latency_avg': self.latency_avg,
+                'latency_max': self.latency_max,
+            }
+
     def _init(self):
         pass
 
     def _get(self):
         raise NotImplementedError()
+
+
+class RemoteViewLRU(object):
+    """
+    Per-key RemoteViewCache instances (e.g. one per pool), created on
+    first use by `factory(key)`.  Only the `max_size` most recently used
+    are kept, so that requests for many keys don't grow without bound.
+    """
+
+    def __init__(self, factory, max_size=DEFAULT_LRU_SIZE):
+        self.factory = factory
+        self.max_size = max_size
+        self.views = OrderedDict()
+        self.lock = Lock()
+
+    def __getitem__(self, key):
+        with self.lock:
+            view = self.views.pop(key, None)
+            if view is None:
+                view = self.factory(key)
+            self.views[key] = view
+            while len(self.views) > self.max_size:
+                self.views.popitem(last=False)
+            return view
+
+    def __len__(self):
+        return len(self.views)
+
+    def values(self):
+        with self.lock:
+            return self.views.values()
+
+
+def get_stats():
+    """
+    Statistics of the executor and of every live view, for the
+    dashboard's view_cache_stats endpoint.
+    """
+    views = sorted((v.stats() for v in list(_views)),
+                   key=lambda s: s['name'])
+    return {
+        'executor': executor.stats(),
+        'views': views,
+    }
@@ -0,0 +1,196 @@
+
+from array import array
+from threading import Lock
+
+
+# Samples kept as they come, for the latest value and rate
+RAW_POINTS = 10
+
+# Downsampling tiers: name, resolution in seconds, and default retention
+# in seconds.  A tier keeps the last sample of each period.
+TIERS = [
+    ('10s', 10, 3600),
+    ('1m', 60, 6 * 3600),
+    ('10m', 600, 3 * 24 * 3600),
+]
+
+# Percentiles of the rates over each tier's retention
+PERCENTILES = [50, 95, 99]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    i = int(round((len(sorted_values) - 1) * p / 100.0))
+    return sorted_values[i]
+
+
+class Tier(object):
+    """
+    Fixed-size columns of samples at one resolution: the sample times,
+    and for each stat its values and its rates since the sample before.
+    """
+    __slots__ = ('name', 'resolution', 'capacity', 'times', 'values',
+                 'rates', 'start', 'size', 'percentiles')
+
+    def __init__(self, name, resolution, capacity):
+        self.name = name
+        self.resolution = resolution
+        self.capacity = capacity
+        self.times = array('d', [0.0]) * capacity
+        self.values = {}
+        self.rates = {}
+        self.start = 0
+        self.size = 0
+        self.percentiles = {}
+
+    def _index(self, n):
+        # n-th sample, oldest first; negative from the newest
+        if n < 0:
+            n += self.size
+        return (self.start + n) % self.capacity
+
+    def _column(self, columns, stat):
+        column = columns.get(stat)
+        if column is None:
+            column = array('d', [0.0]) * self.capacity
+            columns[stat] = column
+        return column
+
+    def add(self, t, values):
+        if self.size and self.resolution and \
+                t // self.resolution == \
+                self.times[self._index(-1)] // self.resolution:
+            # Same period as the last sample: replace it
+            i = self._index(-1)
+        else:
+            if self.size and self.resolution:
+                # The last period is complete
+                self._update_percentiles()
+            if self.size < self.capacity:
+                self.size += 1
+            else:
+                self.start = (self.start + 1) % self.capacity
+            i = self._index(-1)
+
+        self.times[i] = t
+        prev = self._index(-2) if self.size > 1 else None
+        for stat, v in values.items():
+            column = self._column(self.values, stat)
+            rates = self._column(self.rates, stat)
+            column[i] = v
+            if prev is not None and t > self.times[prev]:
+                rates[i] = (v - column[prev]) / (t - self.times[prev])
+            else:
+                rates[i] = 0
+
+    def _update_percentiles(self):
+        for stat, rates in self.rates.items():
+            # All but the first sample, which has no rate
+            ordered = sorted(rates[self._index(n)]
+                             for n in range(1, self.size))
+            self.percentiles[stat] = dict(
+                ("p{0}".format(p), percentile(ordered, p))
+                for p in PERCENTILES)
+
+    def latest(self, stat):
+        i = self._index(-1)
+        return self.values[stat][i], self.rates[stat][i]
+
+    def series(self, stat):
+        """
+        :return: dict of 'times', 'values' and 'rates', oldest first,
+                 and the rate 'percentiles'
+        """
+        indices = [self._index(n) for n in range(self.size)]
+        values = self.values.get(stat)
+        rates = self.rates.get(stat)
+        return {
+            'resolution': self.resolution,
+            'times': [self.times[i] for i in indices],
+            'values': [values[i] for i in indices] if values else [],
+            'rates': [rates[i] for i in indices] if rates else [],
+            'percentiles': self.percentiles.get(stat, {}),
+        }
+
+
+class TimeSeriesStore(object):
+    """
+    Series of a set of stats per key (e.g. per pool), sampled together,
+    kept raw for the last RAW_POINTS samples and downsampled into
+    `tiers` for trends over longer periods.  Memory is fixed per key.
+    """
+
+    def __init__(self, retention=None):
+        """
+        :param retention: dict of tier name to retention in seconds,
+                          overriding those in TIERS
+        """
+        retention = retention or {}
+        self.tiers = [(name, resolution,
+                       max(int(retention.get(name, default) // resolution),
+                           2))
+                      for name, resolution, default in TIERS]
+        self.series = {}
+        self.lock = Lock()
+
+    def __len__(self):
+        return len(self.series)
+
+    def add(self, key, t, values):
+        with self.lock:
+            tiers = self.series.get(key)
+            if tiers is None:
+                tiers = [Tier('raw', None, RAW_POINTS)] + \
+                    [Tier(name, resolution, capacity)
+                     for name, resolution, capacity in self.tiers]
+                self.series[key] = tiers
+            for tier in tiers:
+                tier.add(t, values)
+
+    def retain(self, keys):
+        """
+        Drop the series of keys other than these
+        """
+        keys = set(keys)
+        with self.lock:
+            for key in self.series.keys():
+                if key not in keys:
+                    del self.series[key]
+
+    def latest(self, key):
+        """
+        :return: dict of stat to dict of its 'latest' value, 'rate', and
+                 recent 'series' of [time, value], newest first
+        """
+        with self.lock:
+            tiers = self.series.get(key)
+            if tiers is None:
+                return {}
+            raw = tiers[0]
+            result = {}
+            for stat in raw.values:
+                value, rate = raw.latest(stat)
+                series = raw.series(stat)
+                result[stat] = {
+                    'latest': value,
+                    'rate': rate,
+                    'series': zip(series['times'], series['values'])[::-1],
+                }
+            return result
+
+    def get(self, key, stat, tier):
+        """
+        :param tier: a tier name, or 'raw'
+        :return: see Tier.series, or None if we have no such series
+        """
+        with self.lock:
+            tiers = self.series.get(key)
+            if tiers is None:
+                return None
+            for t in tiers:
+                if t.name == tier:
+                    if stat not in t.values:
+                        return None
+                    return t.series(stat)
+            raise ValueError("Invalid tier '{0}'".format(tier))
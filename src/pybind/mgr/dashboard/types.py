@@ -1,5 +1,7 @@
 from collections import namedtuple
 
+from mgr_module import CrushRuleResolver
+
 
 CRUSH_RULE_TYPE_REPLICATED = 1
 CRUSH_RULE_TYPE_ERASURE = 3
@@ -24,11 +26,14 @@ def memoize(function):
         if not hasattr(self, "_memo"):
             self._memo = {}
 
-        if args in self._memo:
-            return self._memo[args]
+        # Keyed by function too: the memoized properties all take
+        # just self
+        key = (function.__name__,) + args[1:]
+        if key in self._memo:
+            return self._memo[key]
         else:
             rv = function(*args)
-            self._memo[args] = rv
+            self._memo[key] = rv
             return rv
     return wrapper
 
@@ -44,8 +49,13 @@ class DataWrapper(object):
 class OsdMap(DataWrapper):
     str = OSD_MAP
 
-    def __init__(self, data):
+    def __init__(self, data, crush_resolver=None):
+        """
+        :param crush_resolver: a CrushRuleResolver for this map, if the
+                               caller has one already
+        """
         super(OsdMap, self).__init__(data)
+        self._crush_resolver = crush_resolver
         if data is not None:
             self.osds_by_id = dict([(o['osd'], o) for o in data['osds']])
             self.pools_by_id = dict([(p['pool'], p) for p in data['pools']])
@@ -70,70 +80,20 @@ class OsdMap(DataWrapper):
     def get_tree_nodes_by_id(self):
         return dict((n["id"], n) for n in self.data['tree']["nodes"])
 
-    def _get_crush_rule_osds(self, rule):
-        nodes_by_id = self.get_tree_nodes_by_id()
-
-        def _gather_leaf_ids(node):
-            if node['id'] >= 0:
-                return set([node['id']])
-
-            result = set()
-            for child_id in node['children']:
-                if child_id >= 0:
-                    result.add(child_id)
-                else:
-                    result |= _gather_leaf_ids(nodes_by_id[child_id])
-
-            return result
-
-        def _gather_descendent_ids(node, typ):
-            result = set()
-            for child_id in node['children']:
-                child_node = nodes_by_id[child_id]
-                if child_node['type'] == typ:
-                    result.add(child_node['id'])
-                elif 'children' in child_node:
-                    result |= _gather_descendent_ids(child_node, typ)
-
-            return result
-
-        def _gather_osds(root, steps):
-            if root['id'] >= 0:
-                return set([root['id']])
-
-            osds = set()
-            step = steps[0]
-            if step['op'] == 'choose_firstn':
-                # Choose all descendents of the current node of type 'type'
-                d = _gather_descendent_ids(root, step['type'])
-                for desc_node in [nodes_by_id[i] for i in d]:
-                    osds |= _gather_osds(desc_node, steps[1:])
-            elif step['op'] == 'chooseleaf_firstn':
-                # Choose all descendents of the current node of type 'type',
-                # and select all leaves beneath those
-                for desc_node in [nodes_by_id[i] for i in _gather_descendent_ids(root, step['type'])]:
-                    # Short circuit another iteration to find the emit
-                    # and assume anything we've done a chooseleaf on
-                    # is going to be part of the selected set of osds
-                    osds |= _gather_leaf_ids(desc_node)
-            elif step['op'] == 'emit':
-                if root['id'] >= 0:
-                    osds |= root['id']
-
-            return osds
-
-        osds = set()
-        for i, step in enumerate(rule['steps']):
-            if step['op'] == 'take':
-                osds |= _gather_osds(nodes_by_id[step['item']], rule['steps'][i + 1:])
-        return osds
+    def _get_crush_resolver(self):
+        if self._crush_resolver is None:
+            self._crush_resolver = CrushRuleResolver(
+                self.data['tree']['nodes'], self.data['crush']['rules'])
+        return self._crush_resolver
 
     @property
     @memoize
     def osds_by_rule_id(self):
+        resolver = self._get_crush_resolver()
         result = {}
         for rule in self.data['crush']['rules']:
-            result[rule['rule_id']] = list(self._get_crush_rule_osds(rule))
+            result[rule['rule_id']] = list(
+                resolver.rule_osds(rule['rule_id']))
 
         return result
 
@@ -146,19 +106,17 @@ class OsdMap(DataWrapper):
         :return dict of pool ID to OSD IDs in the pool
         """
 
+        resolver = self._get_crush_resolver()
         result = {}
         for pool_id, pool in self.pools_by_id.items():
-            osds = None
-            for rule in [r for r in self.data['crush']['rules'] if r['ruleset'] == pool['crush_ruleset']]:
-                if rule['min_size'] <= pool['size'] <= rule['max_size']:
-                    osds = self.osds_by_rule_id[rule['rule_id']]
+            osds = resolver.pool_osds(pool)
 
             if osds is None:
-                # Fallthrough, the pool size didn't fall within any of the rules in its ruleset, Calamari
+                # Fallthrough, the pool size didn't fall within its rule, Calamari
                 # doesn't understand.  Just report all OSDs instead of failing horribly.
                 osds = self.osds_by_id.keys()
 
-            result[pool_id] = osds
+            result[pool_id] = list(osds)
 
         return result
 
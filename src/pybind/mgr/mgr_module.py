@@ -114,6 +114,329 @@ class CRUSHMap(object):
         return { int(k): v for k, v in uglymap.get('weights', {}).iteritems() }
 
 
+class CrushRuleResolver(object):
+    """
+    Which OSDs each CRUSH rule (and so each pool) may map PGs to, worked
+    out from the 'osd_map_tree' nodes and 'osd_map_crush' rules.
+
+    The tree is indexed once, bottom up: for every bucket, the OSDs
+    beneath it and, per type, its nearest descendants of that type.
+    Rules are then resolved from the index without walking the tree,
+    and each rule only once.
+    """
+
+    def __init__(self, nodes, rules):
+        self.nodes_by_id = dict((n['id'], n) for n in nodes)
+        self.rules_by_id = dict((r['rule_id'], r) for r in rules)
+        self.leaves = {}
+        self.descendants = {}
+        self.osds_by_rule_id = {}
+        for node_id in self.nodes_by_id:
+            self._index(node_id)
+
+    def _index(self, node_id):
+        if node_id in self.leaves:
+            return
+        if node_id >= 0:
+            self.leaves[node_id] = frozenset([node_id])
+            self.descendants[node_id] = {}
+            return
+
+        leaves = set()
+        descendants = {}
+        for child_id in self.nodes_by_id[node_id].get('children', []):
+            if child_id >= 0:
+                leaves.add(child_id)
+            child = self.nodes_by_id.get(child_id)
+            if child is None:
+                continue
+            self._index(child_id)
+            leaves |= self.leaves[child_id]
+            # The nearest descendants of a type: the child itself if it
+            # is of that type, otherwise those of the child
+            for typ, ids in self.descendants[child_id].items():
+                if typ != child['type']:
+                    descendants.setdefault(typ, set()).update(ids)
+            descendants.setdefault(child['type'], set()).add(child_id)
+        self.leaves[node_id] = frozenset(leaves)
+        self.descendants[node_id] = descendants
+
+    def _gather_osds(self, node_id, steps):
+        if node_id >= 0:
+            return set([node_id])
+
+        osds = set()
+        if not steps:
+            return osds
+        step = steps[0]
+        children = self.descendants[node_id].get(step.get('type'), ())
+        if step['op'] in ('choose_firstn', 'choose_indep'):
+            for child_id in children:
+                osds |= self._gather_osds(child_id, steps[1:])
+        elif step['op'] in ('chooseleaf_firstn', 'chooseleaf_indep'):
+            # Assume anything we've done a chooseleaf on is going to be
+            # part of the selected set of osds
+            for child_id in children:
+                osds |= self.leaves[child_id]
+        return osds
+
+    def rule_osds(self, rule_id):
+        """
+        :return: frozenset of the OSD ids the rule may choose
+        """
+        osds = self.osds_by_rule_id.get(rule_id)
+        if osds is None:
+            steps = self.rules_by_id[rule_id]['steps']
+            osds = set()
+            for i, step in enumerate(steps):
+                if step['op'] == 'take' and step['item'] in self.nodes_by_id:
+                    osds |= self._gather_osds(step['item'], steps[i + 1:])
+            osds = frozenset(osds)
+            self.osds_by_rule_id[rule_id] = osds
+        return osds
+
+    def pool_osds(self, pool):
+        """
+        :param pool: a pool from the 'osd_map' pools
+        :return: frozenset of OSD ids, or None if the pool's size is
+                 outside that allowed by its rule
+        """
+        rule = self.rules_by_id.get(pool['crush_rule'])
+        if rule is None or \
+                not rule['min_size'] <= pool['size'] <= rule['max_size']:
+            return None
+        return self.rule_osds(rule['rule_id'])
+
+
+class StatsView(object):
+    """
+    Column oriented view of per-PG or per-OSD stats, as returned by
+    MgrModule.get_pg_stats_view and MgrModule.get_osd_stats_view.
+
+    Each field is a plain list and row i of every column describes the
+    same PG (or OSD), so callers can walk just the columns they need
+    instead of a list of fully populated dicts.  Rows are only built
+    on demand.
+    """
+    def __init__(self, columns, key):
+        self._columns = columns
+        self._key = key
+        self._index = None
+
+    def __len__(self):
+        for col in self._columns.itervalues():
+            return len(col)
+        return 0
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __getitem__(self, i):
+        return dict((name, col[i]) for name, col in self._columns.iteritems())
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    @property
+    def fields(self):
+        return self._columns.keys()
+
+    @property
+    def index(self):
+        """
+        dict of key field value (pgid or osd id) to row number.  Only
+        available if the key field was part of the projection.
+        """
+        if self._index is None:
+            self._index = dict(
+                (k, i) for i, k in enumerate(self._columns[self._key]))
+        return self._index
+
+    def column(self, name):
+        return self._columns[name]
+
+    def get(self, key, field=None):
+        """
+        Look up the row for a pgid or osd id; with ``field``, just that
+        value.  Returns None if the key is not present.
+        """
+        i = self.index.get(key)
+        if i is None:
+            return None
+        if field is not None:
+            return self._columns[field][i]
+        return self[i]
+
+    def select(self, *fields):
+        """
+        Narrow the view to a subset of its fields without copying.
+        """
+        v = StatsView(dict((f, self._columns[f]) for f in fields), self._key)
+        if self._key in fields:
+            v._index = self._index
+        return v
+
+
+class ClusterStateCache(object):
+    """
+    Cache of ``MgrModule.get`` results, keyed by data name and by the
+    epoch/version of the map(s) the data is generated from.  Entries
+    for data without a version (health, mon_status) are dropped when
+    the corresponding notification arrives.
+
+    Each module runs in its own python interpreter, so the cache (and
+    the objects in it) is per module; within a module every caller
+    gets the same object back, which must be treated as read-only.
+    """
+
+    # data name -> maps it is derived from (see PyModules::get_python)
+    DEPENDS = {
+        'osd_map': ('osd_map',),
+        'osd_map_tree': ('osd_map',),
+        'osd_map_crush': ('osd_map',),
+        'osdmap_crush_map_text': ('osd_map',),
+        'pg_summary': ('pg_map',),
+        'pg_status': ('pg_map',),
+        'pg_dump': ('pg_map',),
+        'osd_stats': ('pg_map',),
+        'df': ('osd_map', 'pg_map'),
+        'fs_map': ('fs_map',),
+        'mon_map': ('mon_map',),
+        'service_map': ('service_map',),
+        'mgr_map': ('mgr_map',),
+    }
+
+    # notify type -> unversioned data names it replaces
+    NOTIFIED = {
+        'health': ('health',),
+        'mon_status': ('mon_status',),
+    }
+
+    # notify type -> map version it announces, where they differ
+    NOTIFY_MAPS = {
+        'pg_summary': 'pg_map',
+    }
+
+    # list name -> field its items are looked up by in a path
+    PATH_ITEM_KEYS = {
+        'osds': 'osd',
+        'pools': 'pool',
+        'nodes': 'id',
+        'rules': 'rule_id',
+        'buckets': 'id',
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}  # data name -> (versions, value)
+        self.generation = {}  # data name -> invalidation count
+        self.paths = {}  # data name -> (value, {path: part}, {path: index})
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def cacheable(self, data_name):
+        return data_name in self.DEPENDS or \
+            any(data_name in v for v in self.NOTIFIED.itervalues())
+
+    def get(self, data_name, fetch, get_versions):
+        """
+        Return the cached value for data_name, calling fetch() to
+        (re)load it if it is missing or its maps have moved on.
+        """
+        key = None
+        deps = self.DEPENDS.get(data_name)
+        if deps:
+            versions = get_versions()
+            key = tuple(versions.get(d) for d in deps)
+        with self.lock:
+            entry = self.entries.get(data_name)
+            if entry is not None and entry[0] == key:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            gen = self.generation.get(data_name, 0)
+        value = fetch()
+        with self.lock:
+            # don't store something that was invalidated while we were
+            # fetching it; a versioned entry fetched while the map moved
+            # on is harmless, as it just fails the next version check
+            if self.generation.get(data_name, 0) == gen:
+                self.entries[data_name] = (key, value)
+        return value
+
+    def walk(self, value, path, indices=None):
+        """
+        The part of value at path: dict keys, or for lists the value of
+        the items' PATH_ITEM_KEYS field (or else their position).
+        Lists are looked up through an index, reused from indices.
+
+        :raises KeyError: if there is nothing at path
+        """
+        obj = value
+        for i, part in enumerate(path):
+            if isinstance(obj, list):
+                field = self.PATH_ITEM_KEYS.get(path[i - 1]) if i else None
+                if field is None:
+                    try:
+                        obj = obj[part]
+                        continue
+                    except (IndexError, TypeError):
+                        raise KeyError(part)
+                index = None
+                if indices is not None:
+                    index = indices.get(path[:i])
+                if index is None:
+                    index = dict((item[field], item) for item in obj)
+                    if indices is not None:
+                        indices[path[:i]] = index
+                obj = index[part]
+            elif isinstance(obj, dict):
+                obj = obj[part]
+            else:
+                raise KeyError(part)
+        return obj
+
+    def get_path(self, data_name, path, fetch, get_versions):
+        """
+        Return the part of the cached value for data_name at path (see
+        ``walk``), itself cached until the value is replaced.
+        """
+        path = tuple(path)
+        value = self.get(data_name, fetch, get_versions)
+        with self.lock:
+            entry = self.paths.get(data_name)
+            if entry is None or entry[0] is not value:
+                entry = (value, {}, {})
+                self.paths[data_name] = entry
+            _, parts, indices = entry
+            if path not in parts:
+                parts[path] = self.walk(value, path, indices)
+            return parts[path]
+
+    def invalidate(self, notify_type):
+        m = self.NOTIFY_MAPS.get(notify_type, notify_type)
+        names = [name for name, deps in self.DEPENDS.iteritems()
+                 if m in deps]
+        names.extend(self.NOTIFIED.get(notify_type, ()))
+        with self.lock:
+            for name in names:
+                self.generation[name] = self.generation.get(name, 0) + 1
+                if self.entries.pop(name, None) is not None:
+                    self.invalidations += 1
+                self.paths.pop(name, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'invalidations': self.invalidations,
+                'size': len(self.entries),
+            }
+
+
 class MgrModule(object):
     COMMANDS = []
 
@@ -145,6 +468,9 @@ class MgrModule(object):
 
         self._version = ceph_state.get_version()
 
+        self._cache = ClusterStateCache()
+        self._crush_resolver = (None, None, None)
+
     @property
     def log(self):
         return self._logger
@@ -160,6 +486,14 @@ class MgrModule(object):
         """
         pass
 
+    def _notify(self, notify_type, notify_id):
+        """
+        Entry point for notifications from ceph-mgr: drop cached state
+        made stale by the notification, then pass it on to ``notify``.
+        """
+        self._cache.invalidate(notify_type)
+        self.notify(notify_type, notify_id)
+
     def serve(self):
         """
         Called by the ceph-mgr service to start any server that
@@ -186,6 +520,57 @@ class MgrModule(object):
         """
         return ceph_state.get(self._handle, data_name)
 
+    def get_cached(self, data_name):
+        """
+        Like ``get``, but return a cached copy as long as the map(s) the
+        data is built from have not changed.  The same object is handed
+        to every caller, so it must not be modified; use ``get`` if you
+        need a private copy.
+        """
+        if not self._cache.cacheable(data_name):
+            return self.get(data_name)
+        return self._cache.get(
+            data_name,
+            lambda: ceph_state.get(self._handle, data_name),
+            lambda: ceph_state.get(self._handle, 'versions'))
+
+    def get_cached_path(self, data_name, path):
+        """
+        Like ``get_cached``, but just the part of the data at path: a
+        sequence of dict keys, where lists of OSDs, pools, CRUSH nodes
+        and so on are looked up by id, e.g. ``('pools', 1)``.  Lookups
+        are cached per path, so repeated ones don't walk the data.
+
+        :raises KeyError: if there is nothing at path
+        """
+        if not self._cache.cacheable(data_name):
+            return self._cache.walk(self.get(data_name), tuple(path))
+        return self._cache.get_path(
+            data_name, path,
+            lambda: ceph_state.get(self._handle, data_name),
+            lambda: ceph_state.get(self._handle, 'versions'))
+
+    def get_crush_resolver(self):
+        """
+        The CrushRuleResolver for the current OSD map, built once per
+        epoch from the ``get_cached`` tree and CRUSH rules.
+        """
+        tree = self.get_cached('osd_map_tree')
+        crush = self.get_cached('osd_map_crush')
+        cached_tree, cached_crush, resolver = self._crush_resolver
+        if tree is not cached_tree or crush is not cached_crush:
+            resolver = CrushRuleResolver(tree['nodes'], crush['rules'])
+            self._crush_resolver = (tree, crush, resolver)
+        return resolver
+
+    def get_cache_stats(self):
+        """
+        Counters for the ``get_cached`` cache of this module.
+
+        :return: dict with hits, misses, invalidations and size
+        """
+        return self._cache.stats()
+
     def get_server(self, hostname):
         """
         Called by the plugin to load information about a particular
@@ -219,6 +604,53 @@ class MgrModule(object):
         """
         return ceph_state.get_counter(self._handle, svc_type, svc_name, path)
 
+    def get_pg_stats_view(self, fields=None):
+        """
+        Fetch per-PG stats as a column oriented StatsView, keyed by
+        pgid.  Only the requested fields are converted into python
+        objects, which is much cheaper than ``get('pg_dump')`` on
+        clusters with many PGs.
+
+        :param fields: list of field names, e.g. ['pgid', 'up',
+                       'num_bytes'], or None for all of them
+        :return: StatsView
+        """
+        return StatsView(
+            ceph_state.get_pg_stats(self._handle, ','.join(fields or [])),
+            'pgid')
+
+    def get_osd_stats_view(self, fields=None):
+        """
+        Fetch per-OSD stats (as in ``get('osd_stats')``) as a column
+        oriented StatsView, keyed by osd id.
+
+        :param fields: list of field names, e.g. ['osd', 'kb_used'],
+                       or None for all of them
+        :return: StatsView
+        """
+        return StatsView(
+            ceph_state.get_osd_stats(self._handle, ','.join(fields or [])),
+            'osd')
+
+    def get_all_perf_counters(self, svc_type=None, paths=None,
+                              latest_only=True):
+        """
+        Fetch perf counter data for many daemons in a single call,
+        rather than one ``get_counter`` call per daemon and path.
+
+        :param svc_type: only daemons of this type (e.g. 'osd'), or
+                         None for all daemons
+        :param paths: list of counter paths, or None for all counters
+        :param latest_only: only return the most recent datapoint
+        :return: dict of daemon name ('osd.0') to dict of path to a list
+                 of [time, value] datapoints, oldest first; times are
+                 in seconds since the epoch.  Long-running averages
+                 give [time, sum, count] instead.
+        """
+        return ceph_state.get_all_perf_counters(
+            self._handle, svc_type or '', ','.join(paths or []),
+            1 if latest_only else 0)
+
     def list_servers(self):
         """
         Like ``get_server``, but instead of returning information
@@ -1,9 +1,14 @@
 import cherrypy
+import gzip
+import json
 import math
 import os
 import time
 from collections import OrderedDict
-from mgr_module import MgrModule
+from cStringIO import StringIO
+from mgr_module import MgrModule, CommandResult
+from push import Pusher
+from threading import Event, Lock, Thread
 
 # Defaults for the Prometheus HTTP server.  Can also set in config-key
 # see https://github.com/prometheus/prometheus/wiki/Default-port-allocations
@@ -12,6 +17,57 @@ from mgr_module import MgrModule
 DEFAULT_ADDR = '::'
 DEFAULT_PORT = 9283
 
+# Seconds between background collections; scrapes are served from the
+# result of the last one.
+DEFAULT_SCRAPE_INTERVAL = 15
+
+# Seconds to wait for OSDs to answer 'perf histogram dump'
+HISTOGRAM_TIMEOUT = 5
+
+# Size of the pieces a compressed response is streamed in
+GZIP_CHUNK_SIZE = 64 * 1024
+
+# Push mode (off unless push_url is set): format, number of batches
+# kept for retrying, and HTTP timeout in seconds
+DEFAULT_PUSH_FORMAT = 'text'
+DEFAULT_PUSH_QUEUE_SIZE = 10
+DEFAULT_PUSH_TIMEOUT = 10
+
+# Cluster metrics taken from the mgr's maps: (metric, source field,
+# type, description)
+DF_CLUSTER = [
+    ('cluster_total_bytes', 'total_bytes', 'gauge', 'Total raw capacity'),
+    ('cluster_total_used_bytes', 'total_used_bytes', 'gauge',
+     'Raw capacity used'),
+    ('cluster_total_avail_bytes', 'total_avail_bytes', 'gauge',
+     'Raw capacity available'),
+    ('cluster_total_objects', 'total_objects', 'gauge', 'Number of objects'),
+]
+DF_POOL = [
+    ('pool_bytes_used', 'bytes_used', 'gauge', 'Bytes stored in the pool'),
+    ('pool_raw_bytes_used', 'raw_bytes_used', 'gauge',
+     'Raw bytes used by the pool, including replication'),
+    ('pool_max_avail', 'max_avail', 'gauge',
+     'Bytes that can still be written to the pool'),
+    ('pool_objects', 'objects', 'gauge', 'Objects in the pool'),
+    ('pool_dirty', 'dirty', 'gauge', 'Dirty objects in a cache tier pool'),
+    ('pool_rd', 'rd', 'counter', 'Read operations'),
+    ('pool_rd_bytes', 'rd_bytes', 'counter', 'Bytes read'),
+    ('pool_wr', 'wr', 'counter', 'Write operations'),
+    ('pool_wr_bytes', 'wr_bytes', 'counter', 'Bytes written'),
+]
+OSD_MAP = [
+    ('osd_up', 'up', 'gauge', 'OSD is up'),
+    ('osd_in', 'in', 'gauge', 'OSD is in'),
+    ('osd_weight', 'weight', 'gauge', 'OSD reweight value'),
+]
+OSD_STATS = [
+    ('osd_kb', 'kb', 'gauge', 'OSD capacity in KiB'),
+    ('osd_kb_used', 'kb_used', 'gauge', 'OSD KiB used'),
+    ('osd_kb_avail', 'kb_avail', 'gauge', 'OSD KiB available'),
+    ('osd_num_pgs', 'num_pgs', 'gauge', 'PGs on the OSD'),
+]
+
 
 # cherrypy likes to sys.exit on error.  don't let it take us down too!
 def os_exit_noop():
@@ -45,20 +101,71 @@ PERFCOUNTER_TYPE_MASK = ~2
 
 def stattype_to_str(stattype):
 
+    if stattype & PERFCOUNTER_HISTOGRAM:
+        return 'histogram'
+    if stattype & PERFCOUNTER_LONGRUNAVG:
+        # exported as _sum and _count
+        return 'summary'
     typeonly = stattype & PERFCOUNTER_TYPE_MASK
     if typeonly == 0:
         return 'gauge'
-    if typeonly == PERFCOUNTER_LONGRUNAVG:
-        # this lie matches the DaemonState decoding: only val, no counts
-        return 'counter'
     if typeonly == PERFCOUNTER_COUNTER:
         return 'counter'
-    if typeonly == PERFCOUNTER_HISTOGRAM:
-        return 'histogram'
 
     return ''
 
 
+def histogram_buckets(histogram):
+    '''
+    Collapse a 'perf histogram dump' histogram onto its first axis.
+    Returns the cumulative (upper bound, count) buckets and the total
+    count; OSD latency axes count nanoseconds, these are converted to
+    seconds.
+    '''
+    axis = histogram['axes'][0]
+    scale = 1e-9 if axis['name'].startswith('Latency') else 1
+    buckets = []
+    total = 0
+    for r, row in zip(axis['ranges'], histogram['values']):
+        total += sum(row) if isinstance(row, list) else row
+        buckets.append((r['max'] * scale if 'max' in r else float('inf'),
+                        total))
+    return buckets, total
+
+
+def promethize(path):
+    ''' replace illegal metric name characters '''
+    result = path.replace('.', '_').replace('+', '_plus')
+
+    # Hyphens usually turn into underscores, unless they are
+    # trailing
+    if result.endswith("-"):
+        result = result[0:-1] + "_minus"
+    else:
+        result = result.replace("-", "_")
+
+    return result
+
+
+def floatstr(value):
+    ''' represent as Go-compatible float '''
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    if math.isnan(value):
+        return 'NaN'
+    return repr(float(value))
+
+
+def escape_label_value(value):
+    ''' escape a label value as the text exposition format requires '''
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
 class Metric(object):
     def __init__(self, mtype, name, desc, labels=None):
         self.mtype = mtype
@@ -66,62 +173,132 @@ class Metric(object):
         self.desc = desc
         self.labelnames = labels    # tuple if present
         self.value = dict()         # indexed by label values
+        self.promname = promethize(name)
+        self.header = None
+        # (suffix, label values) -> 'name_suffix{labels} ', kept across
+        # collections so that they are only formatted once
+        self.prefixes = dict()
 
     def set(self, value, labelvalues=None):
-        # labelvalues must be a tuple
+        # labelvalues must be a tuple.  value is (sum, count) for a
+        # summary and (buckets, count) for a histogram.
         labelvalues = labelvalues or ('',)
         self.value[labelvalues] = value
 
-    def str_expfmt(self):
-
-        def promethize(path):
-            ''' replace illegal metric name characters '''
-            result = path.replace('.', '_').replace('+', '_plus') 
-
-            # Hyphens usually turn into underscores, unless they are
-            # trailing
-            if result.endswith("-"):
-                result = result[0:-1] + "_minus"
+    def clear(self):
+        ''' drop all values, e.g. before refilling from a new map '''
+        if len(self.prefixes) > 4 * len(self.value):
+            # don't hang on to label sets that have gone away
+            self.prefixes.clear()
+        self.value = dict()
+
+    def prefix(self, suffix, labelvalues, extra=None):
+        key = (suffix, labelvalues, extra)
+        prefix = self.prefixes.get(key)
+        if prefix is None:
+            labels = zip(self.labelnames, labelvalues) if self.labelnames \
+                else []
+            if extra:
+                labels.append(extra)
+            labels = ','.join('%s="%s"' % (k, escape_label_value(v))
+                              for k, v in labels)
+            if labels:
+                prefix = '%s%s{%s} ' % (self.promname, suffix, labels)
             else:
-                result = result.replace("-", "_")
-
-            return result
-
-        def floatstr(value):
-            ''' represent as Go-compatible float '''
-            if value == float('inf'):
-                return '+Inf'
-            if value == float('-inf'):
-                return '-Inf'
-            if math.isnan(value):
-                return 'NaN'
-            return repr(float(value))
-
-        name = promethize(self.name)
-        expfmt = '''
-# HELP {name} {desc}
-# TYPE {name} {mtype}'''.format(
-            name=name,
-            desc=self.desc,
-            mtype=self.mtype,
-        )
+                prefix = '%s%s ' % (self.promname, suffix)
+            prefix = self.prefixes[key] = intern(prefix)
+        return prefix
 
-        for labelvalues, value in self.value.items():
-            if self.labelnames:
-                labels = zip(self.labelnames, labelvalues)
-                labels = ','.join('%s="%s"' % (k, v) for k, v in labels)
-            else:
-                labels = ''
-            if labels:
-                fmtstr = '\n{name}{{{labels}}} {value}'
+    def samples(self):
+        '''
+        yield (label values, name suffix, extra label, value) for every
+        series, expanding summaries and histograms
+        '''
+        for labelvalues, value in self.value.iteritems():
+            if self.mtype == 'summary':
+                yield labelvalues, '_sum', None, value[0]
+                yield labelvalues, '_count', None, value[1]
+            elif self.mtype == 'histogram':
+                buckets, count = value
+                for le, n in buckets:
+                    yield labelvalues, '_bucket', ('le', floatstr(le)), n
+                yield labelvalues, '_count', None, count
             else:
-                fmtstr = '\n{name} {value}'
-            expfmt += fmtstr.format(
-                name=name,
-                labels=labels,
-                value=floatstr(value),
-            )
-        return expfmt
+                yield labelvalues, '', None, value
+
+    def str_expfmt(self):
+        if self.header is None:
+            self.header = '\n# HELP %s %s\n# TYPE %s %s' % (
+                self.promname, self.desc, self.promname, self.mtype)
+
+        lines = [self.header]
+        lines.extend(self.prefix(suffix, labelvalues, extra) + floatstr(v)
+                     for labelvalues, suffix, extra, v in self.samples())
+        return '\n'.join(lines)
+
+
+def accepts_gzip(accept_encoding):
+    '''
+    Whether an Accept-Encoding header value allows a gzipped response:
+    gzip (or, failing that, "*") has to be listed with a q-value above
+    0.  "gzip;q=0" refuses it, and so does a header without either.
+    '''
+    qvalues = {}
+    for coding in accept_encoding.split(','):
+        params = coding.split(';')
+        name = params[0].strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[name] = q
+    for name in ('gzip', 'x-gzip', '*'):
+        if name in qvalues:
+            return qvalues[name] > 0
+    return False
+
+
+def gzip_compress(chunks):
+    buf = StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb')
+    for chunk in chunks:
+        f.write(chunk)
+    f.close()
+    return buf.getvalue()
+
+
+class Collection(object):
+    '''
+    The rendered result of one collection, served to every scrape until
+    the next one replaces it.  The gzipped form is made on first use.
+    '''
+    def __init__(self, chunks, collected_at, duration):
+        self.chunks = chunks
+        self.collected_at = collected_at
+        self.duration = duration
+        self.lock = Lock()
+        self.gzipped = None
+
+    def stream(self, tail):
+        for chunk in self.chunks:
+            yield chunk
+        yield tail
+
+    def stream_gzip(self, tail):
+        with self.lock:
+            if self.gzipped is None:
+                self.gzipped = gzip_compress(self.chunks)
+        for i in xrange(0, len(self.gzipped), GZIP_CHUNK_SIZE):
+            yield self.gzipped[i:i + GZIP_CHUNK_SIZE]
+        # a gzip stream may consist of several members, so the per-scrape
+        # part is compressed on its own and appended
+        yield gzip_compress([tail])
 
 
 class Module(MgrModule):
@@ -132,6 +309,11 @@ class Module(MgrModule):
         self.serving = False
         self.metrics = dict()
         self.schema = OrderedDict()
+        # replaced as a whole by the collector thread, never modified
+        # in place
+        self.collected = Collection([], None, None)
+        self.collector_event = Event()
+        self.pusher = None
         _global_instance['plugin'] = self
 
     def _get_ordered_schema(self, **kwargs):
@@ -165,46 +347,240 @@ class Module(MgrModule):
 
     def shutdown(self):
         self.serving = False
-        pass
+        self.collector_event.set()
+        if self.pusher:
+            self.pusher.stop()
 
-    # XXX duplicated from dashboard; factor out?
-    def get_latest(self, daemon_type, daemon_name, stat):
-        data = self.get_counter(daemon_type, daemon_name, stat)[stat]
-        if data:
-            return data[-1][1]
+    def get_histograms(self, daemons):
+        '''
+        Fetch histogram data from OSDs.  The counter reports daemons send
+        to the mgr leave out histograms, so ask the OSDs directly, all at
+        once, and use whatever arrives within HISTOGRAM_TIMEOUT.
+        '''
+        results = []
+        for daemon in daemons:
+            result = CommandResult('')
+            self.send_command(result, 'osd', daemon.split('.')[1],
+                              json.dumps({
+                                  'prefix': 'perf histogram dump',
+                                  'format': 'json',
+                              }),
+                              '')
+            results.append((daemon, result))
+
+        histograms = {}
+        deadline = time.time() + HISTOGRAM_TIMEOUT
+        for daemon, result in results:
+            if not result.ev.wait(max(deadline - time.time(), 0)):
+                self.log.debug('no histograms from %s in time' % daemon)
+                continue
+            r, outb, outs = result.wait()
+            if r != 0:
+                self.log.debug('perf histogram dump on %s: %s' % (daemon, outs))
+                continue
+            try:
+                histograms[daemon] = json.loads(outb)
+            except ValueError:
+                self.log.debug('bad histogram data from %s' % daemon)
+        return histograms
+
+    def reuse_metric(self, metrics, name, mtype, desc, labels=None):
+        '''
+        The Metric for name in a collection being built.  Last cycle's
+        Metric is reused, for its formatted label prefixes, but without
+        its values: only what is collected this cycle is exported.
+        '''
+        m = metrics.get(name)
+        if m is not None:
+            return m
+        m = self.metrics.get(name)
+        if m is None:
+            m = Metric(mtype, name, desc, labels)
         else:
-            return 0
+            m.clear()
+        metrics[name] = m
+        return m
 
-    def get_stat(self, daemon, path):
+    def get_stat(self, daemon, path, counters, histograms, metrics):
 
         perfcounter = self.schema[daemon][path]
         stattype = stattype_to_str(perfcounter['type'])
-        # XXX simplify first effort: no histograms
-        # averages are already collapsed to one value for us
-        if not stattype or stattype == 'histogram':
+        if not stattype:
             self.log.debug('ignoring %s, type %s' % (path, stattype))
             return
 
-        if path not in self.metrics:
-            self.metrics[path] = Metric(
-                stattype,
-                path,
-                perfcounter['description'],
-                ('daemon',),
-            )
+        if stattype == 'histogram':
+            logger, name = path.split('.', 1)
+            histogram = histograms.get(daemon, {}).get(logger, {}).get(name)
+            if not histogram:
+                return
+            value = histogram_buckets(histogram)
+        else:
+            data = counters[daemon].get(path)
+            if stattype == 'summary':
+                # datapoints are [time, sum, count]; time sums are in ns
+                value = (data[-1][1], data[-1][2]) if data else (0, 0)
+                if perfcounter['type'] & PERFCOUNTER_TIME:
+                    value = (value[0] / 1e9, value[1])
+            else:
+                value = data[-1][1] if data else 0
 
-        daemon_type, daemon_id = daemon.split('.')
+        m = self.reuse_metric(metrics, path, stattype,
+                              perfcounter['description'], ('daemon',))
+        m.set(value, (daemon,))
 
-        self.metrics[path].set(
-            self.get_latest(daemon_type, daemon_id, path),
-            (daemon,)
-        )
+    def get_cluster_metrics(self):
+        '''
+        Metrics for pools, PG states and OSDs, built from scratch from
+        the mgr's maps so that removed pools and OSDs drop out.
+        '''
+        metrics = {}
+
+        def metric(name, mtype, desc, labels=None):
+            return self.reuse_metric(metrics, name, mtype, desc, labels)
+
+        df = self.get_cached('df')
+        for name, field, mtype, desc in DF_CLUSTER:
+            metric(name, mtype, desc).set(df['stats'].get(field, 0))
+        for name, field, mtype, desc in DF_POOL:
+            m = metric(name, mtype, desc, ('pool_id', 'name'))
+            for pool in df['pools']:
+                m.set(pool['stats'].get(field, 0),
+                      (str(pool['id']), pool['name']))
+
+        # PGs in each state, counting every flag of a combined state
+        # like 'active+clean' separately
+        m = metric('pg_state', 'gauge',
+                   'PGs in each state (a PG can be in several states)',
+                   ('pool_id', 'state'))
+        pg_summary = self.get_cached('pg_summary')
+        for pool_id, states in pg_summary['by_pool'].items():
+            counts = {}
+            for state, num in states.items():
+                for flag in state.split('+'):
+                    counts[flag] = counts.get(flag, 0) + num
+            for flag, num in counts.items():
+                m.set(num, (pool_id, flag))
+
+        osd_map = self.get_cached('osd_map')
+        metric('osd_map_epoch', 'gauge', 'OSDMap epoch').set(
+            osd_map['epoch'])
+        for name, field, mtype, desc in OSD_MAP:
+            m = metric(name, mtype, desc, ('daemon',))
+            for osd in osd_map['osds']:
+                m.set(osd[field], ('osd.%d' % osd['osd'],))
+
+        osd_stats = self.get_osd_stats_view(
+            ['osd'] + [field for _, field, _, _ in OSD_STATS])
+        daemons = ['osd.%d' % osd for osd in osd_stats.column('osd')]
+        for name, field, mtype, desc in OSD_STATS:
+            m = metric(name, mtype, desc, ('daemon',))
+            for daemon, value in zip(daemons, osd_stats.column(field)):
+                m.set(value, (daemon,))
+        m = metric('osd_fill_ratio', 'gauge', 'Fraction of the OSD used',
+                   ('daemon',))
+        for daemon, kb, kb_used in zip(daemons, osd_stats.column('kb'),
+                                       osd_stats.column('kb_used')):
+            if kb:
+                m.set(float(kb_used) / kb, (daemon,))
+
+        return metrics
 
     def collect(self):
-        for daemon in self.schema.keys():
+        '''
+        Build this cycle's metrics from scratch, so that daemons that
+        went away, and histograms that didn't arrive in time, drop out
+        rather than repeating their last values.
+        '''
+        metrics = self.get_cluster_metrics()
+        counters = self.get_all_perf_counters()
+        # the schema keeps daemons that are gone
+        daemons = [daemon for daemon in self.schema.keys()
+                   if daemon in counters]
+        histograms = self.get_histograms([
+            daemon for daemon in daemons
+            if daemon.startswith('osd.') and any(
+                p['type'] & PERFCOUNTER_HISTOGRAM
+                for p in self.schema[daemon].values())
+        ])
+        for daemon in daemons:
             for path in self.schema[daemon].keys():
-                self.get_stat(daemon, path)
-        return self.metrics
+                self.get_stat(daemon, path, counters, histograms, metrics)
+        self.metrics = metrics
+        return metrics
+
+    def format_metrics(self, metrics):
+        return [m.str_expfmt() for m in metrics.values()] + ['\n']
+
+    def collector(self, interval):
+        '''
+        Collect and render all metrics once per interval, so that
+        scrapes only ever hand out the last result.
+        '''
+        while self.serving:
+            start = time.time()
+            try:
+                metrics = self.collect()
+                chunks = self.format_metrics(metrics)
+            except Exception as e:
+                self.log.exception('collection failed: %s' % e)
+            else:
+                end = time.time()
+                self.collected = Collection(chunks, end, end - start)
+                if self.pusher:
+                    self.pusher.submit(
+                        self.pusher.encode(metrics, chunks, end))
+            self.collector_event.wait(max(interval - (time.time() - start),
+                                          0))
+            self.collector_event.clear()
+
+    def collector_metrics(self, collected_at, duration):
+        ''' describe the age and cost of the collection being served '''
+        age = Metric(
+            'gauge',
+            'prometheus_collect_age_seconds',
+            'Seconds since the served metrics were collected',
+        )
+        took = Metric(
+            'gauge',
+            'prometheus_collect_duration_seconds',
+            'Seconds taken to collect the served metrics',
+        )
+        if collected_at is not None:
+            age.set(time.time() - collected_at)
+            took.set(duration)
+        metrics = [age, took]
+        if self.pusher:
+            stats = self.pusher.stats()
+            for key, desc in [('sent', 'Batches pushed'),
+                              ('failed', 'Failed push attempts'),
+                              ('dropped', 'Batches dropped unsent')]:
+                m = Metric('counter', 'prometheus_push_%s' % key, desc)
+                m.set(stats[key])
+                metrics.append(m)
+        return ''.join(m.str_expfmt() for m in metrics) + '\n'
+
+    def start_pusher(self):
+        ''' start push mode, if a push_url is configured '''
+        url = self.get_localized_config('push_url')
+        if not url:
+            return
+        try:
+            self.pusher = Pusher(
+                self.log, url,
+                self.get_localized_config('push_format',
+                                          DEFAULT_PUSH_FORMAT),
+                int(self.get_localized_config('push_queue_size',
+                                              DEFAULT_PUSH_QUEUE_SIZE)),
+                float(self.get_localized_config('push_timeout',
+                                                DEFAULT_PUSH_TIMEOUT)))
+        except ValueError as e:
+            self.log.error('push mode disabled: %s' % e)
+            return
+        self.log.info('pushing %s to %s' % (self.pusher.fmt, url))
+        pusher = Thread(target=self.pusher.run)
+        pusher.daemon = True
+        pusher.start()
 
     def notify(self, ntype, nid):
         ''' Just try to sync and not run until we're notified once '''
@@ -227,18 +603,21 @@ class Module(MgrModule):
                 cherrypy.request.path = ''
                 return self
 
-            def format_metrics(self, metrics):
-                formatted = ''
-                for m in metrics.values():
-                    formatted += m.str_expfmt()
-                return formatted + '\n'
-
             @cherrypy.expose
             def index(self):
-                metrics = global_instance().collect()
-                cherrypy.response.headers['Content-Type'] = 'text/plain'
-                if metrics:
-                    return self.format_metrics(metrics)
+                instance = global_instance()
+                collected = instance.collected
+                tail = instance.collector_metrics(collected.collected_at,
+                                                  collected.duration)
+                headers = cherrypy.response.headers
+                headers['Content-Type'] = 'text/plain'
+                headers['Vary'] = 'Accept-Encoding'
+                if accepts_gzip(cherrypy.request.headers.get(
+                        'Accept-Encoding', '')):
+                    headers['Content-Encoding'] = 'gzip'
+                    return collected.stream_gzip(tail)
+                return collected.stream(tail)
+            index._cp_config = {'response.stream': True}
 
         server_addr = self.get_localized_config('server_addr', DEFAULT_ADDR)
         server_port = self.get_localized_config('server_port', DEFAULT_PORT)
@@ -246,10 +625,17 @@ class Module(MgrModule):
             "server_addr: %s server_port: %s" %
             (server_addr, server_port)
         )
+        scrape_interval = float(self.get_localized_config(
+            'scrape_interval', DEFAULT_SCRAPE_INTERVAL))
         # wait for first notification (of any kind) to start up
         while not self.serving:
             time.sleep(1)
 
+        self.start_pusher()
+        collector = Thread(target=self.collector, args=(scrape_interval,))
+        collector.daemon = True
+        collector.start()
+
         cherrypy.config.update({
             'server.socket_host': server_addr,
             'server.socket_port': server_port,
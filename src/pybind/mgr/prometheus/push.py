@@ -0,0 +1,171 @@
+"""
+Push mode for the prometheus module: ship each collection to a remote
+endpoint instead of (or as well as) waiting to be scraped.
+
+Two formats are supported:
+
+ * 'text': the text exposition format, as served on the scrape
+   endpoint, POSTed as is (e.g. to a Pushgateway).
+ * 'remote_write': a Prometheus remote-write WriteRequest, protobuf
+   encoded and snappy compressed.  Needs the python snappy module.
+"""
+
+import struct
+import urllib2
+from collections import deque
+from threading import Event, Lock
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+
+PUSH_FORMATS = ('text', 'remote_write')
+
+# Longest wait between retries of a failed push, in seconds
+MAX_BACKOFF = 60
+
+
+def _varint(n):
+    out = []
+    while True:
+        b = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(chr(b | 0x80))
+        else:
+            out.append(chr(b))
+            return ''.join(out)
+
+
+def _field(number, data):
+    """ a length-delimited protobuf field """
+    return _varint(number << 3 | 2) + _varint(len(data)) + data
+
+
+def _utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return str(s)
+
+
+def encode_write_request(series):
+    """
+    Encode a remote-write WriteRequest.
+
+    :param series: iterable of (labels, value, timestamp in ms), where
+                   labels is a list of (name, value) including __name__
+    """
+    out = []
+    for labels, value, timestamp in series:
+        ts = ''.join(
+            _field(1, _field(1, _utf8(k)) + _field(2, _utf8(v)))
+            for k, v in sorted(labels))
+        sample = (_varint(1 << 3 | 1) + struct.pack('<d', value) +
+                  _varint(2 << 3) + _varint(timestamp))
+        ts += _field(2, sample)
+        out.append(_field(1, ts))
+    return ''.join(out)
+
+
+class Pusher(object):
+    """
+    Sends batches to the push endpoint from its own thread.  Batches
+    that fail are retried with backoff; the queue is bounded, so while
+    the endpoint is unreachable the oldest batches are dropped.
+    """
+    def __init__(self, log, url, fmt, queue_size, timeout):
+        if fmt not in PUSH_FORMATS:
+            raise ValueError('unknown push format %s' % fmt)
+        if fmt == 'remote_write' and snappy is None:
+            raise ValueError('remote_write needs the python snappy module')
+        self.log = log
+        self.url = url
+        self.fmt = fmt
+        self.timeout = timeout
+        self.queue = deque(maxlen=queue_size)
+        self.lock = Lock()
+        self.event = Event()
+        self.running = True
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def encode(self, metrics, chunks, timestamp):
+        """
+        Build a batch from one collection.
+
+        :param metrics: the collected Metric objects
+        :param chunks: the same metrics, rendered for scraping
+        :param timestamp: collection time, in seconds
+        """
+        if self.fmt == 'text':
+            return ''.join(chunks), {
+                'Content-Type': 'text/plain; version=0.0.4',
+            }
+        ms = int(timestamp * 1000)
+        series = []
+        for m in metrics.values():
+            name = m.promname
+            for labelvalues, suffix, extra, v in m.samples():
+                labels = zip(m.labelnames, labelvalues) if m.labelnames \
+                    else []
+                if extra:
+                    labels.append(extra)
+                labels.append(('__name__', name + suffix))
+                series.append((labels, float(v), ms))
+        return snappy.compress(encode_write_request(series)), {
+            'Content-Type': 'application/x-protobuf',
+            'Content-Encoding': 'snappy',
+            'X-Prometheus-Remote-Write-Version': '0.1.0',
+        }
+
+    def submit(self, batch):
+        with self.lock:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append(batch)
+        self.event.set()
+
+    def post(self, batch):
+        body, headers = batch
+        request = urllib2.Request(self.url, body, headers)
+        urllib2.urlopen(request, timeout=self.timeout).read()
+
+    def run(self):
+        backoff = 0
+        while self.running:
+            self.event.wait(backoff or None)
+            self.event.clear()
+            while self.running:
+                with self.lock:
+                    if not self.queue:
+                        break
+                    batch = self.queue[0]
+                try:
+                    self.post(batch)
+                except Exception as e:
+                    self.failed += 1
+                    backoff = min(max(backoff * 2, 1), MAX_BACKOFF)
+                    self.log.warning('push to %s failed: %s' % (self.url, e))
+                    break
+                with self.lock:
+                    # unless it was pushed out of the queue meanwhile
+                    if self.queue and self.queue[0] is batch:
+                        self.queue.popleft()
+                self.sent += 1
+                backoff = 0
+
+    def stop(self):
+        self.running = False
+        self.event.set()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'sent': self.sent,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'queued': len(self.queue),
+            }
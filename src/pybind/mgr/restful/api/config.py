@@ -12,7 +12,7 @@ class ConfigOsd(RestController):
         """
         Show OSD configuration options
         """
-        flags = module.instance.get("osd_map")['flags']
+        flags = module.instance.get_cached("osd_map")['flags']
 
         # pause is a valid osd config command that sets pauserd,pausewr
         flags = flags.replace('pauserd,pausewr', 'pause')
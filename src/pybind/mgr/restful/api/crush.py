@@ -1,7 +1,7 @@
 from pecan import expose
 from pecan.rest import RestController
 
-from restful import common, module
+from restful import module
 from collections import defaultdict
 
 from restful.decorators import auth
@@ -15,10 +15,10 @@ class CrushRule(RestController):
         Show crush rules
         """
         rules = module.instance.get('osd_map_crush')['rules']
-        nodes = module.instance.get('osd_map_tree')['nodes']
+        resolver = module.instance.get_crush_resolver()
 
         for rule in rules:
-            rule['osd_count'] = len(common.crush_rule_osds(nodes, rule))
+            rule['osd_count'] = len(resolver.rule_osds(rule['rule_id']))
 
         return rules
 
@@ -496,40 +496,42 @@ class Module(MgrModule):
 
 
     def get_osd_pools(self):
-        osds = dict(map(lambda x: (x['osd'], []), self.get('osd_map')['osds']))
-        pools = dict(map(lambda x: (x['pool'], x), self.get('osd_map')['pools']))
-        crush_rules = self.get('osd_map_crush')['rules']
-
-        osds_by_pool = {}
-        for pool_id, pool in pools.items():
-            pool_osds = None
-            for rule in [r for r in crush_rules if r['rule_id'] == pool['crush_rule']]:
-                if rule['min_size'] <= pool['size'] <= rule['max_size']:
-                    pool_osds = common.crush_rule_osds(self.get('osd_map_tree')['nodes'], rule)
-
-            osds_by_pool[pool_id] = pool_osds
-
-        for pool_id in pools.keys():
-            for in_pool_id in osds_by_pool[pool_id]:
-                osds[in_pool_id].append(pool_id)
+        osd_map = self.get_cached('osd_map')
+        osds = dict(map(lambda x: (x['osd'], []), osd_map['osds']))
+        resolver = self.get_crush_resolver()
+
+        for pool in osd_map['pools']:
+            pool_osds = resolver.pool_osds(pool)
+            if pool_osds is None:
+                # No rule that applies to the pool
+                continue
+            for in_pool_id in pool_osds:
+                if in_pool_id in osds:
+                    osds[in_pool_id].append(pool['pool'])
 
         return osds
 
 
     def get_osds(self, pool_id=None, ids=None):
         # Get data
-        osd_map = self.get('osd_map')
-        osd_metadata = self.get('osd_metadata')
-
-        # Update the data with the additional info from the osd map
-        osds = osd_map['osds']
-
-        # Filter by osd ids
         if ids is not None:
-            osds = filter(
-                lambda x: str(x['osd']) in ids,
-                osds
+            # Just the osds asked for, and their metadata.  Ids that
+            # aren't numbers can't name an osd, so they are skipped like
+            # missing ones.
+            osd_ids = []
+            for osd_id in ids:
+                try:
+                    osd_ids.append(int(osd_id))
+                except (TypeError, ValueError):
+                    self.log.debug("Ignoring bad osd id '%s'" % osd_id)
+            osds = filter(None, map(self.get_osd_by_id, osd_ids))
+            osd_metadata = dict(
+                (str(osd['osd']), self.get_metadata('osd', str(osd['osd'])) or {})
+                for osd in osds
             )
+        else:
+            osds = self.get('osd_map')['osds']
+            osd_metadata = self.get('osd_metadata')
 
         # Get list of pools per osd node
         pools_map = self.get_osd_pools()
@@ -537,7 +539,7 @@ class Module(MgrModule):
         # map osd IDs to reweight
         reweight_map = dict([
             (x.get('id'), x.get('reweight', None))
-            for x in self.get('osd_map_tree')['nodes']
+            for x in self.get_cached('osd_map_tree')['nodes']
         ])
 
         # Build OSD data objects
@@ -564,28 +566,20 @@ class Module(MgrModule):
 
 
     def get_osd_by_id(self, osd_id):
-        osd = filter(
-            lambda x: x['osd'] == osd_id,
-            self.get('osd_map')['osds']
-        )
-
-        if len(osd) != 1:
+        try:
+            # A copy, the cached one is shared
+            return dict(self.get_cached_path('osd_map', ('osds', osd_id)))
+        except KeyError:
             return None
 
-        return osd[0]
-
 
     def get_pool_by_id(self, pool_id):
-        pool = filter(
-            lambda x: x['pool'] == pool_id,
-            self.get('osd_map')['pools'],
-        )
-
-        if len(pool) != 1:
+        try:
+            # A copy, the cached one is shared
+            return dict(self.get_cached_path('osd_map', ('pools', pool_id)))
+        except KeyError:
             return None
 
-        return pool[0]
-
 
     def submit_request(self, _request, **kwargs):
         request = CommandsRequest(_request)
@@ -98,6 +98,10 @@ class Module(MgrModule):
         data = self.get_counter(daemon_type, daemon_name, stat)[stat]
 
         #self.log.error("get_latest {0} data={1}".format(stat, data))
+        return self.rate(data)
+
+    @staticmethod
+    def rate(data):
         if data and len(data) > 1:
             return (data[-1][1] - data[-2][1]) / float(data[-1][0] - data[-2][0])
         else:
@@ -110,7 +114,7 @@ class Module(MgrModule):
 
         mds_versions = defaultdict(list)
 
-        fsmap = self.get("fs_map")
+        fsmap = self.get_cached("fs_map")
         for filesystem in fsmap['filesystems']:
             if fs_filter and filesystem['mdsmap']['fs_name'] != fs_filter:
                 continue
@@ -196,9 +200,9 @@ class Module(MgrModule):
                     self.format_dimless(inos, 5)
                 ])
 
-            df = self.get("df")
+            df = self.get_cached("df")
             pool_stats = dict([(p['id'], p['stats']) for p in df['pools']])
-            osdmap = self.get("osd_map")
+            osdmap = self.get_cached("osd_map")
             pools = dict([(p['pool'], p) for p in osdmap['pools']])
             metadata_pool_id = mdsmap['metadata_pool']
             data_pool_ids = mdsmap['data_pools']
@@ -243,14 +247,14 @@ class Module(MgrModule):
 
     def handle_osd_status(self, cmd):
         osd_table = PrettyTable(['id', 'host', 'used', 'avail', 'wr ops', 'wr data', 'rd ops', 'rd data'])
-        osdmap = self.get("osd_map")
+        osdmap = self.get_cached("osd_map")
 
         filter_osds = set()
         bucket_filter = None
         if 'bucket' in cmd:
             self.log.debug("Filtering to bucket '{0}'".format(cmd['bucket']))
             bucket_filter = cmd['bucket']
-            crush = self.get("osd_map_crush")
+            crush = self.get_cached("osd_map_crush")
             found = False
             for bucket in crush['buckets']:
                 if fnmatch.fnmatch(bucket['name'], bucket_filter):
@@ -262,7 +266,10 @@ class Module(MgrModule):
                 return errno.ENOENT, msg, ""
 
         # Build dict of OSD ID to stats
-        osd_stats = dict([(o['osd'], o) for o in self.get("osd_stats")['osd_stats']])
+        osd_stats = dict([(o['osd'], o) for o in self.get_cached("osd_stats")['osd_stats']])
+        counters = self.get_all_perf_counters(
+            'osd', ['osd.op_w', 'osd.op_rw', 'osd.op_in_bytes', 'osd.op_r',
+                    'osd.op_out_bytes'], latest_only=False)
 
         for osd in osdmap['osds']:
             osd_id = osd['osd']
@@ -271,15 +278,19 @@ class Module(MgrModule):
 
             metadata = self.get_metadata('osd', "%s" % osd_id)
             stats = osd_stats[osd_id]
+            osd_counters = counters.get("osd.%s" % osd_id, {})
+
+            def rate(path):
+                return self.rate(osd_counters.get(path))
 
             osd_table.add_row([osd_id, metadata['hostname'],
                                self.format_dimless(stats['kb_used'] * 1024, 5),
                                self.format_dimless(stats['kb_avail'] * 1024, 5),
-                               self.format_dimless(self.get_rate("osd", osd_id.__str__(), "osd.op_w") +
-                               self.get_rate("osd", osd_id.__str__(), "osd.op_rw"), 5),
-                               self.format_dimless(self.get_rate("osd", osd_id.__str__(), "osd.op_in_bytes"), 5),
-                               self.format_dimless(self.get_rate("osd", osd_id.__str__(), "osd.op_r"), 5),
-                               self.format_dimless(self.get_rate("osd", osd_id.__str__(), "osd.op_out_bytes"), 5),
+                               self.format_dimless(rate("osd.op_w") +
+                               rate("osd.op_rw"), 5),
+                               self.format_dimless(rate("osd.op_in_bytes"), 5),
+                               self.format_dimless(rate("osd.op_r"), 5),
+                               self.format_dimless(rate("osd.op_out_bytes"), 5),
                                ])
 
         return 0, "", osd_table.get_string()
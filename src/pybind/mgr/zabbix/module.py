@@ -112,17 +112,17 @@ class Module(MgrModule):
     def get_data(self):
         data = dict()
 
-        health = json.loads(self.get('health')['json'])
+        health = json.loads(self.get_cached('health')['json'])
         # 'status' is luminous+, 'overall_status' is legacy mode.
         data['overall_status'] = health.get('status',
                                             health.get('overall_status'))
         data['overall_status_int'] = \
             self.ceph_health_mapping.get(data['overall_status'])
 
-        mon_status = json.loads(self.get('mon_status')['json'])
+        mon_status = json.loads(self.get_cached('mon_status')['json'])
         data['num_mon'] = len(mon_status['monmap']['mons'])
 
-        df = self.get('df')
+        df = self.get_cached('df')
         data['num_pools'] = len(df['pools'])
         data['total_objects'] = df['stats']['total_objects']
         data['total_used_bytes'] = df['stats']['total_used_bytes']
@@ -145,7 +145,7 @@ class Module(MgrModule):
         data['wr_bytes'] = wr_bytes
         data['rd_bytes'] = rd_bytes
 
-        osd_map = self.get('osd_map')
+        osd_map = self.get_cached('osd_map')
         data['num_osd'] = len(osd_map['osds'])
         data['osd_nearfull_ratio'] = osd_map['nearfull_ratio']
         data['osd_full_ratio'] = osd_map['full_ratio']
@@ -165,15 +165,13 @@ class Module(MgrModule):
         data['num_osd_up'] = num_up
         data['num_osd_in'] = num_in
 
-        osd_fill = list()
-        osd_apply_latency = list()
-        osd_commit_latency = list()
-
-        osd_stats = self.get('osd_stats')
-        for osd in osd_stats['osd_stats']:
-            osd_fill.append((float(osd['kb_used']) / float(osd['kb'])) * 100)
-            osd_apply_latency.append(osd['perf_stat']['apply_latency_ms'])
-            osd_commit_latency.append(osd['perf_stat']['commit_latency_ms'])
+        osd_stats = self.get_osd_stats_view(['kb', 'kb_used',
+                                             'apply_latency_ms',
+                                             'commit_latency_ms'])
+        osd_fill = [(float(used) / float(kb)) * 100 for kb, used in
+                    zip(osd_stats.column('kb'), osd_stats.column('kb_used'))]
+        osd_apply_latency = osd_stats.column('apply_latency_ms')
+        osd_commit_latency = osd_stats.column('commit_latency_ms')
 
         try:
             data['osd_max_fill'] = max(osd_fill)
@@ -193,7 +191,7 @@ class Module(MgrModule):
         except ValueError:
             pass
 
-        pg_summary = self.get('pg_summary')
+        pg_summary = self.get_cached('pg_summary')
         num_pg = 0
         for state, num in pg_summary['all'].items():
             num_pg += num
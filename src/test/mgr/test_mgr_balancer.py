@@ -0,0 +1,416 @@
+#!/usr/bin/env nosetests
+
+import copy
+import logging
+import math
+import os
+import random
+import sys
+import types
+from unittest import TestCase
+
+# the C++ modules ceph-mgr provides are only needed once the balancer
+# talks to a real map, which these tests don't
+for name in ('ceph_state', 'ceph_osdmap', 'ceph_osdmap_incremental',
+             'ceph_crushmap'):
+    sys.modules.setdefault(name, types.ModuleType(name))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'pybind', 'mgr'))
+
+from balancer.module import EvalEngine, IncrementalEval, MoveScheduler, \
+    POOL_TYPE_ERASURE  # noqa
+
+log = logging.getLogger('test_mgr_balancer')
+
+
+class FakeCrush(object):
+    def __init__(self, weights):
+        self.weights = weights
+
+    def find_takes(self):
+        return [-1]
+
+    def get_item_name(self, item):
+        return 'default'
+
+    def get_take_weight_osd_map(self, root):
+        return dict(self.weights)
+
+
+class FakeOSDMap(object):
+    def __init__(self, epoch, cluster):
+        self.epoch = epoch
+        self.cluster = cluster
+
+    def get_epoch(self):
+        return self.epoch
+
+    def get_crush_version(self):
+        return 1
+
+    def get_pools_by_take(self, take):
+        return [p['pool'] for p in self.cluster['pools']]
+
+    def map_pool_pgs_up(self, poolid):
+        return dict((pgid, list(up))
+                    for pgid, up in self.cluster['up'].iteritems()
+                    if pgid.startswith('%d.' % poolid))
+
+
+class FakePgStats(object):
+    def __init__(self, rows):
+        self.rows = rows
+
+    def column(self, name):
+        return [row[name] for row in self.rows]
+
+
+class FakeState(object):
+    """
+    The parts of a MappingState the evaluation uses, for a cluster of
+    one crush root
+    """
+    def __init__(self, cluster, epoch):
+        self.desc = 'epoch %d' % epoch
+        self.cluster = copy.deepcopy(cluster)
+        self.crush = FakeCrush(cluster['weights'])
+        self.osdmap = FakeOSDMap(epoch, self.cluster)
+        self.osdmap_dump = {
+            'epoch': epoch,
+            'pools': cluster['pools'],
+            'erasure_code_profiles': {'ec': {'k': '3', 'm': '1'}},
+            'pg_upmap_items': cluster['upmaps'],
+            'osds': [{'osd': osd, 'up': 1, 'in': 1, 'weight': 1.0,
+                      'primary_affinity': 1.0}
+                     for osd in sorted(cluster['weights'])],
+        }
+        self.pg_stat = self.cluster['pg_stat']
+        self.pg_stats = FakePgStats([
+            dict(stat, pgid=pgid)
+            for pgid, stat in sorted(self.pg_stat.iteritems())])
+        self.pg_up = {}
+
+    def get_pool_pgs_up(self, poolid):
+        if poolid not in self.pg_up:
+            self.pg_up[poolid] = self.osdmap.map_pool_pgs_up(poolid)
+        return self.pg_up[poolid]
+
+
+def make_cluster(num_osds=12, seed=0, ec=True):
+    r = random.Random(seed)
+    if ec:
+        pool = {'pool': 2, 'pool_name': 'ec', 'crush_rule': 1, 'size': 4,
+                'type': POOL_TYPE_ERASURE, 'erasure_code_profile': 'ec'}
+    else:
+        pool = {'pool': 2, 'pool_name': 'data', 'crush_rule': 0, 'size': 2,
+                'type': 1}
+    cluster = {
+        'weights': dict((osd, 1.0 + r.uniform(0, 1))
+                        for osd in range(num_osds)),
+        'pools': [
+            {'pool': 1, 'pool_name': 'rbd', 'crush_rule': 0, 'size': 3,
+             'type': 1},
+            pool,
+        ],
+        'upmaps': [],
+        'up': {},
+        'pg_stat': {},
+    }
+    for pool in cluster['pools']:
+        for ps in range(32):
+            pgid = '%d.%x' % (pool['pool'], ps)
+            cluster['up'][pgid] = r.sample(range(num_osds), pool['size'])
+            cluster['pg_stat'][pgid] = {
+                'num_objects': r.randint(0, 1000),
+                'num_bytes': r.randint(0, 1 << 40),
+                'reported_epoch': 1,
+                'reported_seq': 1,
+            }
+    return cluster
+
+
+def change_stats(cluster, r):
+    """
+    Report new stats for a random PG
+
+    :return: its pgid
+    """
+    pgid = r.choice(sorted(cluster['pg_stat']))
+    old = cluster['pg_stat'][pgid]
+    cluster['pg_stat'][pgid] = {
+        'num_objects': r.randint(0, 1000),
+        'num_bytes': r.randint(0, 1 << 40),
+        'reported_epoch': old['reported_epoch'],
+        'reported_seq': old['reported_seq'] + 1,
+    }
+    return pgid
+
+
+def move_shard(cluster, r):
+    """
+    Move one shard of a random PG to an OSD not already holding it, and
+    change the stats of another PG.
+
+    :return: the id of the pool whose mapping changed
+    """
+    pgid = r.choice(sorted(cluster['up']))
+    up = cluster['up'][pgid]
+    i = r.randrange(len(up))
+    to = r.choice([osd for osd in cluster['weights'] if osd not in up])
+    cluster['upmaps'].append({'pgid': pgid,
+                              'mappings': [{'from': up[i], 'to': to}]})
+    up[i] = to
+    change_stats(cluster, r)
+    return int(pgid.split('.')[0])
+
+
+def eval_results(pe):
+    return {
+        'count_by_pool': pe.count_by_pool,
+        'actual_by_pool': pe.actual_by_pool,
+        'total_by_pool': pe.total_by_pool,
+        'count_by_root': pe.count_by_root,
+        'actual_by_root': pe.actual_by_root,
+        'total_by_root': pe.total_by_root,
+        'stats_by_root': pe.stats_by_root,
+        'score_by_root': pe.score_by_root,
+        'score': pe.score,
+    }
+
+
+def baseline_eval(ms):
+    """
+    The evaluation as Module.calc_eval and Eval.calc_stats did it before
+    EvalEngine, with nested dicts keyed by OSD, and with the score
+    normalized by the weight of the overfull OSDs
+
+    :return: what eval_results returns for an Eval
+    """
+    res = {
+        'count_by_pool': {},
+        'actual_by_pool': {},
+        'total_by_pool': {},
+        'count_by_root': {},
+        'actual_by_root': {},
+        'total_by_root': {},
+        'stats_by_root': {},
+    }
+    keys = ('pgs', 'objects', 'bytes')
+    pool_name = dict((p['pool'], p['pool_name'])
+                     for p in ms.osdmap_dump['pools'])
+    pool_roots = dict((name, []) for name in pool_name.itervalues())
+    target_by_root = {}
+    by_root = {}
+    roots = []
+    for rootid in ms.crush.find_takes():
+        root = ms.crush.get_item_name(rootid)
+        roots.append(root)
+        for poolid in ms.osdmap.get_pools_by_take(rootid):
+            pool_roots[pool_name[poolid]].append(root)
+        target_by_root[root] = ms.crush.get_take_weight_osd_map(rootid)
+        by_root[root] = dict((t, dict((osd, 0) for osd in
+                                      target_by_root[root]))
+                             for t in keys)
+        res['total_by_root'][root] = dict((t, 0) for t in keys)
+
+    for poolid, pool in pool_name.iteritems():
+        total = dict((t, 0) for t in keys)
+        by_osd = dict((t, {}) for t in keys)
+        for root in pool_roots[pool]:
+            for osd in target_by_root[root]:
+                for t in keys:
+                    by_osd[t][osd] = 0
+        for pgid, up in ms.osdmap.map_pool_pgs_up(poolid).iteritems():
+            stat = ms.pg_stat[pgid]
+            n = {'pgs': 1, 'objects': stat['num_objects'],
+                 'bytes': stat['num_bytes']}
+            for osd in [int(osd) for osd in up]:
+                for t in keys:
+                    by_osd[t][osd] += n[t]
+                for root in pool_roots[pool]:
+                    if osd in target_by_root[root]:
+                        for t in keys:
+                            by_root[root][t][osd] += n[t]
+                            total[t] += n[t]
+                            res['total_by_root'][root][t] += n[t]
+                        break
+        res['count_by_pool'][pool] = by_osd
+        res['actual_by_pool'][pool] = dict(
+            (t, dict((k, float(v) / float(max(total[t], 1)))
+                     for k, v in by_osd[t].iteritems()))
+            for t in keys)
+        res['total_by_pool'][pool] = total
+
+    for root in roots:
+        total = res['total_by_root'][root]
+        res['count_by_root'][root] = dict(
+            (t, dict((k, float(v)) for k, v in by_root[root][t].iteritems()))
+            for t in keys)
+        res['actual_by_root'][root] = dict(
+            (t, dict((k, float(v) / float(max(total[t], 1)))
+                     for k, v in by_root[root][t].iteritems()))
+            for t in keys)
+
+        target = target_by_root[root]
+        num = max(len(target), 1)
+        stats = {}
+        for t in keys:
+            avg = float(total[t]) / float(num)
+            dev = 0.0
+            score = 0.0
+            sum_weight = 0.0
+            for k, v in res['count_by_root'][root][t].iteritems():
+                adjusted = float(v) / target[k] / float(num)
+                if adjusted > avg:
+                    score += target[k] * \
+                        math.erf(((adjusted - avg) / avg) / math.sqrt(2.0))
+                    sum_weight += target[k]
+                dev += (avg - adjusted) * (avg - adjusted)
+            stats[t] = {
+                'avg': avg,
+                'stddev': math.sqrt(dev / float(max(num - 1, 1))),
+                'score': score / max(sum_weight, 1),
+            }
+        res['stats_by_root'][root] = stats
+
+    res['score_by_root'] = dict(
+        (r, dict((t, res['stats_by_root'][r][t]['score']) for t in keys))
+        for r in roots)
+    res['score'] = sum(v for vs in res['score_by_root'].itervalues()
+                       for v in vs.itervalues()) / (3 * len(roots))
+    return res
+
+
+class TestEvalEngine(TestCase):
+    def test_matches_baseline_eval(self):
+        for seed in range(5):
+            # the baseline didn't split the bytes of EC pools over shards
+            ms = FakeState(make_cluster(seed=seed, ec=False), 1)
+            pe = EvalEngine(ms, log).run()
+            self.assertEqual(eval_results(pe), baseline_eval(ms))
+
+    def test_advance_matches_full_eval(self):
+        r = random.Random(1)
+        cluster = make_cluster()
+        ms = FakeState(cluster, 1)
+        engine = EvalEngine(ms, log)
+        engine.run()
+        for epoch in range(2, 200):
+            poolid = move_shard(cluster, r)
+            ms = FakeState(cluster, epoch)
+            engine.advance(ms, set([engine.pool_name[poolid]]))
+            pe = engine.finish()
+            full = EvalEngine(FakeState(cluster, epoch), log).run()
+            self.assertEqual(eval_results(pe), eval_results(full))
+
+    def test_only_reported_stats_are_read(self):
+        r = random.Random(4)
+        cluster = make_cluster()
+        engine = EvalEngine(FakeState(cluster, 1), log)
+        engine.run()
+        pgids = set(change_stats(cluster, r) for i in range(5))
+        # a change the PG didn't report is not picked up
+        quiet = sorted(set(cluster['pg_stat']) - pgids)[0]
+        cluster['pg_stat'][quiet] = dict(cluster['pg_stat'][quiet],
+                                         num_objects=-1)
+        ms = FakeState(cluster, 2)
+        self.assertEqual(engine.advance(ms, set()), len(pgids))
+        cluster['pg_stat'][quiet]['reported_seq'] += 1
+        self.assertEqual(
+            engine.advance(FakeState(cluster, 3), set()), 1)
+        full = EvalEngine(FakeState(cluster, 3), log).run()
+        self.assertEqual(eval_results(engine.finish()), eval_results(full))
+
+    def test_ec_bytes_divided_over_shards(self):
+        cluster = make_cluster()
+        pe = EvalEngine(FakeState(cluster, 1), log).run()
+        self.assertEqual(pe.data_shards, {'rbd': 1, 'ec': 3})
+        ec_bytes = sum(s['num_bytes'] for pgid, s in
+                       cluster['pg_stat'].iteritems()
+                       if pgid.startswith('2.'))
+        # 4 shards of each PG, each holding a third of its bytes
+        self.assertAlmostEqual(pe.total_by_pool['ec']['bytes'],
+                               ec_bytes * 4 / 3.0, delta=4)
+
+    def test_earlier_evals_unchanged(self):
+        r = random.Random(2)
+        cluster = make_cluster()
+        engine = EvalEngine(FakeState(cluster, 1), log)
+        first = engine.run()
+        before = copy.deepcopy(eval_results(first))
+        for epoch in range(2, 20):
+            poolid = move_shard(cluster, r)
+            engine.advance(FakeState(cluster, epoch),
+                           set([engine.pool_name[poolid]]))
+            engine.finish()
+        self.assertEqual(eval_results(first), before)
+
+    def test_evals_are_independent(self):
+        cluster = make_cluster()
+        engine = EvalEngine(FakeState(cluster, 1), log)
+        first = engine.run()
+        expected = copy.deepcopy(eval_results(first))
+        # whatever a caller does with one Eval doesn't show in the next
+        first.count_by_pool['rbd']['pgs'].clear()
+        first.actual_by_root['default']['pgs'].clear()
+        first.stats_by_root['default']['bytes']['avg'] = -1
+        engine.advance(FakeState(cluster, 2), set())
+        self.assertEqual(eval_results(engine.finish()), expected)
+
+
+class TestIncrementalEval(TestCase):
+    def test_tracks_upmap_changes(self):
+        r = random.Random(3)
+        cluster = make_cluster()
+        tracker = IncrementalEval(log)
+        tracker.eval(FakeState(cluster, 1))
+        for epoch in range(2, 50):
+            move_shard(cluster, r)
+            ms = FakeState(cluster, epoch)
+            # the mappings of unchanged pools are taken over from the
+            # last state, as get_cluster_state does
+            pe = tracker.eval(ms)
+            full = EvalEngine(FakeState(cluster, epoch), log).run()
+            self.assertEqual(eval_results(pe), eval_results(full))
+            self.assertTrue(tracker.last_state() is ms)
+        self.assertEqual(tracker.stats['full'], 1)
+        self.assertEqual(tracker.stats['incremental'], 48)
+
+    def test_older_state_is_evaluated_in_full(self):
+        cluster = make_cluster()
+        tracker = IncrementalEval(log)
+        latest = FakeState(cluster, 5)
+        tracker.eval(latest)
+        tracker.eval(FakeState(cluster, 4))
+        self.assertTrue(tracker.last_state() is latest)
+
+
+class TestMoveScheduler(TestCase):
+    def make_state(self):
+        ms = FakeState(make_cluster(), 1)
+        ms.pg_stats = FakePgStats([
+            {'pgid': '1.0', 'state': 'active+remapped+backfilling',
+             'num_bytes': 3000},
+            {'pgid': '2.0', 'state': 'active+remapped+backfilling',
+             'num_bytes': 3000},
+            {'pgid': '2.1', 'state': 'active+clean', 'num_bytes': 3000},
+        ])
+        return ms
+
+    def test_in_flight_counts_shard_bytes(self):
+        sched = MoveScheduler(self.make_state(), 10000, 0, {2: 3})
+        self.assertEqual(sched.in_flight, 3000 + 1000)
+        self.assertEqual(sched.budget, 10000 - 4000)
+
+    def test_admit(self):
+        sched = MoveScheduler(self.make_state(), 10000, 1, {2: 3})
+        admitted = sched.admit([
+            ('a', 1.0, 5000, [1, 2]),
+            # best gain per byte, but osd 1 is taken by then
+            ('b', 1.0, 100, [1, 3]),
+            ('c', 0.1, 1000, [4, 5]),
+            # over what is left of the budget
+            ('d', 10.0, 7000, [6, 7]),
+        ])
+        self.assertEqual(admitted, set(['b', 'c']))
+        self.assertEqual(sched.admitted_bytes, 1100)
@@ -0,0 +1,179 @@
+#!/usr/bin/env nosetests
+
+import copy
+import json
+import os
+import random
+import sys
+from unittest import TestCase
+
+# appended: dashboard/types.py would shadow the standard library module
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '..', 'pybind', 'mgr', 'dashboard'))
+
+from feed import Feed, json_patch  # noqa
+
+
+def apply_patch(doc, ops):
+    """
+    Apply RFC 6902 add, remove and replace operations, as a client does
+    """
+    for op in ops:
+        if op['path'] == u'':
+            assert op['op'] == 'replace'
+            doc = copy.deepcopy(op['value'])
+            continue
+        keys = [k.replace(u'~1', u'/').replace(u'~0', u'~')
+                for k in op['path'].split(u'/')[1:]]
+        parent = doc
+        for k in keys[:-1]:
+            parent = parent[int(k) if isinstance(parent, list) else k]
+        k = keys[-1]
+        if isinstance(parent, list):
+            k = int(k)
+        if op['op'] == 'remove':
+            del parent[k]
+        elif op['op'] == 'add':
+            assert isinstance(parent, dict) and k not in parent
+            parent[k] = copy.deepcopy(op['value'])
+        else:
+            assert op['op'] == 'replace'
+            parent[k] = copy.deepcopy(op['value'])
+    return doc
+
+
+def random_doc(r, depth=0):
+    kind = r.randrange(6 if depth < 3 else 3)
+    if kind == 0:
+        return r.randint(0, 3)
+    elif kind == 1:
+        return r.choice([u'a', u'b', u'x/y', u'x~y', None, True])
+    elif kind == 2:
+        return r.random()
+    elif kind == 3:
+        return [random_doc(r, depth + 1) for i in range(r.randrange(4))]
+    else:
+        return dict((r.choice([u'a', u'b', u'c', u'a/b', u'~', u'']),
+                     random_doc(r, depth + 1))
+                    for i in range(r.randrange(5)))
+
+
+def mutate(r, doc):
+    """
+    A copy of `doc` with a few things changed, as a document is between
+    two versions
+    """
+    if isinstance(doc, dict) and doc and r.random() < .8:
+        doc = dict(doc)
+        k = r.choice(sorted(doc))
+        action = r.randrange(3)
+        if action == 0:
+            del doc[k]
+        elif action == 1:
+            doc[k + u'+'] = random_doc(r, 2)
+        else:
+            doc[k] = mutate(r, doc[k])
+        return doc
+    if isinstance(doc, list) and doc and r.random() < .8:
+        doc = list(doc)
+        i = r.randrange(len(doc))
+        doc[i] = mutate(r, doc[i])
+        return doc
+    return random_doc(r)
+
+
+class TestJsonPatch(TestCase):
+    def check(self, old, new):
+        ops = json_patch(old, new)
+        # what clients get is JSON
+        ops = json.loads(json.dumps(ops))
+        self.assertEqual(apply_patch(copy.deepcopy(old), ops), new)
+        return ops
+
+    def test_equal(self):
+        doc = {u'a': [1, {u'b': None}], u'c': u'd'}
+        self.assertEqual(self.check(doc, copy.deepcopy(doc)), [])
+
+    def test_dict(self):
+        ops = self.check({u'a': 1, u'b': 2, u'c': {u'd': 3}},
+                         {u'a': 1, u'c': {u'd': 4}, u'e': 5})
+        self.assertEqual(sorted(ops), sorted([
+            {u'op': u'remove', u'path': u'/b'},
+            {u'op': u'replace', u'path': u'/c/d', u'value': 4},
+            {u'op': u'add', u'path': u'/e', u'value': 5},
+        ]))
+
+    def test_escaped_keys(self):
+        ops = self.check({u'a/b': 1, u'~': {u'x': 2}},
+                         {u'a/b': 2, u'~': {u'x': 3}})
+        self.assertEqual(sorted(op['path'] for op in ops),
+                         [u'/a~1b', u'/~0/x'])
+
+    def test_list_items(self):
+        ops = self.check([1, 2, 3, 4, 5], [1, 2, 0, 4, 5])
+        self.assertEqual(ops, [
+            {u'op': u'replace', u'path': u'/2', u'value': 0}])
+
+    def test_list_length_changed(self):
+        ops = self.check({u'l': [1, 2]}, {u'l': [1, 2, 3]})
+        self.assertEqual(ops, [
+            {u'op': u'replace', u'path': u'/l', u'value': [1, 2, 3]}])
+
+    def test_list_replaced_when_shorter(self):
+        new = [{u'a': 2, u'b': 2}]
+        ops = self.check([{u'a': 1, u'b': 1}], new)
+        # two ops for a list of one
+        self.assertEqual(ops, [
+            {u'op': u'replace', u'path': u'', u'value': new}])
+
+    def test_type_changed(self):
+        self.check({u'a': [1]}, {u'a': {u'0': 1}})
+        self.check({u'a': 1}, {u'a': 1.5})
+        self.check([1], {u'a': 1})
+
+    def test_random_round_trips(self):
+        r = random.Random(0)
+        for i in range(500):
+            old = random_doc(r)
+            new = old
+            for j in range(r.randrange(1, 4)):
+                new = mutate(r, new)
+            self.check(old, new)
+
+
+class TestFeed(TestCase):
+    def setUp(self):
+        self.doc = {u'osds': [{u'id': 0, u'up': 1}, {u'id': 1, u'up': 1}]}
+        self.feed = Feed(lambda: self.doc)
+
+    def test_patches_bring_client_up_to_date(self):
+        first = self.feed.poll(wait=0)
+        client = first['data']
+        self.assertEqual(client, self.doc)
+
+        versions = []
+        for up in (0, 1, 0):
+            self.doc = copy.deepcopy(self.doc)
+            self.doc[u'osds'][1][u'up'] = up
+            self.feed.invalidate()
+            versions.append(self.feed.poll(wait=0)['version'])
+
+        result = self.feed.poll(self.feed.id, first['version'], wait=0)
+        self.assertEqual(result['version'], versions[-1])
+        self.assertEqual(apply_patch(client, result['patch']), self.doc)
+
+    def test_current_client_gets_nothing(self):
+        first = self.feed.poll(wait=0)
+        result = self.feed.poll(first['id'], first['version'], wait=0)
+        self.assertEqual(result['patch'], [])
+        self.assertEqual(result['version'], first['version'])
+
+    def test_unchanged_document_keeps_version(self):
+        first = self.feed.poll(wait=0)
+        self.feed.invalidate()
+        self.assertEqual(self.feed.poll(wait=0)['version'], first['version'])
+
+    def test_other_feed_gets_data(self):
+        first = self.feed.poll(wait=0)
+        result = self.feed.poll('another id', first['version'], wait=0)
+        self.assertEqual(result['data'], self.doc)
@@ -0,0 +1,101 @@
+#!/usr/bin/env nosetests
+
+import logging
+import os
+import sys
+from unittest import TestCase
+
+# appended: dashboard/types.py would shadow the standard library module
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '..', 'pybind', 'mgr', 'dashboard'))
+
+from ioctx_pool import IoctxPool  # noqa
+
+
+class FakeIoctx(object):
+    def __init__(self, pool_name):
+        self.pool_name = pool_name
+        self.closed = False
+
+    def close(self):
+        assert not self.closed
+        self.closed = True
+
+
+class FakeRados(object):
+    def __init__(self):
+        self.opened = []
+
+    def open_ioctx(self, pool_name):
+        ioctx = FakeIoctx(pool_name)
+        self.opened.append(ioctx)
+        return ioctx
+
+
+class FakeModule(object):
+    def __init__(self):
+        self.log = logging.getLogger('test_mgr_dashboard_ioctx_pool')
+        self.rados = FakeRados()
+
+
+class TestIoctxPool(TestCase):
+    def setUp(self):
+        self.module = FakeModule()
+        self.pool = IoctxPool(self.module, max_size=2)
+
+    def use(self, pool_name):
+        ioctx = self.pool.acquire(pool_name)
+        self.pool.release(ioctx)
+        return ioctx
+
+    def test_reused(self):
+        a = self.use('a')
+        self.assertTrue(self.use('a') is a)
+        self.assertEqual(len(self.module.rados.opened), 1)
+        self.assertFalse(a.closed)
+
+    def test_evicted_is_closed(self):
+        a = self.use('a')
+        b = self.use('b')
+        self.use('a')
+        c = self.use('c')
+        # b was the least recently used
+        self.assertTrue(b.closed)
+        self.assertFalse(a.closed)
+        self.assertFalse(c.closed)
+
+    def test_evicted_in_use_is_closed_on_release(self):
+        a = self.pool.acquire('a')
+        self.use('b')
+        self.use('c')
+        self.assertFalse(a.closed)
+        # a new one while the old one is still in use
+        a2 = self.use('a')
+        self.assertFalse(a2 is a)
+        self.pool.release(a)
+        self.assertTrue(a.closed)
+
+    def test_shared_is_closed_on_last_release(self):
+        a = self.pool.acquire('a')
+        self.assertTrue(self.pool.acquire('a') is a)
+        self.pool.discard('a')
+        self.pool.release(a)
+        self.assertFalse(a.closed)
+        self.pool.release(a)
+        self.assertTrue(a.closed)
+
+    def test_discard(self):
+        a = self.use('a')
+        self.pool.discard('a')
+        self.assertTrue(a.closed)
+        self.pool.discard('a')
+        self.assertFalse(self.use('a') is a)
+
+    def test_close(self):
+        a = self.use('a')
+        b = self.pool.acquire('b')
+        self.pool.close()
+        self.assertTrue(a.closed)
+        self.assertFalse(b.closed)
+        self.pool.release(b)
+        self.assertTrue(b.closed)
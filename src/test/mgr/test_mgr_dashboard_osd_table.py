@@ -0,0 +1,156 @@
+#!/usr/bin/env nosetests
+
+import logging
+import os
+import sys
+from unittest import TestCase
+
+# appended: dashboard/types.py would shadow the standard library module
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '..', 'pybind', 'mgr', 'dashboard'))
+
+from osd_table import OsdTable, RingBuffer  # noqa
+
+
+class FakeModule(object):
+    """
+    Six OSDs on three hosts; odd ones are down, and osd.5 is out.
+    osd.N writes N * 10 ops per second.
+    """
+    url_prefix = '/prefix'
+
+    def __init__(self):
+        self.log = logging.getLogger('test_mgr_dashboard_osd_table')
+        self.now = 100
+        self.latest_only = []
+        self.osd_map = {
+            'epoch': 1,
+            'osds': [{'osd': i, 'up': i % 2 == 0, 'in': i != 5}
+                     for i in range(6)],
+        }
+        self.servers = [
+            {'hostname': 'node-b', 'services': [
+                {'type': 'osd', 'id': '0'}, {'type': 'osd', 'id': '1'}]},
+            {'hostname': 'node-a', 'services': [
+                {'type': 'osd', 'id': '2'}, {'type': 'osd', 'id': '3'},
+                {'type': 'mon', 'id': 'a'}]},
+            {'hostname': 'Node-C', 'services': [
+                {'type': 'osd', 'id': '4'}, {'type': 'osd', 'id': '5'}]},
+        ]
+
+    def get_cached(self, what):
+        assert what == 'osd_map'
+        return self.osd_map
+
+    def list_servers(self):
+        return self.servers
+
+    def get_all_perf_counters(self, svc_type, names, latest_only=False):
+        self.latest_only.append(latest_only)
+        times = [self.now] if latest_only else range(self.now - 9,
+                                                     self.now + 1)
+        result = {}
+        for osd in self.osd_map['osds']:
+            i = osd['osd']
+            result['osd.%d' % i] = {
+                'osd.op_w': [[t, t * i * 10] for t in times],
+                'osd.numpg': [[self.now, 100 + i]],
+            }
+        return result
+
+
+class TestRingBuffer(TestCase):
+    def test_wraps_and_ignores_old_points(self):
+        buf = RingBuffer(3)
+        self.assertEqual(buf.rate(), 0)
+        for t in range(5):
+            buf.append(t, t * 2)
+        buf.append(3, 100)
+        self.assertEqual(buf.items(), [[2, 4], [3, 6], [4, 8]])
+        self.assertEqual(buf.rate(), 2)
+
+
+class TestOsdTable(TestCase):
+    def setUp(self):
+        self.module = FakeModule()
+        self.table = OsdTable(self.module, history=5)
+
+    def ids(self, **kwargs):
+        return [r['id'] for r in self.table.query(**kwargs)['osds']]
+
+    def test_rows(self):
+        result = self.table.query()
+        self.assertEqual(result['total'], 6)
+        self.assertEqual(result['matched'], 6)
+        row = result['osds'][3]
+        self.assertEqual(row['id'], 3)
+        self.assertEqual(row['host'], 'node-a')
+        self.assertEqual(row['url'], '/prefix/osd/perf/3')
+        self.assertFalse(row['up'])
+        self.assertEqual(row['stats']['op_w'], 30)
+        self.assertEqual(row['stats']['numpg'], 103)
+        self.assertEqual(row['stats']['stat_bytes'], 0)
+        self.assertFalse('stats_history' in row)
+
+    def test_sort(self):
+        self.assertEqual(self.ids(), [0, 1, 2, 3, 4, 5])
+        self.assertEqual(self.ids(reverse=True), [5, 4, 3, 2, 1, 0])
+        self.assertEqual(self.ids(sort='host'), [4, 5, 2, 3, 0, 1])
+        self.assertEqual(self.ids(sort='op_w', reverse=True),
+                         [5, 4, 3, 2, 1, 0])
+        # ties stay in table order, by host then id
+        self.assertEqual(self.ids(sort='up'), [5, 3, 1, 4, 2, 0])
+
+    def test_filter(self):
+        self.assertEqual(self.ids(filter='NODE-A'), [2, 3])
+        self.assertEqual(self.ids(filter='c'), [4, 5])
+        self.assertEqual(self.ids(filter='5'), [5])
+        result = self.table.query(filter='nothing')
+        self.assertEqual(result['osds'], [])
+        self.assertEqual(result['total'], 6)
+        self.assertEqual(result['matched'], 0)
+
+    def test_state(self):
+        self.assertEqual(self.ids(state='up'), [0, 2, 4])
+        self.assertEqual(self.ids(state='down'), [1, 3, 5])
+        self.assertEqual(self.ids(state='in'), [0, 1, 2, 3, 4])
+        self.assertEqual(self.ids(state='out'), [5])
+        result = self.table.query(state='down', filter='node-b')
+        self.assertEqual(result['matched'], 1)
+
+    def test_paging(self):
+        self.assertEqual(self.ids(page_size=4), [0, 1, 2, 3])
+        self.assertEqual(self.ids(page=1, page_size=4), [4, 5])
+        self.assertEqual(self.ids(page=2, page_size=4), [])
+        self.assertEqual(self.ids(page=1, page_size=2, reverse=True),
+                         [3, 2])
+        self.assertEqual(self.ids(page=1, page_size=2, state='up'), [4])
+
+    def test_history(self):
+        rows = self.table.query(page_size=2, history=True)['osds']
+        history = rows[1]['stats_history']
+        self.assertEqual(sorted(history),
+                         ['op_in_bytes', 'op_out_bytes', 'op_r', 'op_w'])
+        # only as much as we keep
+        self.assertEqual(history['op_w'],
+                         [[t, t * 10] for t in range(96, 101)])
+        self.assertEqual(history['op_r'], [])
+        # the table itself doesn't get them
+        self.assertFalse('stats_history' in self.table.rows[1])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, self.table.query, sort='nothing')
+        self.assertRaises(ValueError, self.table.query, state='nothing')
+
+    def test_refresh_takes_only_new_points(self):
+        self.table.refresh()
+        self.module.now = 110
+        self.module.servers[0]['services'].pop()
+        self.module.osd_map = dict(self.module.osd_map, epoch=2)
+        self.table.refresh()
+        self.assertEqual(self.module.latest_only, [False, True])
+        # osd.1 has no metadata now
+        self.assertEqual(self.ids(), [0, 2, 3, 4, 5])
+        history = self.table.query(filter='3',
+                                   history=True)['osds'][0]['stats_history']
+        self.assertEqual(history['op_w'][-2:], [[100, 3000], [110, 3300]])
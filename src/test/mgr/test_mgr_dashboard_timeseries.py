@@ -0,0 +1,118 @@
+#!/usr/bin/env nosetests
+
+import os
+import sys
+from unittest import TestCase
+
+# appended: dashboard/types.py would shadow the standard library module
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '..', 'pybind', 'mgr', 'dashboard'))
+
+from timeseries import RAW_POINTS, Tier, TimeSeriesStore, \
+    percentile  # noqa
+
+
+class TestPercentile(TestCase):
+    def test_percentile(self):
+        values = range(101)
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([3], 95), 3)
+        self.assertEqual(percentile([], 50), 0)
+
+
+class TestTier(TestCase):
+    def test_keeps_last_sample_of_each_period(self):
+        tier = Tier('10s', 10, 4)
+        for t, v in [(0, 1), (5, 2), (9, 3), (10, 4), (19, 5), (25, 6)]:
+            tier.add(t, {'x': v})
+        series = tier.series('x')
+        self.assertEqual(series['times'], [9, 19, 25])
+        self.assertEqual(series['values'], [3, 5, 6])
+
+    def test_rates_against_previous_period(self):
+        tier = Tier('10s', 10, 4)
+        tier.add(0, {'x': 0})
+        tier.add(10, {'x': 100})
+        # replaces the sample at 10, with the rate since the one at 0
+        tier.add(15, {'x': 300})
+        self.assertEqual(tier.series('x')['rates'], [0, 20])
+        self.assertEqual(tier.latest('x'), (300, 20))
+
+    def test_retention(self):
+        tier = Tier('10s', 10, 3)
+        for t in range(0, 100, 10):
+            tier.add(t, {'x': t * 2})
+        series = tier.series('x')
+        self.assertEqual(series['times'], [70, 80, 90])
+        self.assertEqual(series['values'], [140, 160, 180])
+        self.assertEqual(series['rates'], [2, 2, 2])
+
+    def test_raw_keeps_every_sample(self):
+        tier = Tier('raw', None, 3)
+        for t in range(5):
+            tier.add(t, {'x': t})
+        self.assertEqual(tier.series('x')['times'], [2, 3, 4])
+
+    def test_percentiles_of_complete_periods(self):
+        tier = Tier('10s', 10, 100)
+        v = 0
+        for i in range(1, 101):
+            v += i * 10
+            tier.add(i * 10, {'x': v})
+        # the rate of the sample at t is t / 10 per second, counted from
+        # the second sample on and up to the one at 990: the newest
+        # period isn't complete yet
+        self.assertEqual(tier.series('x')['percentiles'], {
+            'p50': 51, 'p95': 94, 'p99': 98})
+
+    def test_stats_appearing_later(self):
+        tier = Tier('10s', 10, 3)
+        tier.add(0, {'x': 1})
+        tier.add(10, {'x': 2, 'y': 5})
+        self.assertEqual(tier.series('y')['values'], [0, 5])
+        self.assertEqual(tier.series('z')['values'], [])
+
+
+class TestTimeSeriesStore(TestCase):
+    def test_retention_override(self):
+        store = TimeSeriesStore({'10s': 60, '1m': 30})
+        self.assertEqual(store.tiers, [
+            ('10s', 10, 6),
+            # never fewer than two samples
+            ('1m', 60, 2),
+            ('10m', 600, 3 * 24 * 6),
+        ])
+
+    def test_latest(self):
+        store = TimeSeriesStore()
+        self.assertEqual(store.latest('pool'), {})
+        for t in range(20):
+            store.add('pool', t, {'bytes': t * 100})
+        latest = store.latest('pool')['bytes']
+        self.assertEqual(latest['latest'], 1900)
+        self.assertEqual(latest['rate'], 100)
+        self.assertEqual(len(latest['series']), RAW_POINTS)
+        self.assertEqual(latest['series'][0], (19, 1900))
+
+    def test_get(self):
+        store = TimeSeriesStore()
+        for t in range(0, 3600, 5):
+            store.add('pool', t, {'bytes': t})
+        self.assertEqual(len(store.get('pool', 'bytes', '10s')['times']), 360)
+        self.assertEqual(store.get('pool', 'bytes', '1m')['times'][-3:],
+                         [3475, 3535, 3595])
+        self.assertEqual(len(store.get('pool', 'bytes', 'raw')['times']),
+                         RAW_POINTS)
+        self.assertEqual(store.get('pool', 'objects', '1m'), None)
+        self.assertEqual(store.get('other', 'bytes', '1m'), None)
+        self.assertRaises(ValueError, store.get, 'pool', 'bytes', '1h')
+
+    def test_retain(self):
+        store = TimeSeriesStore()
+        for key in ('a', 'b', 'c'):
+            store.add(key, 0, {'bytes': 1})
+        store.retain(['a', 'c', 'd'])
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.get('b', 'bytes', 'raw'), None)
+        self.assertNotEqual(store.get('c', 'bytes', 'raw'), None)
@@ -0,0 +1,253 @@
+#!/usr/bin/env nosetests
+
+import logging
+import os
+import socket
+import struct
+import sys
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from Queue import Queue
+from threading import Thread
+from unittest import TestCase, skipIf
+
+# push.py stands on its own; load it without the rest of the module
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '..', 'pybind', 'mgr', 'prometheus'))
+
+import push  # noqa
+
+log = logging.getLogger('test_mgr_prometheus_push')
+log.addHandler(logging.NullHandler())
+
+
+def read_varint(buf, i):
+    n = 0
+    shift = 0
+    while True:
+        b = ord(buf[i])
+        i += 1
+        n |= (b & 0x7f) << shift
+        shift += 7
+        if not b & 0x80:
+            return n, i
+
+
+def read_fields(buf):
+    """
+    :return: list of (field number, value) of a protobuf message, with
+             length-delimited values as strings
+    """
+    fields = []
+    i = 0
+    while i < len(buf):
+        key, i = read_varint(buf, i)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, i = read_varint(buf, i)
+        elif wire_type == 1:
+            value = struct.unpack('<d', buf[i:i + 8])[0]
+            i += 8
+        elif wire_type == 2:
+            n, i = read_varint(buf, i)
+            value = buf[i:i + n]
+            i += n
+        else:
+            raise ValueError('unexpected wire type %d' % wire_type)
+        fields.append((number, value))
+    return fields
+
+
+def decode_write_request(buf):
+    """
+    :return: list of (labels, [(value, timestamp)]) of a WriteRequest
+    """
+    series = []
+    for number, ts in read_fields(buf):
+        assert number == 1
+        labels = []
+        samples = []
+        for number, value in read_fields(ts):
+            if number == 1:
+                label = dict(read_fields(value))
+                labels.append((label[1], label[2]))
+            elif number == 2:
+                sample = dict(read_fields(value))
+                samples.append((sample[1], sample[2]))
+        series.append((labels, samples))
+    return series
+
+
+class Receiver(object):
+    """
+    A local HTTP endpoint that records what is POSTed to it, answering
+    with the given status codes in turn (then 200)
+    """
+    def __init__(self, statuses=()):
+        self.requests = Queue()
+        self.statuses = list(statuses)
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                status = receiver.statuses.pop(0) if receiver.statuses \
+                    else 200
+                if status == 200:
+                    receiver.requests.put((dict(self.headers), body))
+                self.send_response(status)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d/push' % self.server.server_port
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get(self, timeout=10):
+        return self.requests.get(timeout=timeout)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeMetric(object):
+    def __init__(self, promname, labelnames, samples):
+        self.promname = promname
+        self.labelnames = labelnames
+        self._samples = samples
+
+    def samples(self):
+        return iter(self._samples)
+
+
+def unused_port_url():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return 'http://127.0.0.1:%d/push' % port
+
+
+class PusherTestCase(TestCase):
+    def setUp(self):
+        self.receiver = None
+        self.pusher = None
+        self.thread = None
+
+    def tearDown(self):
+        if self.pusher:
+            self.pusher.stop()
+            self.thread.join()
+        if self.receiver:
+            self.receiver.stop()
+
+    def start(self, url, fmt, queue_size=4):
+        self.pusher = push.Pusher(log, url, fmt, queue_size, 5)
+        self.thread = Thread(target=self.pusher.run)
+        self.thread.start()
+        return self.pusher
+
+    def wait_for(self, predicate, timeout=10):
+        deadline = time.time() + timeout
+        while not predicate():
+            if time.time() > deadline:
+                self.fail('timed out, pusher stats %s' % self.pusher.stats())
+            time.sleep(0.01)
+
+
+class TestEncodeWriteRequest(TestCase):
+    def test_round_trip(self):
+        series = [
+            ([('__name__', 'ceph_pool_bytes_used'), ('pool_id', '1')],
+             1234.5, 1500000000123),
+            ([('__name__', 'ceph_osd_up'), ('ceph_daemon', 'osd.0')],
+             1.0, 1500000000123),
+            ([('__name__', 'ceph_pool_objects'), ('name', u'p\xe9"')],
+             -0.25, 0),
+        ]
+        decoded = decode_write_request(push.encode_write_request(series))
+        self.assertEqual(decoded, [
+            ([('__name__', 'ceph_pool_bytes_used'), ('pool_id', '1')],
+             [(1234.5, 1500000000123)]),
+            ([('__name__', 'ceph_osd_up'), ('ceph_daemon', 'osd.0')],
+             [(1.0, 1500000000123)]),
+            ([('__name__', 'ceph_pool_objects'),
+              ('name', u'p\xe9"'.encode('utf-8'))],
+             [(-0.25, 0)]),
+        ])
+
+
+class TestPusher(PusherTestCase):
+    def test_text_push_arrives_intact(self):
+        self.receiver = Receiver()
+        pusher = self.start(self.receiver.url, 'text')
+        chunks = ['\n# HELP ceph_osd_up up\n# TYPE ceph_osd_up gauge',
+                  '\nceph_osd_up{ceph_daemon="osd.0"} 1.0',
+                  '\nceph_pool_objects{name="a\\"b"} 3.0\n']
+        pusher.submit(pusher.encode({}, chunks, time.time()))
+        headers, body = self.receiver.get()
+        self.assertEqual(body, ''.join(chunks))
+        self.assertEqual(headers['content-type'],
+                         'text/plain; version=0.0.4')
+        self.wait_for(lambda: pusher.stats()['sent'] == 1)
+
+    @skipIf(push.snappy is None, 'needs the python snappy module')
+    def test_remote_write_push_decodes(self):
+        self.receiver = Receiver()
+        pusher = self.start(self.receiver.url, 'remote_write')
+        metrics = {
+            'osd_up': FakeMetric('ceph_osd_up', ('ceph_daemon',), [
+                (('osd.0',), '', None, 1),
+                (('osd.1',), '', None, 0),
+            ]),
+            'lat': FakeMetric('ceph_osd_op_r_latency', ('ceph_daemon',), [
+                (('osd.0',), '_bucket', ('le', '0.5'), 3),
+                (('osd.0',), '_count', None, 4),
+            ]),
+        }
+        pusher.submit(pusher.encode(metrics, [], 1500000000.5))
+        headers, body = self.receiver.get()
+        self.assertEqual(headers['content-encoding'], 'snappy')
+        decoded = decode_write_request(push.snappy.uncompress(body))
+        self.assertEqual(sorted(decoded), sorted([
+            ([('__name__', 'ceph_osd_up'), ('ceph_daemon', 'osd.0')],
+             [(1.0, 1500000000500)]),
+            ([('__name__', 'ceph_osd_up'), ('ceph_daemon', 'osd.1')],
+             [(0.0, 1500000000500)]),
+            ([('__name__', 'ceph_osd_op_r_latency_bucket'),
+              ('ceph_daemon', 'osd.0'), ('le', '0.5')],
+             [(3.0, 1500000000500)]),
+            ([('__name__', 'ceph_osd_op_r_latency_count'),
+              ('ceph_daemon', 'osd.0')],
+             [(4.0, 1500000000500)]),
+        ]))
+
+    def test_retry_after_server_error(self):
+        self.receiver = Receiver(statuses=[503])
+        pusher = self.start(self.receiver.url, 'text')
+        pusher.submit(('batch', {'Content-Type': 'text/plain'}))
+        headers, body = self.receiver.get()
+        self.assertEqual(body, 'batch')
+        self.wait_for(lambda: pusher.stats()['sent'] == 1)
+        stats = pusher.stats()
+        self.assertEqual(stats['failed'], 1)
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['dropped'], 0)
+
+    def test_drop_oldest_while_unreachable(self):
+        pusher = self.start(unused_port_url(), 'text', queue_size=2)
+        for i in range(5):
+            pusher.submit(('batch %d' % i, {}))
+        self.wait_for(lambda: pusher.stats()['failed'] >= 1)
+        stats = pusher.stats()
+        self.assertEqual(stats['sent'], 0)
+        self.assertEqual(stats['dropped'], 3)
+        self.assertEqual(stats['queued'], 2)
+        self.assertEqual([body for body, headers in pusher.queue],
+                         ['batch 3', 'batch 4'])
@@ -0,0 +1,659 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Ceph - scalable distributed file system
+#
+# This is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public
+# License version 2, as published by the Free Software
+# Foundation.  See file COPYING.
+#
+
+"""
+Offline simulator and benchmark for the mgr balancer module.
+
+The C++ modules ceph-mgr provides to python (ceph_state, ceph_osdmap,
+ceph_osdmap_incremental, ceph_crushmap) are replaced by a simulated
+cluster, and the real mgr_module.py and balancer module are loaded on top
+of it.  The balancer is then run round after round: each round creates a
+plan, optimizes it, executes it against the simulated cluster and
+evaluates the result.
+
+The cluster is either synthetic (--osds/--pools/--pgs) or loaded from a
+recorded 'ceph osd dump -f json' / 'ceph pg dump -f json' pair, with an
+optional 'ceph osd crush dump -f json' for the crush roots.
+
+Synthetic PGs are placed with straw2 over a small per-PG candidate set,
+so crush-compat weight changes move data the way they would with CRUSH.
+Recorded PGs keep their recorded raw mapping; only upmaps move them.
+
+Executed plans take effect immediately: data movement is assumed to have
+completed by the next round.
+
+  balancer_bench.py --osds 2000 --pools 4 --pgs 65536 --mode upmap
+  balancer_bench.py --osdmap osd.json --pg-dump pg.json --crush crush.json
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import time
+import types
+from array import array
+
+MGR_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', 'pybind', 'mgr')
+
+POOL_TYPE_REPLICATED = 1
+POOL_TYPE_ERASURE = 3
+
+
+class SimCluster(object):
+    """
+    The parts of a cluster that don't change while the balancer runs:
+    crush roots and rules, pools, PG stats and the raw placement of each
+    PG.
+    """
+    def __init__(self):
+        self.roots = {}         # root id -> (name, {osd: crush weight})
+        self.rule_root = {}     # crush rule id -> root id
+        self.pools = {}         # pool id -> pool dict (as in osd dump)
+        self.ec_profiles = {}   # profile name -> profile dict
+        self.pg_stat = {}       # pgid -> stat_sum
+        self.pool_pgs = {}      # pool id -> [pgid]
+
+        # synthetic placement: pgid -> (candidate osds, straw draws)
+        self.candidates = {}
+        # recorded placement: pgid -> raw up
+        self.fixed = {}
+
+    def crush_weight(self, osd):
+        for name, weights in self.roots.itervalues():
+            if osd in weights:
+                return weights[osd]
+        return 0.0
+
+    def pool_root(self, poolid):
+        return self.rule_root.get(self.pools[poolid]['crush_rule'])
+
+    def raw_up(self, pgid, size, weight):
+        fixed = self.fixed.get(pgid)
+        if fixed is not None:
+            return list(fixed)
+        cand, draws = self.candidates[pgid]
+        straws = []
+        for osd, draw in zip(cand, draws):
+            w = weight(osd)
+            if w > 0:
+                # straw2: the largest log(u) / w wins
+                straws.append((draw / w, osd))
+        straws.sort(reverse=True)
+        return [osd for s, osd in straws[:size]]
+
+
+def synthetic_cluster(num_osds, num_pools, num_pgs, num_ec_pools=0,
+                      weight_spread=0.0, candidates=12, seed=0):
+    r = random.Random(seed)
+    cluster = SimCluster()
+    weights = {}
+    for osd in range(num_osds):
+        weights[osd] = 1.0 + r.uniform(0, weight_spread)
+    cluster.roots[-1] = ('default', weights)
+    cluster.rule_root[0] = -1
+    cluster.rule_root[1] = -1
+    cluster.ec_profiles['default'] = {'k': '2', 'm': '1'}
+    osds = sorted(weights.keys())
+    pg_num = max(num_pgs // max(num_pools, 1), 1)
+    for poolid in range(1, num_pools + 1):
+        ec = poolid > num_pools - num_ec_pools
+        cluster.pools[poolid] = {
+            'pool': poolid,
+            'pool_name': 'pool%d' % poolid,
+            'type': POOL_TYPE_ERASURE if ec else POOL_TYPE_REPLICATED,
+            'size': 3,
+            'min_size': 2,
+            'pg_num': pg_num,
+            'pg_placement_num': pg_num,
+            'crush_rule': 1 if ec else 0,
+            'erasure_code_profile': 'default' if ec else '',
+        }
+        # pools fill up unevenly
+        fill = r.uniform(0.2, 1.0)
+        pgs = []
+        for ps in range(pg_num):
+            pgid = '%d.%x' % (poolid, ps)
+            pgs.append(pgid)
+            cand = r.sample(osds, min(candidates, len(osds)))
+            draws = array('d', [math.log(1.0 - r.random()) for c in cand])
+            cluster.candidates[pgid] = (array('i', cand), draws)
+            objects = int(r.lognormvariate(7, 0.5) * fill)
+            cluster.pg_stat[pgid] = {
+                'num_objects': objects,
+                'num_bytes': objects * r.randint(1 << 20, 4 << 20),
+            }
+        cluster.pool_pgs[poolid] = pgs
+    return SimOSDMap(cluster, 1, 1, osd_weights=dict.fromkeys(osds, 1.0))
+
+
+def recorded_cluster(osd_dump, pg_dump, crush_dump=None):
+    cluster = SimCluster()
+    osd_weights = {}
+    for o in osd_dump.get('osds', []):
+        osd_weights[o['osd']] = float(o['weight'])
+    if crush_dump:
+        buckets = {b['id']: b for b in crush_dump['buckets']}
+
+        def leaves(bid, acc):
+            for item in buckets[bid]['items']:
+                if item['id'] >= 0:
+                    acc[item['id']] = item['weight'] / float(0x10000)
+                else:
+                    leaves(item['id'], acc)
+            return acc
+
+        for rule in crush_dump.get('rules', []):
+            for step in rule['steps']:
+                if step['op'] == 'take':
+                    root = step['item']
+                    cluster.rule_root[rule['rule_id']] = root
+                    if root not in cluster.roots:
+                        cluster.roots[root] = (buckets[root]['name'],
+                                               leaves(root, {}))
+                    break
+    else:
+        cluster.roots[-1] = ('default', dict.fromkeys(osd_weights, 1.0))
+    for p in osd_dump.get('pools', []):
+        cluster.pools[p['pool']] = p
+        cluster.pool_pgs[p['pool']] = []
+        if not crush_dump:
+            cluster.rule_root[p['crush_rule']] = -1
+    cluster.ec_profiles = osd_dump.get('erasure_code_profiles', {})
+    upmaps = {}
+    for item in osd_dump.get('pg_upmap_items', []):
+        upmaps[item['pgid']] = [(m['from'], m['to'])
+                                for m in item['mappings']]
+    for pg in pg_dump.get('pg_stats', []):
+        pgid = pg['pgid']
+        poolid = int(pgid.split('.')[0])
+        if poolid not in cluster.pools:
+            continue
+        # undo the recorded upmaps to get back to the raw mapping
+        raw = list(pg['up'])
+        for frm, to in upmaps.get(pgid, []):
+            if to in raw:
+                raw[raw.index(to)] = frm
+        cluster.fixed[pgid] = raw
+        cluster.pg_stat[pgid] = pg['stat_sum']
+        cluster.pool_pgs[poolid].append(pgid)
+    return SimOSDMap(cluster, osd_dump.get('epoch', 1), 1,
+                     osd_weights=osd_weights, upmap_items=upmaps)
+
+
+class SimOSDMap(object):
+    def __init__(self, cluster, epoch, crush_version, osd_weights,
+                 compat_ws=None, upmap_items=None):
+        self.cluster = cluster
+        self.epoch = epoch
+        self.crush_version = crush_version
+        self.osd_weights = osd_weights      # osd -> reweight (0..1)
+        self.compat_ws = compat_ws          # osd -> weight, or None
+        self.upmap_items = upmap_items or {}  # pgid -> [(from, to)]
+        self._up = {}
+
+    def copy(self):
+        return SimOSDMap(self.cluster, self.epoch + 1, self.crush_version,
+                         dict(self.osd_weights),
+                         None if self.compat_ws is None
+                         else dict(self.compat_ws),
+                         dict(self.upmap_items))
+
+    def weight(self, osd):
+        if self.compat_ws is not None and osd in self.compat_ws:
+            w = self.compat_ws[osd]
+        else:
+            w = self.cluster.crush_weight(osd)
+        return w * self.osd_weights.get(osd, 0.0)
+
+    def pg_up(self, pgid, size):
+        up = self.cluster.raw_up(pgid, size, self.weight)
+        for frm, to in self.upmap_items.get(pgid, []):
+            if frm in up and to not in up:
+                up[up.index(frm)] = to
+        return up
+
+    def map_pool(self, poolid):
+        if poolid not in self._up:
+            size = self.cluster.pools[poolid]['size']
+            self._up[poolid] = {
+                pgid: self.pg_up(pgid, size)
+                for pgid in self.cluster.pool_pgs[poolid]
+            }
+        return self._up[poolid]
+
+    def dump(self):
+        return {
+            'epoch': self.epoch,
+            'pools': [dict(p) for p in self.cluster.pools.itervalues()],
+            'osds': [{
+                'osd': osd,
+                'up': 1,
+                'in': 1 if w > 0 else 0,
+                'weight': w,
+                'primary_affinity': 1.0,
+            } for osd, w in sorted(self.osd_weights.iteritems())],
+            'pg_upmap': [],
+            'pg_upmap_items': [{
+                'pgid': pgid,
+                'mappings': [{'from': f, 'to': t} for f, t in items],
+            } for pgid, items in sorted(self.upmap_items.iteritems())],
+            'erasure_code_profiles': self.cluster.ec_profiles,
+        }
+
+    def crush_dump(self):
+        buckets = []
+        choose_args = []
+        for rootid, (name, weights) in sorted(self.cluster.roots.items()):
+            osds = sorted(weights.keys())
+            buckets.append({
+                'id': rootid,
+                'name': name,
+                'items': [{'id': osd, 'weight': int(weights[osd] * 0x10000),
+                           'pos': pos} for pos, osd in enumerate(osds)],
+            })
+            if self.compat_ws is not None:
+                choose_args.append({
+                    'bucket_id': rootid,
+                    'weight_set': [[self.compat_ws.get(osd, weights[osd])
+                                    for osd in osds]],
+                })
+        r = {
+            'buckets': buckets,
+            'rules': [{'rule_id': rule, 'steps': [{'op': 'take',
+                                                   'item': root}]}
+                      for rule, root in self.cluster.rule_root.iteritems()],
+            'choose_args': {},
+        }
+        if self.compat_ws is not None:
+            r['choose_args']['-1'] = choose_args
+        return r
+
+    def pg_dump(self):
+        stats = []
+        for poolid in self.cluster.pools:
+            for pgid, up in self.map_pool(poolid).iteritems():
+                stats.append({
+                    'pgid': pgid,
+                    'up': up,
+                    'acting': up,
+                    'state': 'active+clean',
+                    # stats never change in the simulation
+                    'reported_epoch': 1,
+                    'reported_seq': 1,
+                    'stat_sum': self.cluster.pg_stat[pgid],
+                })
+        return {'pg_stats': stats}
+
+    def calc_pg_upmaps(self, inc, max_deviation, max_iterations, pools):
+        """
+        A simple stand-in for OSDMap::calc_pg_upmaps: repeatedly move one
+        PG instance from the most overfull to the most underfull OSD of
+        its root, until every OSD is within max_deviation of its target
+        or max_iterations changes were made.
+        """
+        tmp = self.apply_incremental(inc)
+        # like the binding, take pools by name or id
+        poolids = [p['pool'] for p in self.cluster.pools.itervalues()
+                   if p['pool_name'] in pools or p['pool'] in pools]
+        did = 0
+        for rootid, (name, weights) in self.cluster.roots.iteritems():
+            mine = [p for p in poolids if self.cluster.pool_root(p) == rootid]
+            if not mine:
+                continue
+            total_w = sum(tmp.weight(o) for o in weights) or 1.0
+            count = dict.fromkeys(weights, 0)
+            mapping = {}
+            for poolid in mine:
+                for pgid, up in tmp.map_pool(poolid).iteritems():
+                    mapping[pgid] = up
+                    for osd in up:
+                        if osd in count:
+                            count[osd] += 1
+            total = sum(count.values())
+            target = {o: total * tmp.weight(o) / total_w for o in weights}
+
+            def dev(o):
+                return (count[o] - target[o]) / max(target[o], 1.0)
+
+            while did < max_iterations:
+                live = [o for o in weights if target[o] > 0]
+                over = max(live, key=dev)
+                under = min(live, key=dev)
+                if dev(over) <= max_deviation or over == under:
+                    break
+                moved = False
+                for pgid, up in mapping.iteritems():
+                    if over in up and under not in up:
+                        items = inc.new_upmaps.get(
+                            pgid, self.upmap_items.get(pgid, []))
+                        inc.new_upmaps[pgid] = list(items) + [(over, under)]
+                        up[up.index(over)] = under
+                        count[over] -= 1
+                        count[under] += 1
+                        did += 1
+                        moved = True
+                        break
+                if not moved:
+                    break
+        return did
+
+    def apply_incremental(self, inc):
+        m = self.copy()
+        m.epoch = inc.epoch
+        for pgid in inc.old_upmaps:
+            m.upmap_items.pop(pgid, None)
+        m.upmap_items.update(inc.new_upmaps)
+        m.osd_weights.update(inc.reweights)
+        if inc.compat_ws:
+            if m.compat_ws is None:
+                m.compat_ws = {}
+            m.compat_ws.update(inc.compat_ws)
+            m.crush_version += 1
+        return m
+
+
+class SimIncremental(object):
+    def __init__(self, osdmap):
+        self.epoch = osdmap.epoch + 1
+        self.new_upmaps = {}
+        self.old_upmaps = set()
+        self.reweights = {}
+        self.compat_ws = {}
+
+    def dump(self):
+        return {
+            'epoch': self.epoch,
+            'new_pg_upmap_items': [{
+                'pgid': pgid,
+                'mappings': [{'from': f, 'to': t} for f, t in items],
+            } for pgid, items in sorted(self.new_upmaps.iteritems())],
+            'old_pg_upmap_items': sorted(self.old_upmaps),
+        }
+
+
+class SimState(object):
+    """
+    Backs the ceph_state module: serves 'get' requests from the current
+    simulated map and applies mon commands to it.
+    """
+    def __init__(self, osdmap, config=None, verbose=False):
+        self.osdmap = osdmap
+        self.config = config or {}
+        self.verbose = verbose
+        self.commands = 0
+
+    def log(self, handle, level, msg):
+        if self.verbose:
+            print('%s %d %s' % (handle, level, msg), file=sys.stderr)
+
+    def get(self, handle, data_name):
+        if data_name == 'pg_dump':
+            return self.osdmap.pg_dump()
+        if data_name == 'pg_status':
+            return {
+                'unknown_pgs_ratio': 0.0,
+                'degraded_ratio': 0.0,
+                'inactive_pgs_ratio': 0.0,
+                'misplaced_ratio': 0.0,
+            }
+        if data_name == 'osd_map':
+            return self.osdmap.dump()
+        raise KeyError(data_name)
+
+    def get_pg_stats(self, handle, fields):
+        cols = dict((f, []) for f in fields.split(','))
+        for pg in self.osdmap.pg_dump()['pg_stats']:
+            for f, col in cols.iteritems():
+                col.append(pg[f] if f in pg else pg['stat_sum'][f])
+        return cols
+
+    def send_command(self, handle, result, svc_type, svc_id, command, tag):
+        self.commands += 1
+        cmd = json.loads(command)
+        prefix = cmd['prefix']
+        m = self.osdmap.copy()
+        outb = ''
+        if prefix == 'osd pg-upmap-items':
+            ids = cmd['id']
+            m.upmap_items[cmd['pgid']] = zip(ids[::2], ids[1::2])
+        elif prefix == 'osd rm-pg-upmap-items':
+            m.upmap_items.pop(cmd['pgid'], None)
+        elif prefix == 'osd crush weight-set create-compat':
+            if m.compat_ws is None:
+                m.compat_ws = {}
+                m.crush_version += 1
+        elif prefix == 'osd crush weight-set reweight-compat':
+            if m.compat_ws is None:
+                m.compat_ws = {}
+            m.compat_ws[int(cmd['item'].split('.')[1])] = cmd['weight'][0]
+            m.crush_version += 1
+        elif prefix == 'osd reweightn':
+            for osd, w in json.loads(cmd['weights']).iteritems():
+                m.osd_weights[int(osd)] = float(w)
+        elif prefix == 'osd crush dump':
+            outb = json.dumps(m.crush_dump())
+            m = self.osdmap
+        else:
+            result.complete(-22, '', 'unsupported command %s' % prefix)
+            return
+        self.osdmap = m
+        result.complete(0, outb, '')
+
+
+def install_stubs(state):
+    """
+    Register stand-ins for the modules ceph-mgr provides in C++.
+    """
+    def module(name, **funcs):
+        mod = types.ModuleType(name)
+        for k, v in funcs.iteritems():
+            setattr(mod, k, v)
+        sys.modules[name] = mod
+
+    module('ceph_state',
+           log=state.log,
+           get_version=lambda: 'balancer_bench',
+           get=state.get,
+           get_pg_stats=state.get_pg_stats,
+           get_server=lambda handle, hostname: [],
+           get_config=lambda handle, key: state.config.get(key),
+           set_config=lambda handle, key, val: state.config.__setitem__(
+               key, val),
+           get_config_prefix=lambda handle, prefix: {
+               k: v for k, v in state.config.iteritems()
+               if k.startswith(prefix)},
+           get_mgr_id=lambda: 'x',
+           send_command=state.send_command,
+           set_health_checks=lambda handle, checks: None,
+           get_osdmap=lambda: state.osdmap)
+    module('ceph_osdmap',
+           get_epoch=lambda m: m.epoch,
+           get_crush_version=lambda m: m.crush_version,
+           dump=lambda m: m.dump(),
+           new_incremental=SimIncremental,
+           apply_incremental=lambda m, inc: m.apply_incremental(inc),
+           get_crush=lambda m: m,
+           get_pools_by_take=lambda m, take: {'pools': [
+               p for p in m.cluster.pools if m.cluster.pool_root(p) == take]},
+           calc_pg_upmaps=lambda m, inc, dev, it, pools:
+               m.calc_pg_upmaps(inc, dev, it, pools),
+           map_pool_pgs_up=lambda m, poolid: {
+               pgid: list(up) for pgid, up in m.map_pool(poolid).iteritems()})
+    module('ceph_osdmap_incremental',
+           get_epoch=lambda inc: inc.epoch,
+           dump=lambda inc: inc.dump(),
+           set_osd_reweights=lambda inc, w: inc.reweights.update(w),
+           set_crush_compat_weight_set_weights=lambda inc, w:
+               inc.compat_ws.update(w))
+
+    def take_weight_osd_map(m, root):
+        name, weights = m.cluster.roots[root]
+        total = sum(weights.values()) or 1.0
+        return {'weights': {str(o): w / total for o, w in weights.items()}}
+
+    module('ceph_crushmap',
+           dump=lambda m: m.crush_dump(),
+           get_item_name=lambda m, item: m.cluster.roots[item][0],
+           find_takes=lambda m: {'takes': sorted(m.cluster.roots.keys())},
+           get_take_weight_osd_map=take_weight_osd_map)
+
+
+def count_moved(before, after):
+    moved = 0
+    for poolid in before.cluster.pools:
+        old = before.map_pool(poolid)
+        for pgid, up in after.map_pool(poolid).iteritems():
+            if old[pgid] != up:
+                moved += 1
+    return moved
+
+
+def pgs_stddev(pe):
+    """
+    Mean over roots of the stddev of weight-adjusted PG counts.
+    """
+    devs = [s['pgs']['stddev'] for s in pe.stats_by_root.itervalues()]
+    return sum(devs) / max(len(devs), 1)
+
+
+def timed(f, *args, **kwargs):
+    t0 = time.time()
+    r = f(*args, **kwargs)
+    return r, time.time() - t0
+
+
+def run(osdmap, args):
+    state = SimState(osdmap, verbose=args.verbose)
+    install_stubs(state)
+    sys.path.insert(0, MGR_DIR)
+    from balancer import module as balancer
+
+    state.config.update({
+        'mode': args.mode,
+        'max_misplaced': str(args.max_misplaced),
+    })
+    for kv in args.set or []:
+        k, v = kv.split('=', 1)
+        state.config[k] = v
+    mod = balancer.Module('balancer')
+
+    results = {'evals': [], 'rounds': []}
+    for i in range(args.evals):
+        ms = balancer.MappingState(
+            mod.get_osdmap(),
+            mod.get_pg_stats_view(balancer.PG_STAT_FIELDS), 'bench')
+        pe, secs = timed(mod.calc_eval, ms)
+        results['evals'].append(secs)
+    if results['evals']:
+        print('calc_eval: %d runs, %.4fs mean, %.4fs min' % (
+            len(results['evals']),
+            sum(results['evals']) / len(results['evals']),
+            min(results['evals'])))
+
+    print('%5s %10s %10s %9s %9s %9s %8s' % (
+        'round', 'score', 'pg_stddev', 'plan_s', 'exec_s', 'eval_s',
+        'moved'))
+    for r in range(args.rounds):
+        before = state.osdmap
+        name = 'bench_%d' % r
+        plan, plan_secs = timed(mod.plan_create, name)
+        ok, secs = timed(mod.optimize, plan)
+        plan_secs += secs
+        exec_secs = 0.0
+        if ok:
+            x, exec_secs = timed(mod.execute, plan)
+        mod.plan_rm(name)
+        moved = count_moved(before, state.osdmap)
+        ms = mod.get_cluster_state('round %d' % r)
+        pe, eval_secs = timed(mod.calc_eval, ms, True)
+        row = {
+            'round': r,
+            'epoch': state.osdmap.epoch,
+            'score': pe.score,
+            'pg_stddev': pgs_stddev(pe),
+            'plan_secs': plan_secs,
+            'exec_secs': exec_secs,
+            'eval_secs': eval_secs,
+            'pgs_moved': moved,
+        }
+        results['rounds'].append(row)
+        print('%5d %10.6f %10.6f %9.4f %9.4f %9.4f %8d' % (
+            r, row['score'], row['pg_stddev'], plan_secs, exec_secs,
+            eval_secs, moved))
+        if not ok or moved == 0:
+            print('converged after %d rounds' % (r + 1))
+            break
+    results['commands'] = state.commands
+    results['pgs_moved'] = sum(r['pgs_moved'] for r in results['rounds'])
+    print('%d mon commands, %d pgs moved' % (results['commands'],
+                                             results['pgs_moved']))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Simulate and benchmark the mgr balancer module')
+    parser.add_argument('--osds', type=int, default=100)
+    parser.add_argument('--pools', type=int, default=4)
+    parser.add_argument('--ec-pools', type=int, default=0,
+                        help='how many of the pools are erasure coded')
+    parser.add_argument('--pgs', type=int, default=4096,
+                        help='total PGs, split evenly across pools')
+    parser.add_argument('--weight-spread', type=float, default=0.0,
+                        help='crush weights are 1 + uniform(0, spread)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--osdmap', help='recorded ceph osd dump -f json')
+    parser.add_argument('--pg-dump', help='recorded ceph pg dump -f json')
+    parser.add_argument('--crush', help='recorded ceph osd crush dump -f json')
+    parser.add_argument('--mode', default='upmap',
+                        choices=['none', 'crush-compat', 'upmap'])
+    parser.add_argument('--max-misplaced', type=float, default=.03)
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--evals', type=int, default=3,
+                        help='calc_eval runs to time before balancing')
+    parser.add_argument('--set', action='append', metavar='KEY=VALUE',
+                        help='set a balancer config key')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='print balancer log messages to stderr')
+    args = parser.parse_args()
+
+    if args.osdmap or args.pg_dump:
+        if not (args.osdmap and args.pg_dump):
+            parser.error('--osdmap and --pg-dump go together')
+        crush = None
+        if args.crush:
+            with open(args.crush) as f:
+                crush = json.load(f)
+        with open(args.osdmap) as f:
+            osd_dump = json.load(f)
+        with open(args.pg_dump) as f:
+            pg_dump = json.load(f)
+        osdmap = recorded_cluster(osd_dump, pg_dump, crush)
+    else:
+        osdmap = synthetic_cluster(args.osds, args.pools, args.pgs,
+                                   args.ec_pools, args.weight_spread,
+                                   seed=args.seed)
+
+    results = run(osdmap, args)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+
+
+if __name__ == '__main__':
+    main()